@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""Recall@k and latency of the IVF index per nprobe, against brute force.
+
+Uniformly random vectors have no neighborhoods for an ANN index to find, so
+the corpus is drawn around random topic centers, like real embeddings of
+movies that cluster by genre. Queries are fresh points from the same
+topics, not corpus rows.
+"""
+
+import argparse
+import json
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "cli"))
+
+from lib.ann import IVFIndex, evaluate
+from lib.embeddings import normalize
+
+
+def clustered(rng: np.random.Generator, centers: np.ndarray, n: int, spread: float):
+    topics = rng.integers(len(centers), size=n)
+    noise = rng.standard_normal((n, centers.shape[1])) * spread
+    return normalize(centers[topics] + noise)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--docs", type=int, default=200_000)
+    parser.add_argument("--dimension", type=int, default=384)
+    parser.add_argument("--topics", type=int, default=200)
+    parser.add_argument("--spread", type=float, default=0.1)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--limit", type=int, default=10)
+    parser.add_argument("--lists", type=int, default=None)
+    parser.add_argument(
+        "--nprobe", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32, 64]
+    )
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", action="store_true", help="Print JSON only")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    centers = rng.standard_normal((args.topics, args.dimension)) / np.sqrt(
+        args.dimension
+    )
+    queries = clustered(rng, centers, args.queries, args.spread)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "embeddings.npy"
+        matrix = np.lib.format.open_memmap(
+            path, mode="w+", dtype=np.float32, shape=(args.docs, args.dimension)
+        )
+        for start in range(0, args.docs, 65_536):
+            rows = min(65_536, args.docs - start)
+            matrix[start : start + rows] = clustered(rng, centers, rows, args.spread)
+        matrix.flush()
+        del matrix
+        vectors = np.load(path, mmap_mode="r")
+
+        start = time.perf_counter()
+        index = IVFIndex.build(vectors, None, args.lists)
+        build_seconds = time.perf_counter() - start
+
+        results = evaluate(index, vectors, queries, args.limit, args.nprobe)
+
+    if args.json:
+        print(json.dumps({"build_seconds": build_seconds, "results": results}))
+        return
+
+    print(f"corpus: {args.docs} x {args.dimension} float32, {args.topics} topics")
+    print(f"ivf: {index.n_lists} lists, built in {build_seconds:.1f} s")
+    print(
+        f"{'nprobe':>8} {'recall@' + str(args.limit):>10} {'p50 ms':>8} {'p95 ms':>8}"
+    )
+    for result in results:
+        nprobe = "exact" if result["nprobe"] is None else result["nprobe"]
+        print(
+            f"{nprobe:>8} {result['recall']:>10.3f} {result['p50_ms']:>8.2f}"
+            f" {result['p95_ms']:>8.2f}   scanned {result['scanned']:.1%}"
+        )
+
+
+if __name__ == "__main__":
+    main()
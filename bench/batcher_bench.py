@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""Throughput and latency of embedding requests with and without batching.
+
+A stand-in encoder sleeps like a model does: a fixed cost per call plus a
+smaller cost per text. Concurrent asyncio clients send one text at a time
+through an `EmbeddingBatcher`; max batch size 1 is the unbatched baseline.
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "cli"))
+
+from lib.batcher import EmbeddingBatcher
+
+
+def stand_in_encoder(call_ms: float, text_ms: float, dimension: int = 384):
+    def encode(texts: list[str]) -> np.ndarray:
+        time.sleep((call_ms + text_ms * len(texts)) / 1000)
+        return np.zeros((len(texts), dimension), dtype=np.float32)
+
+    return encode
+
+
+async def run(args: argparse.Namespace, batch_size: int) -> dict:
+    batcher = EmbeddingBatcher(
+        stand_in_encoder(args.call_ms, args.text_ms),
+        max_batch_size=batch_size,
+        max_wait_ms=args.wait_ms,
+        max_queue=args.clients * 2,
+    )
+    latencies: list[float] = []
+
+    async def client(i: int) -> None:
+        for j in range(args.requests):
+            start = time.perf_counter()
+            await batcher.embed(f"query {i} {j}")
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client(i) for i in range(args.clients)))
+    seconds = time.perf_counter() - start
+    stats = batcher.stats()
+    await batcher.close()
+
+    ms = np.array(latencies) * 1000
+    return {
+        "max_batch_size": batch_size,
+        "requests_per_s": len(latencies) / seconds,
+        "latency_p50_ms": float(np.percentile(ms, 50)),
+        "latency_p95_ms": float(np.percentile(ms, 95)),
+        **stats,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--clients", type=int, default=64)
+    parser.add_argument("--requests", type=int, default=20, help="Per client")
+    parser.add_argument("--call-ms", type=float, default=8.0)
+    parser.add_argument("--text-ms", type=float, default=0.5)
+    parser.add_argument("--wait-ms", type=float, default=5.0)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32, 64])
+    parser.add_argument("--json", action="store_true", help="Print JSON only")
+    args = parser.parse_args()
+
+    results = [asyncio.run(run(args, size)) for size in args.batch_sizes]
+    if args.json:
+        print(json.dumps(results))
+        return
+
+    print(
+        f"{args.clients} clients x {args.requests} requests, encoder"
+        f" {args.call_ms} ms/call + {args.text_ms} ms/text, wait {args.wait_ms} ms"
+    )
+    print(
+        f"{'batch':>6} {'req/s':>8} {'fill':>6} {'queue p50':>10} {'queue p95':>10}"
+        f" {'p50 ms':>8} {'p95 ms':>8}"
+    )
+    for result in results:
+        print(
+            f"{result['max_batch_size']:>6} {result['requests_per_s']:>8.0f}"
+            f" {result['fill_rate']:>6.0%} {result['queue_delay_p50_ms']:>10.1f}"
+            f" {result['queue_delay_p95_ms']:>10.1f} {result['latency_p50_ms']:>8.1f}"
+            f" {result['latency_p95_ms']:>8.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
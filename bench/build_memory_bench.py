@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""Peak memory and time of `InvertedIndex.build` for several memory budgets.
+
+Every build runs in a fresh process over a generated corpus file, so the
+peak RSS of the process is the peak of that build.
+"""
+
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "cli"))
+
+from corpus import write_corpus
+
+
+def run_build(corpus: Path, budget_mib: int) -> None:
+    from lib import inverted_index
+    from lib.utils import iter_movies
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        inverted_index.CACHE_DIR = Path(cache_dir)
+        inverted_index.CACHE_BUILD_FILE = Path(cache_dir) / "build.seg"
+        inverted_index.iter_movies = lambda: iter_movies(corpus)
+
+        index = inverted_index.InvertedIndex()
+        start = time.perf_counter()
+        index.build(memory_budget=budget_mib * 1024**2)
+        seconds = time.perf_counter() - start
+
+        peak_kib = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        spilled = index.built_segment is not None
+        print(
+            json.dumps({"seconds": seconds, "peak_kib": peak_kib, "spilled": spilled})
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--docs", type=int, default=200_000)
+    parser.add_argument("--vocab", type=int, default=50_000)
+    parser.add_argument("--doc-length", type=int, default=60)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument(
+        "--budgets", type=int, nargs="+", default=[4096, 256, 64], help="MiB"
+    )
+    parser.add_argument("--child", nargs=2, metavar=("CORPUS", "BUDGET"))
+    args = parser.parse_args()
+
+    if args.child:
+        run_build(Path(args.child[0]), int(args.child[1]))
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        corpus = Path(tmp) / "movies.jsonl"
+        write_corpus(corpus, args.docs, args.vocab, args.doc_length, args.seed)
+        print(f"corpus: {args.docs} docs, {corpus.stat().st_size / 2**20:.1f} MiB")
+
+        for budget in args.budgets:
+            result = subprocess.run(
+                [sys.executable, __file__, "--child", str(corpus), str(budget)],
+                check=True,
+                capture_output=True,
+                text=True,
+            )
+            stats = json.loads(result.stdout)
+            print(
+                f"budget {budget:>6} MiB: {stats['seconds']:7.1f} s"
+                f"  peak rss {stats['peak_kib'] / 1024:7.1f} MiB"
+                f"  {'spilled' if stats['spilled'] else 'in memory'}"
+            )
+
+
+if __name__ == "__main__":
+    main()
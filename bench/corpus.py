@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""Synthetic movie corpora with Zipfian vocabularies.
+
+Titles and descriptions are made-up words; the word of frequency rank r is
+drawn with weight 1 / r^exponent, like words of real text. The corpus is
+written as JSON lines a batch of documents at a time, so 10M documents
+take no more memory than 10k.
+"""
+
+import argparse
+import json
+import string
+from pathlib import Path
+
+import numpy as np
+
+BATCH_DOCS = 10_000
+
+
+def vocabulary(size: int, seed: int) -> list[str]:
+    # words ordered by frequency rank; the same for the same size and seed
+    rng = np.random.default_rng(seed)
+    letters = np.array(list(string.ascii_lowercase))
+    lengths = rng.integers(4, 10, size=size)
+    return ["".join(rng.choice(letters, size=length)) for length in lengths]
+
+
+def zipf_weights(size: int, exponent: float) -> np.ndarray:
+    weights = 1 / np.arange(1, size + 1) ** exponent
+    return weights / weights.sum()
+
+
+def write_corpus(
+    path: Path,
+    docs: int,
+    vocab: int = 50_000,
+    doc_length: int = 60,
+    seed: int = 42,
+    exponent: float = 1.0,
+) -> None:
+    # descriptions of doc_length / 2 to 3 * doc_length / 2 words, titles of
+    # 1 to 4 words, doc ids 1..docs
+    words = np.array(vocabulary(vocab, seed), dtype=object)
+    weights = zipf_weights(vocab, exponent)
+    rng = np.random.default_rng(seed + 1)
+    with open(path, "w") as f:
+        for start in range(0, docs, BATCH_DOCS):
+            count = min(BATCH_DOCS, docs - start)
+            lengths = rng.integers(doc_length // 2, doc_length * 3 // 2 + 1, count)
+            title_lengths = rng.integers(1, 5, count)
+            tokens = words[rng.choice(vocab, size=lengths.sum(), p=weights)]
+            titles = words[rng.choice(vocab, size=title_lengths.sum(), p=weights)]
+            ends, title_ends = np.cumsum(lengths), np.cumsum(title_lengths)
+
+            lines = []
+            for i in range(count):
+                movie = {
+                    "id": start + i + 1,
+                    "title": " ".join(
+                        titles[title_ends[i] - title_lengths[i] : title_ends[i]]
+                    ).title(),
+                    "description": " ".join(tokens[ends[i] - lengths[i] : ends[i]]),
+                }
+                lines.append(json.dumps(movie))
+            f.write("\n".join(lines) + "\n")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("output", type=Path, help="JSON lines file to write")
+    parser.add_argument("--docs", type=int, default=10_000)
+    parser.add_argument("--vocab", type=int, default=50_000)
+    parser.add_argument("--doc-length", type=int, default=60, help="Mean words")
+    parser.add_argument("--exponent", type=float, default=1.0, help="Zipf exponent")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    write_corpus(
+        args.output, args.docs, args.vocab, args.doc_length, args.seed, args.exponent
+    )
+    size = args.output.stat().st_size / 2**20
+    print(f"{args.docs} docs, {size:.1f} MiB written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
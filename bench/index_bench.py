@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+"""Build, save, load and query performance of the keyword index.
+
+For every corpus size a synthetic corpus is generated (see corpus.py) and
+indexed into a temporary cache directory. The build (with save) and the
+queries (with load) run in fresh processes, so the peak RSS of each is its
+own. Query latencies (BM25 with either engine, boolean OR and AND queries in
+full, and the first --limit boolean matches) are measured for three query
+sets: short (1-2 words), long (8-12 words) and high-df (2-3 of the most
+frequent words), as is the time to read the titles or whole documents of
+each query's top hits. With --positions the index also stores token
+positions, and the query sets are also searched as phrases and with the
+proximity boost. The sparse BM25 engine also scores every query set as one
+batch, and its hits are compared with those of MaxScore.
+
+The results are JSON, tagged with the git commit, so runs of two commits
+can be compared.
+"""
+
+import argparse
+import json
+import platform
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from itertools import islice
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "cli"))
+
+from corpus import vocabulary, write_corpus, zipf_weights
+
+HIGH_DF_WORDS = 20  # high-df queries draw from this many most frequent words
+HYDRATE_FIELDS = {
+    "hydrate_titles": ("title",),
+    "hydrate_documents": ("id", "title", "description"),
+}
+
+
+def use_cache_dir(cache_dir: Path, corpus: Path | None = None) -> None:
+    # point the index at a temporary cache (and corpus) instead of the real one
+    from lib import inverted_index, tokenize
+    from lib.utils import iter_movies
+
+    inverted_index.CACHE_DIR = cache_dir
+    inverted_index.CACHE_STEMS_FILE = tokenize.CACHE_STEMS_FILE = (
+        cache_dir / "stems.bin"
+    )
+    inverted_index.CACHE_BUILD_FILE = cache_dir / "build.seg"
+    inverted_index.CACHE_MANIFEST_FILE = cache_dir / "segments.json"
+    inverted_index.CACHE_SEGMENT_FILE = cache_dir / "index.seg"
+    if corpus is not None:
+        inverted_index.iter_movies = lambda: iter_movies(corpus)
+
+
+def peak_rss_mib() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def query_sets(args: argparse.Namespace) -> dict[str, list[str]]:
+    words = vocabulary(args.vocab, args.seed)
+    weights = zipf_weights(args.vocab, args.exponent)
+    rng = random.Random(args.seed)
+
+    def queries(low: int, high: int, pool: list[str], weights) -> list[str]:
+        return [
+            " ".join(rng.choices(pool, weights=weights, k=rng.randint(low, high)))
+            for _ in range(args.queries)
+        ]
+
+    return {
+        "short": queries(1, 2, words, weights),
+        "long": queries(8, 12, words, weights),
+        "high_df": queries(2, 3, words[:HIGH_DF_WORDS], None),
+    }
+
+
+def percentiles(seconds: list[float]) -> dict:
+    ms = statistics.quantiles([s * 1000 for s in seconds], n=100)
+    return {"p50_ms": ms[49], "p95_ms": ms[94], "p99_ms": ms[98]}
+
+
+def child_build(args: argparse.Namespace) -> dict:
+    from lib.inverted_index import InvertedIndex
+
+    use_cache_dir(args.cache, args.corpus)
+    index = InvertedIndex()
+    start = time.perf_counter()
+    index.build(args.workers, positions=args.positions)
+    build_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    index.save()
+    save_seconds = time.perf_counter() - start
+
+    disk = sum(path.stat().st_size for path in args.cache.rglob("*") if path.is_file())
+    return {
+        "build_s": build_seconds,
+        "save_s": save_seconds,
+        "disk_mib": disk / 2**20,
+        "build_peak_rss_mib": peak_rss_mib(),
+    }
+
+
+def child_query(args: argparse.Namespace) -> dict:
+    from config import BM25_B, BM25_K1, PROXIMITY_WEIGHT
+    from lib.inverted_index import InvertedIndex
+    from lib.tokenize import get_tokenizer, tokenize_str
+
+    use_cache_dir(args.cache)
+    get_tokenizer()  # stopwords and stem table are not part of the load
+    index = InvertedIndex()
+    start = time.perf_counter()
+    index.load()
+    result = {"load_s": time.perf_counter() - start}
+
+    searches = {
+        "bm25_search": lambda query: index.bm25_search(
+            query, args.limit, BM25_K1, BM25_B
+        ),
+        "bm25_sparse": lambda query: index.bm25_search(
+            query, args.limit, BM25_K1, BM25_B, engine="sparse"
+        ),
+        "get_documents": index.get_documents,
+        "boolean_and": lambda query: index.get_documents(" AND ".join(query.split())),
+        "boolean_first": lambda query: list(
+            islice(index.iter_documents(query), args.limit)
+        ),
+    }
+    if args.positions:
+        searches["bm25_phrase"] = lambda query: index.bm25_search(
+            f'"{query}"', args.limit, BM25_K1, BM25_B
+        )
+        searches["bm25_proximity"] = lambda query: index.bm25_search(
+            query, args.limit, BM25_K1, BM25_B, PROXIMITY_WEIGHT
+        )
+    index.bm25_search_tokens([], 1, BM25_K1, BM25_B, "sparse")  # imports numpy
+    for kind, queries in query_sets(args).items():
+        for name, search in searches.items():
+            latencies = []
+            for query in queries:
+                start = time.perf_counter()
+                search(query)
+                latencies.append(time.perf_counter() - start)
+            result[f"{name}_{kind}"] = percentiles(latencies)
+
+        # the sparse engine with the whole query set as one batch, and
+        # whether it found exactly the hits of MaxScore
+        tokens = [tokenize_str(query) for query in queries]
+        start = time.perf_counter()
+        batched = index.bm25_search_tokens_many(
+            tokens, args.limit, BM25_K1, BM25_B, "sparse"
+        )
+        result[f"bm25_sparse_batch_ms_per_query_{kind}"] = (
+            (time.perf_counter() - start) * 1000 / len(queries)
+        )
+        result[f"bm25_sparse_mismatches_{kind}"] = sum(
+            list(found.items())
+            != list(
+                index.bm25_search_tokens(query, args.limit, BM25_K1, BM25_B).items()
+            )
+            for query, found in zip(tokens, batched)
+        )
+
+        # top-k hydration: titles only, and whole stored documents
+        hits = [
+            list(index.bm25_search(query, args.limit, BM25_K1, BM25_B))
+            for query in queries
+        ]
+        for name, fields in HYDRATE_FIELDS.items():
+            latencies = []
+            for doc_ids in hits:
+                start = time.perf_counter()
+                index.hydrate(doc_ids, fields)
+                latencies.append(time.perf_counter() - start)
+            result[f"{name}_{kind}"] = percentiles(latencies)
+
+    result["query_peak_rss_mib"] = peak_rss_mib()
+    return result
+
+
+def run_child(mode: str, args: argparse.Namespace, cache: Path, corpus: Path) -> dict:
+    command = [
+        sys.executable,
+        __file__,
+        "--child",
+        mode,
+        "--cache",
+        str(cache),
+        "--corpus",
+        str(corpus),
+        *("--vocab", str(args.vocab), "--exponent", str(args.exponent)),
+        *("--seed", str(args.seed), "--queries", str(args.queries)),
+        *("--limit", str(args.limit), "--workers", str(args.workers)),
+        *(["--positions"] if args.positions else []),
+    ]
+    output = subprocess.run(command, check=True, capture_output=True, text=True)
+    return json.loads(output.stdout)
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=Path(__file__).parent,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--docs", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--vocab", type=int, default=50_000)
+    parser.add_argument("--doc-length", type=int, default=60)
+    parser.add_argument("--exponent", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--queries", type=int, default=200, help="Per query set")
+    parser.add_argument("--limit", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=1, help="Build workers")
+    parser.add_argument(
+        "--positions",
+        action="store_true",
+        help="Build with token positions, and time phrase and proximity queries",
+    )
+    parser.add_argument("--output", type=Path, help="Also write the JSON here")
+    parser.add_argument("--json", action="store_true", help="Print JSON only")
+    parser.add_argument("--child", choices=["build", "query"], help=argparse.SUPPRESS)
+    parser.add_argument("--cache", type=Path, help=argparse.SUPPRESS)
+    parser.add_argument("--corpus", type=Path, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run = child_build if args.child == "build" else child_query
+        print(json.dumps(run(args)))
+        return
+
+    results = []
+    for docs in args.docs:
+        with tempfile.TemporaryDirectory() as tmp:
+            corpus, cache = Path(tmp) / "movies.jsonl", Path(tmp) / "cache"
+            write_corpus(
+                corpus, docs, args.vocab, args.doc_length, args.seed, args.exponent
+            )
+            result = {"docs": docs, "corpus_mib": corpus.stat().st_size / 2**20}
+            result.update(run_child("build", args, cache, corpus))
+            result.update(run_child("query", args, cache, corpus))
+            results.append(result)
+
+        if not args.json:
+            print(
+                f"{docs} docs: build {result['build_s']:.1f} s, save"
+                f" {result['save_s']:.2f} s, load {result['load_s']:.3f} s,"
+                f" {result['disk_mib']:.1f} MiB on disk, peak rss build"
+                f" {result['build_peak_rss_mib']:.0f} MiB, query"
+                f" {result['query_peak_rss_mib']:.0f} MiB"
+            )
+            for key, latency in result.items():
+                if isinstance(latency, dict):
+                    print(
+                        f"  {key:<26} p50 {latency['p50_ms']:7.2f} ms"
+                        f"  p95 {latency['p95_ms']:7.2f} ms"
+                        f"  p99 {latency['p99_ms']:7.2f} ms"
+                    )
+                elif key.startswith("bm25_sparse_batch"):
+                    print(f"  {key:<38} {latency:7.3f} ms")
+                elif key.startswith("bm25_sparse_mismatches"):
+                    print(f"  {key:<38} {latency}")
+
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "settings": {
+            key: getattr(args, key)
+            for key in (
+                "vocab",
+                "doc_length",
+                "exponent",
+                "seed",
+                "queries",
+                "limit",
+                "positions",
+            )
+        },
+        "results": results,
+    }
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2) + "\n")
+    if args.json:
+        print(json.dumps(report))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""Memory of the legacy dict/set/Counter index vs. columnar Postings."""
+
+import argparse
+import gc
+import random
+import sys
+import tracemalloc
+from collections import Counter, defaultdict
+from itertools import accumulate
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "cli"))
+
+from lib.postings import PostingsBuilder
+
+
+def synthetic_docs(docs: int, vocab: int, doc_length: int, seed: int):
+    # zipfian token stream; tokens are already "stemmed"
+    rng = random.Random(seed)
+    words = [f"w{i}" for i in range(vocab)]
+    cum_weights = list(accumulate(1 / (rank + 1) for rank in range(vocab)))
+    for doc_id in range(1, docs + 1):
+        yield doc_id, rng.choices(words, cum_weights=cum_weights, k=doc_length)
+
+
+def measure(build) -> tuple[int, object]:
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size, result
+
+
+def build_legacy(docs):
+    index: dict[str, set[int]] = defaultdict(set)
+    term_frequencies: dict[int, Counter[str]] = defaultdict(Counter)
+    doc_length: dict[int, int] = {}
+    for doc_id, tokens in docs:
+        doc_length[doc_id] = len(tokens)
+        for token in tokens:
+            term_frequencies[doc_id][token] += 1
+            index[token].add(doc_id)
+    return index, term_frequencies, doc_length
+
+
+def build_columnar(docs):
+    builder = PostingsBuilder()
+    for doc_id, tokens in docs:
+        builder.add_tokens(doc_id, tokens)
+    return builder.build()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--docs", type=int, default=1_000_000)
+    parser.add_argument("--vocab", type=int, default=50_000)
+    parser.add_argument("--doc-length", type=int, default=12)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    def docs():
+        return synthetic_docs(args.docs, args.vocab, args.doc_length, args.seed)
+
+    legacy_size, legacy = measure(lambda: build_legacy(docs()))
+    postings_count = sum(len(ids) for ids in legacy[0].values())
+    del legacy
+
+    columnar_size, postings = measure(lambda: build_columnar(docs()))
+    assert len(postings.tfs) == postings_count
+
+    print(f"documents:   {args.docs}")
+    print(f"postings:    {postings_count}")
+    print(
+        f"legacy:      {legacy_size / 2**20:9.1f} MiB"
+        f"  ({legacy_size / postings_count:.0f} B/posting)"
+    )
+    print(
+        f"columnar:    {columnar_size / 2**20:9.1f} MiB"
+        f"  ({columnar_size / postings_count:.0f} B/posting)"
+    )
+    print(f"reduction:   x{legacy_size / columnar_size:.1f}")
+
+
+if __name__ == "__main__":
+    main()
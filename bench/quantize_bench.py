@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""Memory, latency and recall@k of int8 and PQ embeddings vs. float32.
+
+The corpus is drawn around random topic centers (see ann_bench.py) and
+memory-mapped like the real matrix; the quantized codes are held in memory.
+Every quantization is measured without rescoring and with exact rescoring
+of a shortlist read from the float matrix.
+"""
+
+import argparse
+import json
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "cli"))
+
+from lib.embeddings import normalize, top_k_rows
+from lib.quantize import QuantizedEmbeddings, evaluate
+
+
+def clustered(rng: np.random.Generator, centers: np.ndarray, n: int, spread: float):
+    topics = rng.integers(len(centers), size=n)
+    noise = rng.standard_normal((n, centers.shape[1])) * spread
+    return normalize(centers[topics] + noise)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--docs", type=int, default=200_000)
+    parser.add_argument("--dimension", type=int, default=384)
+    parser.add_argument("--topics", type=int, default=200)
+    parser.add_argument("--spread", type=float, default=0.1)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--limit", type=int, default=10)
+    parser.add_argument("--subspaces", type=int, default=48)
+    parser.add_argument("--rescore", type=int, nargs="+", default=[0, 50, 200])
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", action="store_true", help="Print JSON only")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    centers = rng.standard_normal((args.topics, args.dimension)) / np.sqrt(
+        args.dimension
+    )
+    queries = clustered(rng, centers, args.queries, args.spread)
+
+    results = []
+    builds = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "embeddings.npy"
+        matrix = np.lib.format.open_memmap(
+            path, mode="w+", dtype=np.float32, shape=(args.docs, args.dimension)
+        )
+        for start in range(0, args.docs, 65_536):
+            rows = min(65_536, args.docs - start)
+            matrix[start : start + rows] = clustered(rng, centers, rows, args.spread)
+        matrix.flush()
+        del matrix
+        vectors = np.load(path, mmap_mode="r")
+
+        # warm the page cache, so every run reads from memory
+        top_k_rows(vectors, queries[:1], args.limit)
+
+        for kind in ("int8", "pq"):
+            start = time.perf_counter()
+            quantized = QuantizedEmbeddings.build(
+                vectors, None, kind, subspaces=args.subspaces
+            )
+            builds[kind] = time.perf_counter() - start
+
+            points = evaluate(quantized, vectors, queries, args.limit, args.rescore)
+            results.extend(points if not results else points[1:])
+
+    if args.json:
+        print(json.dumps({"build_seconds": builds, "results": results}))
+        return
+
+    print(f"corpus: {args.docs} x {args.dimension}, {args.topics} topics")
+    for kind, seconds in builds.items():
+        print(f"{kind} built in {seconds:.1f} s")
+    print(
+        f"{'kind':>8} {'rescore':>8} {'MiB':>8} {'recall@' + str(args.limit):>10}"
+        f" {'p50 ms':>8} {'p95 ms':>8}"
+    )
+    for result in results:
+        rescore = "-" if result["rescore"] is None else result["rescore"]
+        print(
+            f"{result['kind']:>8} {rescore:>8} {result['bytes'] / 2**20:>8.1f}"
+            f" {result['recall']:>10.3f} {result['p50_ms']:>8.2f}"
+            f" {result['p95_ms']:>8.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""Throughput of semantic top-k search, one query at a time vs. batched.
+
+Random unit vectors stand in for the corpus and query embeddings; the
+corpus matrix is saved to a temp .npy and memory-mapped like the real one.
+"""
+
+import argparse
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "cli"))
+
+from lib.embeddings import normalize, top_k_rows
+
+
+def full_sort_top_k(vectors: np.ndarray, query: np.ndarray, limit: int):
+    # baseline: one matrix-vector product and a full argsort
+    scores = np.asarray(vectors) @ query
+    rows = np.argsort(-scores, kind="stable")[:limit]
+    return rows, scores[rows]
+
+
+def queries_per_second(run, queries: np.ndarray, batch: int) -> float:
+    start = time.perf_counter()
+    for i in range(0, len(queries), batch):
+        run(queries[i : i + batch])
+    return len(queries) / (time.perf_counter() - start)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--docs", type=int, default=200_000)
+    parser.add_argument("--dimension", type=int, default=384)
+    parser.add_argument("--queries", type=int, default=256)
+    parser.add_argument("--limit", type=int, default=10)
+    parser.add_argument("--batches", type=int, nargs="+", default=[1, 8, 32, 128])
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    queries = normalize(rng.standard_normal((args.queries, args.dimension)))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "embeddings.npy"
+        matrix = np.lib.format.open_memmap(
+            path, mode="w+", dtype=np.float32, shape=(args.docs, args.dimension)
+        )
+        for start in range(0, args.docs, 65_536):
+            rows = min(65_536, args.docs - start)
+            matrix[start : start + rows] = normalize(
+                rng.standard_normal((rows, args.dimension))
+            )
+        matrix.flush()
+        del matrix
+
+        vectors = np.load(path, mmap_mode="r")
+        print(f"corpus: {args.docs} x {args.dimension} float32")
+
+        # warm the page cache, so every run reads from memory
+        top_k_rows(vectors, queries[:1], args.limit)
+
+        baseline = queries_per_second(
+            lambda batch: full_sort_top_k(vectors, batch[0], args.limit), queries, 1
+        )
+        print(f"full argsort,  batch   1: {baseline:8.1f} queries/s")
+
+        for batch in args.batches:
+            qps = queries_per_second(
+                lambda batch: top_k_rows(vectors, batch, args.limit), queries, batch
+            )
+            print(f"argpartition,  batch {batch:>3}: {qps:8.1f} queries/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""Cold-start time of the CLIs, and the imports it goes to.
+
+Every command runs in fresh interpreters: the median wall time of --runs
+runs, and from one more run under `-X importtime` the cumulative import
+time of the slowest top-level imports. Heavy modules (nltk, numpy,
+sentence_transformers) are listed when they get imported at all.
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+CLI_DIR = Path(__file__).parent.parent / "cli"
+HEAVY_MODULES = ("nltk", "numpy", "sentence_transformers", "torch")
+
+COMMANDS = [
+    ["keyword_search_cli.py", "--help"],
+    ["keyword_search_cli.py", "search", "love story"],
+    ["keyword_search_cli.py", "bm25search", "love story"],
+    ["semantic_search_cli.py", "--help"],
+]
+
+
+def wall_ms(command: list[str], runs: int) -> float:
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, *command],
+            cwd=CLI_DIR,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            check=True,
+        )
+        times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1000
+
+
+def import_times(command: list[str]) -> dict[str, float]:
+    # cumulative ms per module, from the `-X importtime` report on stderr
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", *command],
+        cwd=CLI_DIR,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        # top-level imports are indented by a single space
+        if not name.startswith("  "):
+            times[name.strip()] = int(cumulative) / 1000
+        elif name.strip() in HEAVY_MODULES:
+            times.setdefault(name.strip(), int(cumulative) / 1000)
+    return times
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--top", type=int, default=5, help="Slowest imports shown")
+    parser.add_argument("--json", action="store_true", help="Print JSON only")
+    args = parser.parse_args()
+
+    results = []
+    for command in COMMANDS:
+        imports = import_times(command)
+        slowest = sorted(imports.items(), key=lambda item: -item[1])[: args.top]
+        results.append(
+            {
+                "command": " ".join(command),
+                "wall_ms": wall_ms(command, args.runs),
+                "slowest_imports_ms": dict(slowest),
+                "heavy_imports": [name for name in HEAVY_MODULES if name in imports],
+            }
+        )
+
+    if args.json:
+        print(json.dumps(results))
+        return
+
+    for result in results:
+        heavy = ", ".join(result["heavy_imports"]) or "none"
+        print(f"{result['command']}: {result['wall_ms']:.0f} ms (heavy: {heavy})")
+        for name, ms in result["slowest_imports_ms"].items():
+            print(f"  {name:<32} {ms:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""Microbenchmark: legacy per-call tokenizer pipeline vs. the memoized Tokenizer."""
+
+import argparse
+import string
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "cli"))
+
+from lib.tokenize import Tokenizer
+from lib.utils import load_movies, load_stopwords
+from nltk.stem import PorterStemmer
+
+
+def legacy_tokenize_str(query: str) -> list[str]:
+    # the pipeline as it was before Tokenizer existed
+    punctuation_table = str.maketrans("", "", string.punctuation)
+    clean_query = query.lower().translate(punctuation_table)
+    stopwords = load_stopwords()
+    words = [word for word in clean_query.split() if word not in stopwords]
+    stemmer = PorterStemmer()
+    return [stemmer.stem(word) for word in words]
+
+
+def best_of(repeat: int, func, *args) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--docs", type=int, default=2000, help="Documents to tokenize")
+    parser.add_argument("--repeat", type=int, default=3, help="Best-of repetitions")
+    args = parser.parse_args()
+
+    texts = [f"{m['title']} {m['description']}" for m in load_movies()[: args.docs]]
+    tokenizer = Tokenizer()
+
+    legacy = [legacy_tokenize_str(text) for text in texts]
+    if tokenizer.tokenize_many(texts) != legacy:
+        raise SystemExit("Tokenizer output differs from the legacy pipeline")
+
+    legacy_time = best_of(args.repeat, lambda: [legacy_tokenize_str(t) for t in texts])
+    cold_time = best_of(1, Tokenizer().tokenize_many, texts)
+    warm_time = best_of(args.repeat, tokenizer.tokenize_many, texts)
+
+    print(f"documents:          {len(texts)}")
+    print(f"legacy pipeline:    {legacy_time * 1000:9.1f} ms")
+    print(
+        f"Tokenizer (cold):   {cold_time * 1000:9.1f} ms  x{legacy_time / cold_time:.1f}"
+    )
+    print(
+        f"Tokenizer (warm):   {warm_time * 1000:9.1f} ms  x{legacy_time / warm_time:.1f}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -9,6 +9,31 @@ STOPWORDS_TXT = DATA_DIR / "stopwords.txt"
 
 # Cache Files
 CACHE_DIR = PROJECT_ROOT / "cache"
+CACHE_MANIFEST_FILE = CACHE_DIR / "segments.json"
+CACHE_SEGMENT_FILE = CACHE_DIR / "index.seg"  # single segment, before manifests
+CACHE_BUILD_FILE = CACHE_DIR / "build.seg"  # externally merged build, until saved
+CACHE_STEMS_FILE = CACHE_DIR / "stems.bin"  # word -> stem of the indexed vocabulary
+
+CACHE_EMBEDDINGS_MANIFEST_FILE = CACHE_DIR / "embeddings.json"
+CACHE_EMBEDDINGS_FILE = CACHE_DIR / "embeddings.npy"  # float32 [docs, dimension]
+CACHE_EMBEDDING_IDS_FILE = CACHE_DIR / "embedding_ids.npy"  # doc id per row
+CACHE_EMBEDDING_HASHES_FILE = CACHE_DIR / "embedding_hashes.npy"  # text hash per row
+
+CACHE_QUERY_EMBEDDINGS_FILE = CACHE_DIR / "query_embeddings.sqlite"
+CACHE_RESULTS_FILE = CACHE_DIR / "search_results.sqlite"  # serve --persist-results
+
+CACHE_SERVE_FILE = CACHE_DIR / "serve.json"  # address of the running daemon
+
+CACHE_IVF_MANIFEST_FILE = CACHE_DIR / "ivf.json"
+CACHE_IVF_CENTROIDS_FILE = CACHE_DIR / "ivf_centroids.npy"  # float32 [lists, dim]
+CACHE_IVF_OFFSETS_FILE = CACHE_DIR / "ivf_offsets.npy"  # list boundaries
+CACHE_IVF_ROWS_FILE = CACHE_DIR / "ivf_rows.npy"  # embedding rows, grouped by list
+
+CACHE_QUANTIZED_MANIFEST_FILE = CACHE_DIR / "quantized.json"
+CACHE_QUANTIZED_CODES_FILE = CACHE_DIR / "quantized_codes.npy"  # int8/uint8 codes
+CACHE_QUANTIZED_CODEBOOK_FILE = CACHE_DIR / "quantized_codebook.npy"
+
+# Legacy Pickle Cache Files (read by `convert`)
 CACHE_INDEX_FILE = CACHE_DIR / "index.pkl"
 CACHE_DOCMAP_FILE = CACHE_DIR / "docmap.pkl"
 CACHE_TF_FILE = CACHE_DIR / "term_frequencies.pkl"
@@ -18,6 +43,67 @@ CACHE_DOC_LENGTH_FILE = CACHE_DIR / "doc_lengths.pkl"
 MAX_SEARCH_RESULTS = 5
 BM25_K1 = 1.5
 BM25_B = 0.75
+BM25_IMPACT_PARAMS_CACHED = 4  # other (k1, b) pairs whose impacts are kept
+PROXIMITY_WEIGHT = 1.0  # bm25search --proximity without a weight
+PROXIMITY_DEPTH = 100  # BM25 hits reranked by the proximity boost
+RESULT_CACHE_SIZE = 10_000  # search results kept per index generation (LRU)
+BM25_ENGINES = ("maxscore", "sparse")  # bm25search --engine
+BM25_ENGINE = "maxscore"  # sparse: numpy sparse matrix products, same results
+SPARSE_BATCH_POSTINGS = 1_000_000  # postings summed per batched sparse product
+
+# Search Daemon Settings
+SERVE_HOST = "127.0.0.1"
+SERVE_PORT = 8765  # 0 picks a free port; clients find it in CACHE_SERVE_FILE
+SERVE_TIMEOUT = 30.0  # seconds a CLI call waits for the daemon
+SERVE_LATENCY_WINDOW = 1_000  # requests per endpoint in the latency stats
+BATCH_MAX_SIZE = 32  # queries encoded together by the daemon's batcher
+BATCH_MAX_WAIT_MS = 5.0  # a batch is encoded this long after its first query
+BATCH_MAX_QUEUE = 1_024  # queries waiting for the model; more are rejected
+
+# Bulk Search Settings (bm25search --queries-file)
+BULK_CHUNK_QUERIES = 1_000  # queries tokenized and searched per task
+BULK_PENDING_CHUNKS_PER_WORKER = 4  # chunks queued ahead with --workers
+BULK_RESULT_CACHE_SIZE = 100_000  # distinct queries whose results are reused
+
+# Index Build Settings
+BUILD_BATCH_DOCS = 1_000  # documents inverted per batch (one task per batch)
+BUILD_PENDING_BATCHES_PER_WORKER = 4  # batches queued ahead with --workers
+# bytes of batches held in memory before a run is spilled; writing a run takes
+# about as much again, so the build peaks at roughly twice the budget
+BUILD_MEMORY_BUDGET = 512 * 1024**2
+LOADER_CHUNK_SIZE = 1024**2  # characters read at a time when streaming the corpus
+
+# Segment Merge Settings
+MERGE_FACTOR = 10  # segments of one size tier that get merged together
+MERGE_MIN_SEGMENT_DOCS = 1_000  # smaller segments all count as the lowest tier
+MERGE_MAX_DELETED_RATIO = 0.3  # rewrite segments with more tombstones than this
+SEGMENT_LOOKUP_CACHE_SIZE = 10_000  # merged postings lists kept per segment set
+DOC_BLOCK_CACHE_SIZE = 256  # decompressed document blocks kept per segment
+
+# Tokenizer Settings
+STEM_CACHE_SIZE = 100_000
+STEM_TABLE_MAX_WORDS = 1_000_000  # distinct words whose stems 'build' persists
 
 # Semantic Search Settings
 TRANSFORMER_MODEL = "all-MiniLM-L6-v2"
+EMBEDDING_BATCH_SIZE = 64  # texts per encode call
+SEMANTIC_BLOCK_ROWS = 32_768  # embedding rows scored per matrix product
+QUERY_CACHE_BYTES = 64 * 1024**2  # query embeddings kept in memory (LRU)
+
+# Approximate Nearest Neighbor (IVF) Settings
+ANN_LISTS = None  # k-means centroids (inverted lists); None = 4 * sqrt(rows)
+ANN_NPROBE = 8  # lists scanned per query
+ANN_KMEANS_ITERATIONS = 10  # also for the PQ codebooks
+ANN_TRAIN_ROWS = 100_000  # rows sampled to train the centroids
+
+# Quantized Embedding Settings
+PQ_SUBSPACES = 48  # product quantization: bytes per row, divides the dimension
+PQ_TRAIN_ROWS = 25_000  # rows sampled to train each subspace's 256 centroids
+QUANTIZED_RESCORE = 100  # shortlist rescored with the float embeddings
+# int8 rows scored per block; small blocks keep the conversion to float in cache
+QUANTIZED_BLOCK_ROWS = 1_024
+
+# Hybrid Search Settings
+HYBRID_CANDIDATES = 100  # documents each retriever contributes to the fusion
+HYBRID_ALPHA = 0.5  # weight of BM25 against semantic scores in weighted fusion
+RRF_K = 60  # reciprocal rank fusion: 1 / (RRF_K + rank)
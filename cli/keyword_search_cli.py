@@ -1,16 +1,38 @@
 #!/usr/bin/env python3
 import argparse
+import sys
 import textwrap
-
-from config import BM25_B, BM25_K1, MAX_SEARCH_RESULTS
+from pathlib import Path
+
+from config import (
+    BATCH_MAX_QUEUE,
+    BATCH_MAX_SIZE,
+    BATCH_MAX_WAIT_MS,
+    BM25_B,
+    BM25_ENGINE,
+    BM25_ENGINES,
+    BM25_K1,
+    BUILD_MEMORY_BUDGET,
+    MAX_SEARCH_RESULTS,
+    PROXIMITY_WEIGHT,
+    RESULT_CACHE_SIZE,
+    SERVE_HOST,
+    SERVE_PORT,
+)
+from lib import trace
 from lib.search import (
+    add_documents,
     bm25_search,
+    bm25_search_file,
     build_index,
     calculate_bm25_idf,
     calculate_bm25_tf,
     calculate_idf,
     calculate_tf,
     calculate_tf_idf,
+    convert_index,
+    delete_documents,
+    merge_segments,
     search,
 )
 
@@ -21,22 +43,104 @@ class _HelpFmt(
     pass
 
 
+def _positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
+
+
 def cmd_search(args: argparse.Namespace) -> None:
     print(f"Searching for: {args.query}")
     search(args.query)
 
 
 def cmd_bm25_search(args: argparse.Namespace) -> None:
+    limit = args.limit
+    if args.queries_file:
+        if args.query is not None:
+            if limit is not None:
+                args.error("give either a query or --queries-file")
+            # `--queries-file FILE 5`: the only positional is the limit
+            try:
+                limit = _positive_int(args.query)
+            except argparse.ArgumentTypeError as err:
+                args.error(f"argument limit: {err}")
+            except ValueError:
+                args.error(f"argument limit: invalid int value: {args.query!r}")
+        print(f"Searching queries of {args.queries_file} ...", file=sys.stderr)
+        bm25_search_file(
+            args.queries_file,
+            args.output or "-",
+            limit or MAX_SEARCH_RESULTS,
+            BM25_K1,
+            BM25_B,
+            args.workers,
+            args.engine,
+        )
+        return
+
+    if args.query is None:
+        args.error("a query or --queries-file is required")
+    if args.output is not None:
+        args.error("--output needs --queries-file")
+
     print(f"Searching for: {args.query}")
-    bm25_search(args.query, args.limit, BM25_K1, BM25_B)
+    bm25_search(
+        args.query,
+        limit or MAX_SEARCH_RESULTS,
+        BM25_K1,
+        BM25_B,
+        args.proximity,
+        args.engine,
+    )
 
 
-def cmd_build(_: argparse.Namespace) -> None:
+def cmd_build(args: argparse.Namespace) -> None:
     print("Building search index ...")
-    build_index()
+    build_index(args.workers, args.memory_budget * 1024**2, args.positions)
     print("Search index successfully built!")
 
 
+def cmd_convert(_: argparse.Namespace) -> None:
+    print("Converting pickle cache to index segment ...")
+    convert_index()
+    print("Search index successfully converted!")
+
+
+def cmd_add(args: argparse.Namespace) -> None:
+    print(f"Adding documents from {args.file} ...")
+    add_documents(args.file, args.update)
+
+
+def cmd_delete(args: argparse.Namespace) -> None:
+    print(f"Deleting documents {', '.join(map(str, args.doc_ids))} ...")
+    delete_documents(args.doc_ids)
+
+
+def cmd_merge(args: argparse.Namespace) -> None:
+    print("Merging index segments ...")
+    merge_segments(args.full)
+    print("Index segments successfully merged!")
+
+
+def cmd_serve(args: argparse.Namespace) -> None:
+    # numpy and the http server are only needed here
+    from lib.server import serve
+
+    print("Loading search index and model ...")
+    serve(
+        args.host,
+        args.port,
+        not args.no_semantic,
+        max_batch_size=args.batch_size,
+        max_wait_ms=args.batch_wait_ms,
+        max_queue=args.batch_queue,
+        result_cache_size=args.result_cache,
+        persist_results=args.persist_results,
+    )
+
+
 def cmd_tf(args: argparse.Namespace) -> None:
     print(f"Calculating occurrences of {args.term} in document {args.doc_id} ...")
     calculate_tf(args.doc_id, args.term)
@@ -82,6 +186,18 @@ def build_parser() -> argparse.ArgumentParser:
     parser.add_argument(
         "--version", action="version", version="Keyword Search CLI 1.0.0"
     )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Print the time spent in every traced stage and the counters"
+        " (searches run locally, not in the search daemon)",
+    )
+    parser.add_argument(
+        "--metrics",
+        type=Path,
+        help="Write the traced stages and counters to this file: JSON for .json,"
+        " Prometheus text otherwise",
+    )
 
     subparsers = parser.add_subparsers(
         title="commands", dest="command", metavar="<command>", help="Available commands"
@@ -94,8 +210,10 @@ def build_parser() -> argparse.ArgumentParser:
     search_parser = subparsers.add_parser(
         "search",
         aliases=["s"],
-        help="Search the corpus using BM25 ranking",
-        description="Search the corpus using BM25 ranking",
+        help="Boolean search over titles and descriptions",
+        description="Boolean search over titles and descriptions. Words side by"
+        " side match any of them; combine them with AND, OR, NOT and parentheses,"
+        " quote phrases and restrict words to a field with title: or description:",
         formatter_class=_HelpFmt,
         epilog=textwrap.dedent(
             """\
@@ -103,13 +221,16 @@ def build_parser() -> argparse.ArgumentParser:
 
               keyword_search_cli.py search "matrix"
               keyword_search_cli.py s inception
+              keyword_search_cli.py search '"dark knight" batman'
+              keyword_search_cli.py search 'title:(dark OR knight) NOT batman'
+              keyword_search_cli.py search 'space AND (war OR invasion)'
             """
         ),
     )
     search_parser.add_argument(
         "query",
         type=str,
-        help="Free-text query to search for",
+        help="Boolean query to search for",
     )
     search_parser.set_defaults(func=cmd_search)
 
@@ -129,22 +250,63 @@ def build_parser() -> argparse.ArgumentParser:
 
                keyword_search_cli.py bm25search "love story"
                keyword_search_cli.py bms "action bear"
+               keyword_search_cli.py bms '"dark knight" gotham' --proximity
+               keyword_search_cli.py bms "space war" --engine sparse
+               keyword_search_cli.py bm25search --queries-file queries.txt \\
+                   --output results.jsonl --workers 4 --engine sparse
              """
         ),
     )
     bm25_search_parser.add_argument(
         "query",
         type=str,
+        nargs="?",
         help="Free-text query to search for",
     )
     bm25_search_parser.add_argument(
         "limit",
-        type=int,
+        type=_positive_int,
         nargs="?",
-        default=MAX_SEARCH_RESULTS,
-        help="Free-text query to search for",
+        help=f"Number of results, {MAX_SEARCH_RESULTS} if not given",
+    )
+    bm25_search_parser.add_argument(
+        "--proximity",
+        type=float,
+        nargs="?",
+        const=PROXIMITY_WEIGHT,
+        default=0.0,
+        help="Boost the top hits by how close together the query words occur,"
+        " weight / distance per adjacent pair in query order (default weight:"
+        f" {PROXIMITY_WEIGHT}; needs an index built with --positions)",
+    )
+    bm25_search_parser.add_argument(
+        "--engine",
+        choices=BM25_ENGINES,
+        default=BM25_ENGINE,
+        help="Scoring engine: MaxScore pruning, or numpy sparse matrix products"
+        " (batched with --queries-file); both give the same results",
+    )
+    bm25_search_parser.add_argument(
+        "--queries-file",
+        type=Path,
+        help="Search every query of this file (one per line, or JSON lines with"
+        ' a "query" and optional "id" for .jsonl) with the index loaded once',
+    )
+    bm25_search_parser.add_argument(
+        "--output",
+        type=str,
+        help="With --queries-file: JSON lines file the results are streamed to"
+        " (default, or -: stdout)",
+    )
+    bm25_search_parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="With --queries-file: worker processes sharing the loaded index",
+    )
+    bm25_search_parser.set_defaults(
+        func=cmd_bm25_search, error=bm25_search_parser.error
     )
-    bm25_search_parser.set_defaults(func=cmd_bm25_search)
 
     #########
     # Build
@@ -153,8 +315,164 @@ def build_parser() -> argparse.ArgumentParser:
     build_cmd = subparsers.add_parser(
         "build", aliases=["b"], help="Build the search index", formatter_class=_HelpFmt
     )
+    build_cmd.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Worker processes that tokenize and invert corpus shards in parallel",
+    )
+    build_cmd.add_argument(
+        "--memory-budget",
+        type=int,
+        default=BUILD_MEMORY_BUDGET // 1024**2,
+        help="MiB of postings and documents held in memory before a sorted run is"
+        " spilled to disk",
+    )
+    build_cmd.add_argument(
+        "--positions",
+        action="store_true",
+        help="Also index token positions, for phrase queries and --proximity"
+        " (a larger index and a slower build)",
+    )
     build_cmd.set_defaults(func=cmd_build)
 
+    ###########
+    # Convert
+    ########
+
+    convert_cmd = subparsers.add_parser(
+        "convert",
+        help="Convert a legacy pickle cache into the index segment format",
+        formatter_class=_HelpFmt,
+    )
+    convert_cmd.set_defaults(func=cmd_convert)
+
+    #######
+    # Add
+    ####
+
+    add_cmd = subparsers.add_parser(
+        "add",
+        help="Add documents to the index without rebuilding it",
+        formatter_class=_HelpFmt,
+        epilog=textwrap.dedent(
+            """\
+            Examples:
+
+              keyword_search_cli.py add new_movies.json
+              keyword_search_cli.py add changed_movies.json --update
+            """
+        ),
+    )
+    add_cmd.add_argument(
+        "file",
+        type=Path,
+        help='JSON file with a list of movies or {"movies": [...]}, or JSON Lines',
+    )
+    add_cmd.add_argument(
+        "--update",
+        action="store_true",
+        help="Replace documents whose id is already indexed",
+    )
+    add_cmd.set_defaults(func=cmd_add)
+
+    ##########
+    # Delete
+    #######
+
+    delete_cmd = subparsers.add_parser(
+        "delete",
+        help="Delete documents from the index",
+        formatter_class=_HelpFmt,
+        epilog=textwrap.dedent(
+            """\
+            Examples:
+
+              keyword_search_cli.py delete 42 43
+            """
+        ),
+    )
+    delete_cmd.add_argument("doc_ids", type=int, nargs="+", help="Document IDs")
+    delete_cmd.set_defaults(func=cmd_delete)
+
+    #########
+    # Merge
+    ######
+
+    merge_cmd = subparsers.add_parser(
+        "merge",
+        help="Compact index segments under the tiered merge policy",
+        formatter_class=_HelpFmt,
+    )
+    merge_cmd.add_argument(
+        "--full",
+        action="store_true",
+        help="Merge all segments into one, dropping every deleted document",
+    )
+    merge_cmd.set_defaults(func=cmd_merge)
+
+    #########
+    # Serve
+    ######
+
+    serve_cmd = subparsers.add_parser(
+        "serve",
+        help="Run a search daemon that keeps the index and model loaded",
+        description="Answer boolean, BM25 and semantic queries over a local"
+        " JSON HTTP API, from one process that loads the index and the"
+        " embedding model once. While it runs, the search commands of both"
+        " CLIs are answered by it. Per-endpoint latency: GET /stats.",
+        formatter_class=_HelpFmt,
+        epilog=textwrap.dedent(
+            """\
+            Examples:
+
+              keyword_search_cli.py serve
+              keyword_search_cli.py serve --port 0 --no-semantic
+              curl -d '{"query": "matrix"}' http://127.0.0.1:8765/bm25
+            """
+        ),
+    )
+    serve_cmd.add_argument("--host", default=SERVE_HOST, help="Address to bind")
+    serve_cmd.add_argument(
+        "--port", type=int, default=SERVE_PORT, help="Port (0: any free port)"
+    )
+    serve_cmd.add_argument(
+        "--no-semantic",
+        action="store_true",
+        help="Serve keyword search only, without loading the embedding model",
+    )
+    serve_cmd.add_argument(
+        "--batch-size",
+        type=int,
+        default=BATCH_MAX_SIZE,
+        help="Most queries encoded in one model call",
+    )
+    serve_cmd.add_argument(
+        "--batch-wait-ms",
+        type=float,
+        default=BATCH_MAX_WAIT_MS,
+        help="Longest a query waits for others to share its batch",
+    )
+    serve_cmd.add_argument(
+        "--batch-queue",
+        type=int,
+        default=BATCH_MAX_QUEUE,
+        help="Queries that may wait for the model before requests are refused",
+    )
+    serve_cmd.add_argument(
+        "--result-cache",
+        type=int,
+        default=RESULT_CACHE_SIZE,
+        help="Boolean and BM25 results kept in memory (0: no result cache)",
+    )
+    serve_cmd.add_argument(
+        "--persist-results",
+        action="store_true",
+        help="Keep cached results on disk too, for the next start on the same index",
+    )
+    serve_cmd.set_defaults(func=cmd_serve)
+
     ######################
     # TF (Term Frequency)
     ####################
@@ -283,7 +601,14 @@ def main() -> None:
     if not hasattr(args, "func"):
         parser.print_help()
         parser.exit(0)
+
+    if args.profile or args.metrics:
+        trace.enable()
     args.func(args)
+    if args.profile:
+        trace.print_report()
+    if args.metrics:
+        trace.write_metrics(args.metrics)
 
 
 if __name__ == "__main__":
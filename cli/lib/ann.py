@@ -0,0 +1,294 @@
+import json
+import math
+import os
+import time
+from collections.abc import Sequence
+
+import numpy as np
+from config import (
+    ANN_KMEANS_ITERATIONS,
+    ANN_LISTS,
+    ANN_NPROBE,
+    ANN_TRAIN_ROWS,
+    CACHE_DIR,
+    CACHE_IVF_CENTROIDS_FILE,
+    CACHE_IVF_MANIFEST_FILE,
+    CACHE_IVF_OFFSETS_FILE,
+    CACHE_IVF_ROWS_FILE,
+)
+from lib.embeddings import EMBEDDING_DTYPE, normalize, save_array, top_k_rows
+
+# IVF index files, derived from one build of the embedding store:
+#
+#   ivf.json            manifest: list count, row count, embeddings build id
+#   ivf_centroids.npy   float32 [lists, dimension], unit length
+#   ivf_offsets.npy     int64 [lists + 1], list i is rows[offsets[i]:offsets[i + 1]]
+#   ivf_rows.npy        int64 [rows], embedding rows grouped by list
+#
+# Rows are ascending within a list. The index only stores row numbers, so it
+# is stale as soon as the embeddings are rebuilt; loading checks the build id.
+
+IVF_VERSION = 1
+ASSIGN_BLOCK_ROWS = 8_192  # rows assigned to centroids per matrix product
+
+
+class IVFIndex:
+    """Inverted file index over the rows of the embedding matrix.
+
+    Spherical k-means splits the rows into lists around unit centroids. A
+    query only scores the rows of the `nprobe` lists whose centroids are
+    closest to it, so both recall and latency grow with `nprobe`.
+    """
+
+    def __init__(
+        self,
+        manifest: dict,
+        centroids: np.ndarray,
+        offsets: np.ndarray,
+        rows: np.ndarray,
+    ) -> None:
+        self.manifest = manifest
+        self.centroids = centroids
+        self.offsets = offsets
+        self.rows = rows
+
+    @property
+    def n_lists(self) -> int:
+        return len(self.centroids)
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    @classmethod
+    def build(
+        cls,
+        vectors: np.ndarray,
+        build_id: str | None,
+        n_lists: int | None = ANN_LISTS,
+        iterations: int = ANN_KMEANS_ITERATIONS,
+        train_rows: int = ANN_TRAIN_ROWS,
+        seed: int = 0,
+    ) -> "IVFIndex":
+        if not len(vectors):
+            raise ValueError("There are no embeddings to index")
+
+        if n_lists is None:
+            n_lists = round(4 * math.sqrt(len(vectors)))
+        n_lists = max(1, min(n_lists, len(vectors)))
+
+        # spherical k-means: unit centroids, closest by dot product
+        rng = np.random.default_rng(seed)
+        train = sample_rows(vectors, max(train_rows, n_lists), rng)
+        centroids = kmeans(train, n_lists, iterations, rng, spherical=True)
+
+        assignments = assign(vectors, centroids)
+        rows = np.argsort(assignments, kind="stable")
+        offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignments, minlength=n_lists), out=offsets[1:])
+
+        manifest = {
+            "version": IVF_VERSION,
+            "lists": n_lists,
+            "count": len(vectors),
+            "embeddings_build_id": build_id,
+        }
+        return cls(manifest, centroids, offsets, rows)
+
+    def save(self) -> None:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        save_array(CACHE_IVF_CENTROIDS_FILE, self.centroids)
+        save_array(CACHE_IVF_OFFSETS_FILE, self.offsets)
+        save_array(CACHE_IVF_ROWS_FILE, self.rows)
+
+        tmp_manifest = CACHE_IVF_MANIFEST_FILE.with_suffix(".json.tmp")
+        with open(tmp_manifest, "w") as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp_manifest, CACHE_IVF_MANIFEST_FILE)
+
+    @classmethod
+    def load(cls, build_id: str | None) -> "IVFIndex":
+        """Load the index built from the embeddings with `build_id`."""
+        if not CACHE_IVF_MANIFEST_FILE.exists():
+            raise FileNotFoundError(
+                f"File not found: {CACHE_IVF_MANIFEST_FILE} (run 'build_ann')"
+            )
+
+        with open(CACHE_IVF_MANIFEST_FILE, "r") as f:
+            manifest = json.load(f)
+
+        if manifest.get("version") != IVF_VERSION:
+            raise ValueError(
+                f"Unsupported ANN index version {manifest.get('version')}"
+                f" (expected {IVF_VERSION}), please run 'build_ann'"
+            )
+        if build_id is None or manifest["embeddings_build_id"] != build_id:
+            raise ValueError(
+                "The ANN index was built from other embeddings, please run 'build_ann'"
+            )
+
+        centroids = np.load(CACHE_IVF_CENTROIDS_FILE, mmap_mode="r")
+        offsets = np.load(CACHE_IVF_OFFSETS_FILE, mmap_mode="r")
+        rows = np.load(CACHE_IVF_ROWS_FILE, mmap_mode="r")
+        if (
+            len(centroids) != manifest["lists"]
+            or offsets.shape != (manifest["lists"] + 1,)
+            or rows.shape != (manifest["count"],)
+        ):
+            raise ValueError(
+                f"Corrupt ANN index in {CACHE_DIR}, please run 'build_ann'"
+            )
+
+        return cls(manifest, centroids, offsets, rows)
+
+    def probe(self, queries: np.ndarray, nprobe: int) -> np.ndarray:
+        # the `nprobe` lists with the closest centroids, per query
+        nprobe = max(1, min(nprobe, self.n_lists))
+        scores = np.asarray(queries, dtype=EMBEDDING_DTYPE) @ self.centroids.T
+        return np.argpartition(scores, -nprobe, axis=1)[:, -nprobe:]
+
+    def candidates(self, lists: np.ndarray) -> np.ndarray:
+        # sorted, so the matrix is read in order and ties break by row
+        return np.sort(
+            np.concatenate(
+                [self.rows[self.offsets[i] : self.offsets[i + 1]] for i in lists]
+            )
+        )
+
+    def search(
+        self,
+        vectors: np.ndarray,
+        queries: np.ndarray,
+        limit: int,
+        nprobe: int = ANN_NPROBE,
+    ) -> list[tuple[np.ndarray, np.ndarray]]:
+        """Approximate `top_k_rows`: ``(rows, scores)`` per query.
+
+        A query gets fewer than `limit` rows if its lists hold fewer rows.
+        """
+        queries = np.asarray(queries, dtype=EMBEDDING_DTYPE)
+        results = []
+        for query, lists in zip(queries, self.probe(queries, nprobe)):
+            candidates = self.candidates(lists)
+            hits, scores = top_k_rows(vectors[candidates], query[None], limit)
+            results.append((candidates[hits[0]], scores[0]))
+
+        return results
+
+
+def recall_at_k(approximate: Sequence[np.ndarray], exact: np.ndarray) -> float:
+    # share of the exact top-k rows that were found, over all queries
+    found = sum(
+        len(np.intersect1d(rows, truth)) for rows, truth in zip(approximate, exact)
+    )
+    return found / max(exact.size, 1)
+
+
+def evaluate(
+    index: IVFIndex,
+    vectors: np.ndarray,
+    queries: np.ndarray,
+    limit: int,
+    nprobes: Sequence[int],
+) -> list[dict]:
+    """Recall@limit and per-query latency for each `nprobe`, vs. brute force.
+
+    Queries are run one at a time, as they arrive in a service. The first
+    result is brute force itself (``nprobe`` None, recall 1.0).
+    """
+    queries = normalize(queries)
+    exact = []
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        rows, _ = top_k_rows(vectors, query[None], limit)
+        latencies.append(time.perf_counter() - start)
+        exact.append(rows[0])
+
+    results = [_operating_point(None, 1.0, latencies, 1.0)]
+    for nprobe in nprobes:
+        found = []
+        latencies = []
+        for query in queries:
+            start = time.perf_counter()
+            [(rows, _)] = index.search(vectors, query[None], limit, nprobe)
+            latencies.append(time.perf_counter() - start)
+            found.append(rows)
+
+        probes = index.probe(queries, nprobe)
+        scanned = np.mean([len(index.candidates(lists)) for lists in probes])
+        results.append(
+            _operating_point(
+                nprobe,
+                recall_at_k(found, np.array(exact)),
+                latencies,
+                scanned / len(vectors),
+            )
+        )
+
+    return results
+
+
+def _operating_point(
+    nprobe: int | None, recall: float, latencies: list[float], scanned: float
+) -> dict:
+    ms = np.array(latencies) * 1000
+    return {
+        "nprobe": nprobe,
+        "recall": recall,
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p95_ms": float(np.percentile(ms, 95)),
+        "scanned": float(scanned),
+    }
+
+
+def sample_rows(vectors: np.ndarray, size: int, rng: np.random.Generator) -> np.ndarray:
+    # random rows, read in order from the (memory-mapped) matrix
+    size = min(size, len(vectors))
+    rows = np.sort(rng.choice(len(vectors), size=size, replace=False))
+    return np.asarray(vectors[rows], dtype=EMBEDDING_DTYPE)
+
+
+def kmeans(
+    train: np.ndarray,
+    n_clusters: int,
+    iterations: int,
+    rng: np.random.Generator,
+    spherical: bool = False,
+) -> np.ndarray:
+    """Lloyd's k-means over the rows of `train`, seeded with random rows.
+
+    With `spherical` the centroids are kept at unit length, so the closest
+    centroid of a unit vector is the one with the highest dot product.
+    """
+    centroids = train[rng.choice(len(train), size=n_clusters, replace=False)]
+
+    for _ in range(iterations):
+        assignments = assign(train, centroids)
+        counts = np.bincount(assignments, minlength=n_clusters)
+        filled = np.flatnonzero(counts)
+        starts = np.cumsum(counts)[filled] - counts[filled]
+
+        sums = np.empty_like(centroids)
+        order = np.argsort(assignments, kind="stable")
+        sums[filled] = np.add.reduceat(train[order], starts, axis=0)
+
+        # empty clusters restart from random training rows
+        empty = np.flatnonzero(counts == 0)
+        sums[empty] = train[rng.choice(len(train), size=len(empty), replace=False)]
+        counts[empty] = 1
+        centroids = normalize(sums) if spherical else sums / counts[:, None]
+
+    return centroids
+
+
+def assign(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    # closest centroid of every row: argmin |v - c|^2 = argmax v.c - |c|^2 / 2
+    bias = 0.5 * np.einsum("ij,ij->i", centroids, centroids)
+    assignments = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), ASSIGN_BLOCK_ROWS):
+        block = np.asarray(vectors[start : start + ASSIGN_BLOCK_ROWS])
+        assignments[start : start + len(block)] = np.argmax(
+            block @ centroids.T - bias, axis=1
+        )
+
+    return assignments
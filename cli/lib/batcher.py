@@ -0,0 +1,180 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from config import BATCH_MAX_QUEUE, BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS
+
+Encode = Callable[[list[str]], np.ndarray]
+
+METRICS_WINDOW = 1_000  # recent batches and requests the percentiles cover
+
+
+class EmbeddingBatcher:
+    """Coalesces concurrent embedding requests into batched encode calls.
+
+    A batch is closed when it holds `max_batch_size` texts or `max_wait_ms`
+    after its first request arrived, then encoded on a worker thread while
+    the next batch collects. At most `max_queue` requests may wait;
+    `embed` raises `asyncio.QueueFull` beyond that.
+    """
+
+    def __init__(
+        self,
+        encode: Encode,
+        max_batch_size: int = BATCH_MAX_SIZE,
+        max_wait_ms: float = BATCH_MAX_WAIT_MS,
+        max_queue: int = BATCH_MAX_QUEUE,
+    ) -> None:
+        self.encode = encode
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue: asyncio.Queue[tuple[str, asyncio.Future, float]] = asyncio.Queue(
+            max_queue
+        )
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix="encode")
+        self.worker: asyncio.Task | None = None
+
+        self.requests = 0
+        self.rejected = 0
+        self.batches = 0
+        self.batch_sizes: deque[int] = deque(maxlen=METRICS_WINDOW)
+        self.queue_delays: deque[float] = deque(maxlen=METRICS_WINDOW)
+        self.encode_times: deque[float] = deque(maxlen=METRICS_WINDOW)
+
+    async def embed(self, text: str) -> np.ndarray:
+        if self.worker is None:
+            self.worker = asyncio.create_task(self.__run())
+
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((text, future, time.perf_counter()))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise
+        self.requests += 1
+        return await future
+
+    async def embed_many(self, texts: list[str]) -> np.ndarray:
+        return np.stack(await asyncio.gather(*(self.embed(text) for text in texts)))
+
+    async def close(self) -> None:
+        if self.worker is not None:
+            self.worker.cancel()
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
+            self.worker = None
+        self.executor.shutdown()
+
+    def stats(self) -> dict:
+        sizes = np.array(self.batch_sizes, dtype=float)
+        delays = np.array(self.queue_delays) * 1000
+        encodes = np.array(self.encode_times) * 1000
+        return {
+            "requests": self.requests,
+            "rejected": self.rejected,
+            "batches": self.batches,
+            "queue_depth": self.queue.qsize(),
+            "mean_batch_size": float(sizes.mean()) if len(sizes) else 0.0,
+            "fill_rate": float(sizes.mean() / self.max_batch_size)
+            if len(sizes)
+            else 0.0,
+            "queue_delay_p50_ms": _percentile(delays, 50),
+            "queue_delay_p95_ms": _percentile(delays, 95),
+            "encode_p50_ms": _percentile(encodes, 50),
+        }
+
+    async def __run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0 and self.queue.empty():
+                    break
+                try:
+                    # requests already queued are taken without waiting
+                    batch.append(
+                        self.queue.get_nowait()
+                        if not self.queue.empty()
+                        else await asyncio.wait_for(self.queue.get(), timeout)
+                    )
+                except TimeoutError:
+                    break
+
+            await self.__encode(batch)
+
+    async def __encode(self, batch: list[tuple[str, asyncio.Future, float]]) -> None:
+        start = time.perf_counter()
+        self.queue_delays.extend(start - enqueued for _, _, enqueued in batch)
+        self.batch_sizes.append(len(batch))
+        self.batches += 1
+
+        # identical texts of one batch are encoded once
+        texts = list(dict.fromkeys(text for text, _, _ in batch))
+        try:
+            vectors = await asyncio.get_running_loop().run_in_executor(
+                self.executor, self.encode, texts
+            )
+        except Exception as err:  # noqa: BLE001
+            # raised to every caller of the batch instead of ending the loop
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(err)
+            return
+        finally:
+            self.encode_times.append(time.perf_counter() - start)
+
+        rows = dict(zip(texts, vectors))
+        for text, future, _ in batch:
+            if not future.done():
+                future.set_result(rows[text])
+
+
+class BatchingEncoder:
+    """An `EmbeddingBatcher` for threaded callers, on its own event loop.
+
+    Calling it with a list of texts blocks the calling thread until every
+    text has been encoded in some batch; texts of concurrent calls share
+    batches.
+    """
+
+    def __init__(self, encode: Encode, **settings) -> None:
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self.loop.run_forever, name="batcher", daemon=True
+        )
+        self.thread.start()
+        self.batcher = self.__call_soon(self.__create(encode, settings))
+
+    def __call__(self, texts: list[str]) -> np.ndarray:
+        return self.__call_soon(self.batcher.embed_many(list(texts)))
+
+    def stats(self) -> dict:
+        return self.__call_soon(self.__stats())
+
+    def close(self) -> None:
+        self.__call_soon(self.batcher.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def __call_soon(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def __create(self, encode: Encode, settings: dict) -> EmbeddingBatcher:
+        # the queue belongs to the loop it is created on
+        return EmbeddingBatcher(encode, **settings)
+
+    async def __stats(self) -> dict:
+        return self.batcher.stats()
+
+
+def _percentile(values: np.ndarray, q: float) -> float:
+    return float(np.percentile(values, q)) if len(values) else 0.0
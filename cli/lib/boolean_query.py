@@ -0,0 +1,244 @@
+import re
+from bisect import bisect_left
+from collections.abc import Callable, Iterator, Sequence
+
+from lib.top_k import EXHAUSTED
+
+# Boolean query language of 'search':
+#
+#   query    := and ([OR] and)*        words side by side match any of them
+#   and      := unary ([AND] NOT unary | AND unary)*
+#   unary    := NOT unary | primary
+#   primary  := [field:] (word | "phrase" | "(" query ")")
+#   field    := title | description
+#
+# Operators are upper case; a field prefix on a group applies to every word
+# and phrase in it.
+
+FIELDS = ("title", "description")
+OPERATORS = ("AND", "OR", "NOT")
+
+_LEXEME = re.compile(r'(?:(title|description):)?("[^"]*"|[()]|[^\s()"]+)')
+
+
+class Term:
+    """A word or a quoted phrase, optionally restricted to one field."""
+
+    def __init__(self, text: str, field: str | None, phrase: bool) -> None:
+        self.text = text
+        self.field = field
+        self.phrase = phrase
+
+
+class Not:
+    def __init__(self, child: "Node") -> None:
+        self.child = child
+
+
+class And:
+    def __init__(self, children: list["Node"]) -> None:
+        self.children = children
+
+
+class Or:
+    def __init__(self, children: list["Node"]) -> None:
+        self.children = children
+
+
+Node = Term | Not | And | Or
+
+
+def parse(query: str) -> Node | None:
+    parser = _Parser(_LEXEME.findall(query))
+    node = parser.parse_or()
+    if parser.pos < len(parser.lexemes):
+        raise ValueError("Unbalanced ')' in query")
+    return node
+
+
+def normalize(query: str, tokenize: Callable[[str], list[str]]) -> tuple:
+    # the query's lexemes with words and phrases as their tokens; queries that
+    # only differ in case, spacing, stop words or word forms are equal
+    return tuple(
+        (field, text)
+        if text in ("(", ")") or text in OPERATORS and not field
+        else (field, text.startswith('"'), tuple(tokenize(text)))
+        for field, text in _LEXEME.findall(query)
+    )
+
+
+class _Parser:
+    def __init__(self, lexemes: list[tuple[str, str]]) -> None:
+        self.lexemes = lexemes
+        self.pos = 0
+        self.field: str | None = None
+
+    def peek(self) -> str | None:
+        if self.pos == len(self.lexemes):
+            return None
+        field, text = self.lexemes[self.pos]
+        return None if field else text
+
+    def parse_or(self) -> Node | None:
+        children = []
+        while self.pos < len(self.lexemes) and self.peek() != ")":
+            if self.peek() == "OR":
+                self.pos += 1
+                continue
+            children.append(self.parse_and())
+
+        if not children:
+            return None
+        return children[0] if len(children) == 1 else Or(children)
+
+    def parse_and(self) -> Node:
+        # "a NOT b" reads as "a AND NOT b"
+        children = [self.parse_unary()]
+        while self.peek() in ("AND", "NOT"):
+            if self.peek() == "AND":
+                self.pos += 1
+            children.append(self.parse_unary())
+        return children[0] if len(children) == 1 else And(children)
+
+    def parse_unary(self) -> Node:
+        if self.peek() == "NOT":
+            self.pos += 1
+            return Not(self.parse_unary())
+        return self.parse_primary()
+
+    def parse_primary(self) -> Node:
+        if self.pos == len(self.lexemes):
+            raise ValueError("Query ends after an operator")
+
+        field, text = self.lexemes[self.pos]
+        self.pos += 1
+        if text == "(":
+            outer, self.field = self.field, field or self.field
+            node = self.parse_or()
+            self.field = outer
+            if self.peek() != ")":
+                raise ValueError("Unbalanced '(' in query")
+            self.pos += 1
+            return node if node is not None else Or([])
+        if text == ")" or text in OPERATORS and not field:
+            raise ValueError(f"Unexpected '{text}' in query")
+
+        phrase = text.startswith('"')
+        return Term(text.strip('"') if phrase else text, field or self.field, phrase)
+
+
+class OrdinalCursor:
+    """Ascending doc ordinals, e.g. one term's postings."""
+
+    def __init__(self, ordinals: Sequence[int]) -> None:
+        self.ordinals = ordinals
+        self.cost = len(ordinals)
+        self.pos = 0
+        self.doc = ordinals[0] if self.cost else EXHAUSTED
+
+    def seek(self, ordinal: int) -> int:
+        # galloping forward from the current position, then binary search
+        if self.doc >= ordinal:
+            return self.doc
+
+        ordinals, size = self.ordinals, self.cost
+        pos, step = self.pos, 1
+        while pos + step < size and ordinals[pos + step] < ordinal:
+            pos += step
+            step *= 2
+
+        self.pos = bisect_left(ordinals, ordinal, pos, min(pos + step + 1, size))
+        self.doc = ordinals[self.pos] if self.pos < size else EXHAUSTED
+        return self.doc
+
+
+class AndCursor:
+    """Documents in all `children` and in none of `excluded`.
+
+    The rarest child proposes candidates, the others are sought to them, so
+    common terms are skipped through rather than walked.
+    """
+
+    def __init__(self, children: list["Cursor"], excluded: list["Cursor"]) -> None:
+        self.children = sorted(children, key=lambda child: child.cost)
+        self.excluded = excluded
+        self.cost = self.children[0].cost
+        self.doc = -1
+
+    def seek(self, ordinal: int) -> int:
+        if self.doc >= ordinal:
+            return self.doc
+
+        lead, rest = self.children[0], self.children[1:]
+        candidate = ordinal
+        while (candidate := lead.seek(candidate)) != EXHAUSTED:
+            for child in rest:
+                found = child.seek(candidate)
+                if found != candidate:
+                    candidate = found
+                    break
+            else:
+                if not any(
+                    child.seek(candidate) == candidate for child in self.excluded
+                ):
+                    break
+                candidate += 1
+
+        self.doc = candidate
+        return candidate
+
+
+class OrCursor:
+    def __init__(self, children: list["Cursor"]) -> None:
+        self.children = children
+        self.cost = sum(child.cost for child in children)
+        self.doc = -1
+
+    def seek(self, ordinal: int) -> int:
+        if self.doc < ordinal:
+            self.doc = min(
+                (child.seek(ordinal) for child in self.children), default=EXHAUSTED
+            )
+        return self.doc
+
+
+class FilterCursor:
+    """Documents of `child` that `accept(ordinal)`, e.g. a field check."""
+
+    def __init__(self, child: "Cursor", accept: Callable[[int], bool]) -> None:
+        self.child = child
+        self.accept = accept
+        self.cost = child.cost
+        self.doc = -1
+
+    def seek(self, ordinal: int) -> int:
+        if self.doc < ordinal:
+            candidate = self.child.seek(ordinal)
+            while candidate != EXHAUSTED and not self.accept(candidate):
+                candidate = self.child.seek(candidate + 1)
+            self.doc = candidate
+        return self.doc
+
+
+Cursor = OrdinalCursor | AndCursor | OrCursor | FilterCursor
+
+
+def matches(cursor: Cursor, start: int = 0) -> Iterator[int]:
+    # every matching ordinal from `start` on, ascending; nothing is looked at
+    # before it is asked for
+    ordinal = cursor.seek(start)
+    while ordinal != EXHAUSTED:
+        yield ordinal
+        ordinal = cursor.seek(ordinal + 1)
+
+
+def collect(cursor: Cursor) -> Sequence[int]:
+    # every match of a fresh cursor, like list(matches(cursor)), with plain
+    # postings and their unions read in bulk
+    if isinstance(cursor, OrdinalCursor):
+        return cursor.ordinals
+    if isinstance(cursor, OrCursor) and all(
+        isinstance(child, OrdinalCursor) for child in cursor.children
+    ):
+        return sorted(set().union(*(child.ordinals for child in cursor.children)))
+    return list(matches(cursor))
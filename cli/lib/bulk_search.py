@@ -0,0 +1,170 @@
+import json
+import multiprocessing
+from collections import OrderedDict, deque
+from collections.abc import Iterable, Iterator
+from itertools import batched
+from typing import TextIO
+
+from config import (
+    BM25_ENGINE,
+    BULK_CHUNK_QUERIES,
+    BULK_PENDING_CHUNKS_PER_WORKER,
+    BULK_RESULT_CACHE_SIZE,
+)
+from lib.inverted_index import InvertedIndex, bm25_query_tokens
+from lib.tokenize import get_tokenizer
+
+Hits = list[tuple[int, str, float]]
+
+# the index searched by this process; forked workers inherit it
+_index: InvertedIndex | None = None
+
+
+def read_queries(f: TextIO, jsonl: bool) -> Iterator[tuple[int | str, str]]:
+    """(id, query) pairs of a queries file, read lazily.
+
+    A `jsonl` file holds one JSON string or {"query", "id"?} object per
+    line, any other file one query per line; the id defaults to the line
+    number. A malformed line raises ValueError when it is read.
+    """
+    for number, line in enumerate(f, 1):
+        line = line.strip()
+        if not line:
+            continue
+        if not jsonl:
+            yield number, line
+            continue
+
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as err:
+            raise ValueError(f"Line {number}: {err}") from None
+        if isinstance(record, str):
+            yield number, record
+        elif isinstance(record, dict) and "query" in record:
+            yield record.get("id", number), str(record["query"])
+        else:
+            raise ValueError(
+                f"Line {number}: expected a JSON string or an object with"
+                f' a "query", got {line[:40]}'
+            )
+
+
+def bulk_bm25_search(
+    index: InvertedIndex,
+    queries: Iterable[tuple[int | str, str]],
+    out: TextIO,
+    limit: int,
+    k1: float,
+    b: float,
+    workers: int = 1,
+    engine: str = BM25_ENGINE,
+) -> dict:
+    """Write the BM25 results of every query to `out` as JSON lines.
+
+    Queries are searched in chunks, by up to `workers` processes that share
+    the loaded index (forked, or mmap'd where fork is unavailable). Lines
+    are written in input order as soon as their chunk is done. A query
+    seen before is not searched again, nor are queries of one chunk with
+    the same words and quoted phrases; the sparse engine scores a chunk's
+    queries without phrases as one batch. Returns the number of queries
+    and searches.
+    """
+    global _index
+    _index = index
+    get_tokenizer()  # loaded once, before workers fork
+
+    cache: OrderedDict[str, Hits] = OrderedDict()
+    stats = {"queries": 0, "searched": 0}
+
+    def submit(chunk: tuple[tuple[int | str, str], ...]):
+        # results of cached queries are taken now, they may be evicted later
+        known = {}
+        for _, query in chunk:
+            if query in cache:
+                cache.move_to_end(query)
+                known[query] = cache[query]
+        missing = list(dict.fromkeys(q for _, q in chunk if q not in known))
+        stats["searched"] += len(missing)
+        if pool is None:
+            return chunk, known, missing, _search_chunk(missing, limit, k1, b, engine)
+        job = pool.apply_async(_search_chunk, (missing, limit, k1, b, engine))
+        return chunk, known, missing, job
+
+    def write(chunk, known, missing, job) -> None:
+        hits = job if pool is None else job.get()
+        for query, results in zip(missing, hits):
+            known[query] = cache[query] = results
+            if len(cache) > BULK_RESULT_CACHE_SIZE:
+                cache.popitem(last=False)
+
+        for query_id, query in chunk:
+            record = {
+                "id": query_id,
+                "query": query,
+                "results": [
+                    {"id": doc_id, "title": title, "score": score}
+                    for doc_id, title, score in known[query]
+                ],
+            }
+            out.write(json.dumps(record) + "\n")
+        out.flush()
+        stats["queries"] += len(chunk)
+
+    pool = None
+    if workers > 1:
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("fork" if "fork" in methods else None)
+        pool = context.Pool(workers, initializer=_init_worker)
+
+    try:
+        pending = deque()
+        for chunk in batched(queries, BULK_CHUNK_QUERIES):
+            pending.append(submit(chunk))
+            if len(pending) >= max(workers, 1) * BULK_PENDING_CHUNKS_PER_WORKER:
+                write(*pending.popleft())
+
+        while pending:
+            write(*pending.popleft())
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    return stats
+
+
+def _init_worker() -> None:
+    # spawned workers open the index themselves; its segments are mmap'd, so
+    # their pages are still shared through the page cache
+    global _index
+    if _index is None:
+        _index = InvertedIndex()
+        _index.load()
+
+
+def _search_chunk(
+    queries: list[str], limit: int, k1: float, b: float, engine: str
+) -> list[Hits]:
+    # module level so it can be pickled into worker processes
+    # queries are split into words and quoted phrases like single searches
+    index = _index
+    keys = []
+    for query in queries:
+        tokens, phrases = bm25_query_tokens(query)
+        keys.append((tuple(tokens), tuple(map(tuple, phrases))))
+    distinct = list(dict.fromkeys(keys))
+    searched: dict[tuple, Hits] = {}
+    tops = index.bm25_search_tokens_many(
+        [tokens for tokens, _ in distinct],
+        limit,
+        k1,
+        b,
+        engine,
+        [phrases for _, phrases in distinct],
+    )
+    for key, scores in zip(distinct, tops):
+        searched[key] = [
+            (doc_id, hit["title"], score)
+            for (doc_id, score), hit in zip(scores.items(), index.hydrate(scores))
+        ]
+    return [searched[key] for key in keys]
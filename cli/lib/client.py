@@ -0,0 +1,44 @@
+import json
+
+from config import CACHE_SERVE_FILE, SERVE_TIMEOUT
+from lib import trace
+
+
+def request(endpoint: str, payload: dict) -> dict | None:
+    """POST `payload` to the running search daemon ('serve').
+
+    Returns None when no daemon is running or it cannot answer, so the
+    caller searches locally instead. So does a profiled run (--profile),
+    which is about this process' own work.
+    """
+    if trace.is_enabled():
+        return None
+
+    try:
+        with open(CACHE_SERVE_FILE, "r") as f:
+            daemon = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+    # imported only with a daemon to talk to, it adds ~30 ms to CLI startup
+    import http.client
+
+    connection = http.client.HTTPConnection(
+        daemon["host"], daemon["port"], timeout=SERVE_TIMEOUT
+    )
+    try:
+        connection.request(
+            "POST",
+            endpoint,
+            body=json.dumps(payload),
+            headers={"Content-Type": "application/json"},
+        )
+        response = connection.getresponse()
+        body = json.loads(response.read())
+    except (OSError, http.client.HTTPException, ValueError):
+        # a stale serve file: the daemon is gone
+        return None
+    finally:
+        connection.close()
+
+    return body if response.status == 200 else None
@@ -0,0 +1,147 @@
+import sqlite3
+import threading
+import unicodedata
+from collections import OrderedDict
+from collections.abc import Callable, Sequence
+from pathlib import Path
+
+import numpy as np
+from config import CACHE_QUERY_EMBEDDINGS_FILE, QUERY_CACHE_BYTES
+from lib.embeddings import EMBEDDING_DTYPE
+
+Key = tuple[str, str]  # (model name, normalized text)
+
+
+def normalize_query(text: str) -> str:
+    # NFKC and collapsed whitespace; case is kept, cased models embed it
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+class EmbeddingCache:
+    """Query embeddings by (model, normalized text), in two levels.
+
+    An LRU in memory, bounded by `max_bytes` (vectors plus key text), over
+    an sqlite table at `path` that keeps every embedding across processes.
+    Memory-only without a path. Safe to share between threads.
+    """
+
+    def __init__(
+        self,
+        path: Path | None = CACHE_QUERY_EMBEDDINGS_FILE,
+        max_bytes: int = QUERY_CACHE_BYTES,
+    ) -> None:
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[Key, np.ndarray] = OrderedDict()
+        self.held_bytes = 0
+        self.hits = 0  # found in memory
+        self.disk_hits = 0  # found on disk
+        self.misses = 0  # encoded
+        self.evictions = 0  # dropped from memory
+        self.lock = threading.Lock()
+
+        self.db: sqlite3.Connection | None = None
+        if path is not None:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS query_embeddings ("
+                " model TEXT NOT NULL, text TEXT NOT NULL, vector BLOB NOT NULL,"
+                " PRIMARY KEY (model, text)) WITHOUT ROWID"
+            )
+            self.db.commit()
+
+    def get_many(
+        self,
+        model: str,
+        texts: Sequence[str],
+        encode: Callable[[list[str]], np.ndarray],
+    ) -> np.ndarray:
+        """Embeddings of `texts`; only texts in neither level are encoded.
+
+        `encode` gets the normalized texts of all misses in one call.
+        """
+        keys = [(model, normalize_query(text)) for text in texts]
+        found: dict[Key, np.ndarray] = {}
+        with self.lock:
+            for key in dict.fromkeys(keys):
+                vector = self.__get(key)
+                if vector is not None:
+                    found[key] = vector
+
+        missing = [key for key in dict.fromkeys(keys) if key not in found]
+        if missing:
+            vectors = np.asarray(
+                encode([text for _, text in missing]), dtype=EMBEDDING_DTYPE
+            )
+            with self.lock:
+                self.misses += len(missing)
+                for key, vector in zip(missing, vectors):
+                    found[key] = vector
+                    self.__put(key, vector)
+                if self.db is not None:
+                    self.db.executemany(
+                        "INSERT OR REPLACE INTO query_embeddings VALUES (?, ?, ?)",
+                        [(*key, found[key].tobytes()) for key in missing],
+                    )
+                    self.db.commit()
+
+        return np.stack([found[key] for key in keys])
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+                "entries": len(self.entries),
+                "bytes": self.held_bytes,
+            }
+
+    def close(self) -> None:
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def __get(self, key: Key) -> np.ndarray | None:
+        vector = self.entries.get(key)
+        if vector is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return vector
+
+        if self.db is None:
+            return None
+
+        row = self.db.execute(
+            "SELECT vector FROM query_embeddings WHERE model = ? AND text = ?", key
+        ).fetchone()
+        if row is None:
+            return None
+
+        vector = np.frombuffer(row[0], dtype=EMBEDDING_DTYPE)
+        self.disk_hits += 1
+        self.__put(key, vector)
+        return vector
+
+    def __put(self, key: Key, vector: np.ndarray) -> None:
+        size = _entry_bytes(key, vector)
+        if size > self.max_bytes:
+            return
+
+        previous = self.entries.pop(key, None)
+        if previous is not None:
+            self.held_bytes -= _entry_bytes(key, previous)
+
+        self.entries[key] = vector
+        self.held_bytes += size
+        while self.held_bytes > self.max_bytes:
+            old_key, old_vector = self.entries.popitem(last=False)
+            self.held_bytes -= _entry_bytes(old_key, old_vector)
+            self.evictions += 1
+
+
+def _entry_bytes(key: Key, vector: np.ndarray) -> int:
+    return vector.nbytes + len(key[0]) + len(key[1].encode())
@@ -0,0 +1,367 @@
+import hashlib
+import json
+import os
+import uuid
+from collections.abc import Callable, Iterable
+from pathlib import Path
+
+import numpy as np
+from config import (
+    CACHE_DIR,
+    CACHE_EMBEDDING_HASHES_FILE,
+    CACHE_EMBEDDING_IDS_FILE,
+    CACHE_EMBEDDINGS_FILE,
+    CACHE_EMBEDDINGS_MANIFEST_FILE,
+    EMBEDDING_BATCH_SIZE,
+    SEMANTIC_BLOCK_ROWS,
+)
+from lib.utils import document_text
+
+# Embedding store files (all rows ordered by ascending doc id):
+#
+#   embeddings.json              manifest: model, dimension, row count, hash
+#                                function, build id (indexes derived from the
+#                                matrix record it), the array files
+#   embeddings.<build>.npy       float32 [rows, dimension], L2-normalized
+#   embedding_ids.<build>.npy    int64 [rows], doc id per row
+#   embedding_hashes.<build>.npy uint8 [rows, 16], blake2b of the embedded text
+#
+# The .npy files are opened with mmap_mode="r", so loading is zero-copy.
+# Every build writes new array files and then publishes them by replacing
+# the manifest, so readers never pair arrays of different builds; loading
+# checks that the manifest agrees with the arrays.
+
+EMBEDDINGS_VERSION = 2
+EMBEDDING_DTYPE = np.float32
+HASH_SIZE = 16
+COPY_ROWS = 65_536  # rows copied at a time from the previous matrix
+
+Encoder = Callable[[list[str]], np.ndarray]
+
+# the configured array paths, versioned with the build id on disk
+ARRAY_FILES = {
+    "vectors": CACHE_EMBEDDINGS_FILE,
+    "ids": CACHE_EMBEDDING_IDS_FILE,
+    "hashes": CACHE_EMBEDDING_HASHES_FILE,
+}
+
+
+def content_hash(text: str) -> bytes:
+    return hashlib.blake2b(text.encode(), digest_size=HASH_SIZE).digest()
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    # unit length rows, so a dot product is the cosine similarity
+    vectors = np.asarray(vectors, dtype=EMBEDDING_DTYPE)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, np.finfo(EMBEDDING_DTYPE).tiny)
+
+
+def top_k_rows(
+    vectors: np.ndarray,
+    queries: np.ndarray,
+    limit: int,
+    block_rows: int = SEMANTIC_BLOCK_ROWS,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Rows with the highest dot product for every query.
+
+    The matrix is scored block by block, each block with one matrix product
+    for all queries (see `top_k`). Returns ``(rows, scores)`` of shape
+    ``[queries, min(limit, rows)]``, by descending score, ties by
+    ascending row.
+    """
+    queries = np.asarray(queries, dtype=EMBEDDING_DTYPE)
+    return top_k(
+        lambda start, end: queries @ vectors[start:end].T,
+        len(vectors),
+        len(queries),
+        limit,
+        block_rows,
+    )
+
+
+def top_k(
+    score: Callable[[int, int], np.ndarray],
+    row_count: int,
+    query_count: int,
+    limit: int,
+    block_rows: int = SEMANTIC_BLOCK_ROWS,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Top `limit` rows per query, where `score(start, end)` scores a block.
+
+    Only each block's top candidates are kept (argpartition, no full sort).
+    Results are ordered like `top_k_rows`.
+    """
+    k = max(0, min(limit, row_count))
+    best_rows = np.empty((query_count, 0), dtype=np.int64)
+    best_scores = np.empty((query_count, 0), dtype=EMBEDDING_DTYPE)
+    if not k:
+        return best_rows, best_scores
+
+    for start in range(0, row_count, block_rows):
+        scores = score(start, min(start + block_rows, row_count))
+        if scores.shape[1] > k:
+            rows = np.argpartition(scores, -k, axis=1)[:, -k:]
+            scores = np.take_along_axis(scores, rows, axis=1)
+        else:
+            rows = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+
+        best_rows = np.concatenate([best_rows, rows + start], axis=1)
+        best_scores = np.concatenate([best_scores, scores], axis=1)
+        if best_rows.shape[1] > k:
+            keep = np.argpartition(best_scores, -k, axis=1)[:, -k:]
+            best_rows = np.take_along_axis(best_rows, keep, axis=1)
+            best_scores = np.take_along_axis(best_scores, keep, axis=1)
+
+    order = np.lexsort((best_rows, -best_scores), axis=1)
+    return (
+        np.take_along_axis(best_rows, order, axis=1),
+        np.take_along_axis(best_scores, order, axis=1),
+    )
+
+
+class EmbeddingStore:
+    """Corpus embeddings, one row per document, memory-mapped from disk."""
+
+    def __init__(
+        self,
+        manifest: dict,
+        vectors: np.ndarray,
+        doc_ids: np.ndarray,
+        hashes: np.ndarray,
+    ) -> None:
+        self.manifest = manifest
+        self.vectors = vectors
+        self.doc_ids = doc_ids
+        self.hashes = hashes
+
+    @property
+    def model(self) -> str:
+        return self.manifest["model"]
+
+    @property
+    def dimension(self) -> int:
+        return self.manifest["dimension"]
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    @classmethod
+    def load(cls) -> "EmbeddingStore":
+        if not CACHE_EMBEDDINGS_MANIFEST_FILE.exists():
+            raise FileNotFoundError(
+                f"File not found: {CACHE_EMBEDDINGS_MANIFEST_FILE}"
+                " (run 'build_embeddings')"
+            )
+
+        try:
+            return cls.__load(_read_manifest())
+        except FileNotFoundError:
+            # a rebuild published new arrays and removed these since the
+            # manifest was read
+            return cls.__load(_read_manifest())
+
+    @classmethod
+    def __load(cls, manifest: dict) -> "EmbeddingStore":
+        if manifest.get("version") != EMBEDDINGS_VERSION:
+            raise ValueError(
+                f"Unsupported embeddings version {manifest.get('version')}"
+                f" (expected {EMBEDDINGS_VERSION}), please rebuild the embeddings"
+            )
+
+        vectors, doc_ids, hashes = (
+            np.load(path, mmap_mode="r") for path in _array_paths(manifest)
+        )
+
+        count, dimension = manifest["count"], manifest["dimension"]
+        if (
+            vectors.shape != (count, dimension)
+            or vectors.dtype != EMBEDDING_DTYPE
+            or doc_ids.shape != (count,)
+            or hashes.shape != (count, HASH_SIZE)
+        ):
+            raise ValueError(
+                f"Corrupt embeddings in {CACHE_DIR}, please rebuild the embeddings"
+            )
+
+        return cls(manifest, vectors, doc_ids, hashes)
+
+    def rows(self, doc_ids: np.ndarray) -> np.ndarray:
+        # row of every doc id, -1 where the doc id has no embedding
+        positions = np.searchsorted(self.doc_ids, doc_ids)
+        clipped = np.minimum(positions, max(len(self) - 1, 0))
+        found = (positions < len(self)) & (self.doc_ids[clipped] == doc_ids)
+        return np.where(found, positions, -1)
+
+    def row(self, doc_id: int) -> int | None:
+        row = int(self.rows(np.array([doc_id]))[0]) if len(self) else -1
+        return None if row < 0 else row
+
+
+def build_embeddings(
+    movies: Callable[[], Iterable[dict]],
+    model: str,
+    encoder: Callable[[], Encoder],
+    batch_size: int = EMBEDDING_BATCH_SIZE,
+) -> tuple[int, int]:
+    """Embed every movie, re-encoding only texts that changed since last time.
+
+    `movies` is called twice (hashing pass, encoding pass) so the corpus can
+    be streamed; `encoder` is only called if anything needs encoding.
+    Returns ``(encoded, reused)`` document counts.
+    """
+    # pass 1: doc ids and content hashes, sorted by doc id
+    ids: list[int] = []
+    digests = bytearray()
+    for movie in movies():
+        ids.append(movie["id"])
+        digests += content_hash(document_text(movie))
+
+    if not ids:
+        raise ValueError("There are no documents to embed")
+
+    doc_ids = np.array(ids, dtype=np.int64)
+    hashes = np.frombuffer(bytes(digests), dtype=np.uint8).reshape(-1, HASH_SIZE)
+    order = np.argsort(doc_ids, kind="stable")
+    doc_ids, hashes = doc_ids[order], hashes[order]
+    duplicates = doc_ids[1:][doc_ids[1:] == doc_ids[:-1]]
+    if len(duplicates):
+        raise ValueError(f"Duplicate doc id {duplicates[0]}")
+
+    # rows whose text is unchanged keep the previous embedding
+    previous = _load_previous(model)
+    reuse = np.zeros(len(doc_ids), dtype=bool)
+    previous_rows = np.full(len(doc_ids), -1)
+    if previous is not None and len(previous):
+        previous_rows = previous.rows(doc_ids)
+        known = previous_rows >= 0
+        reuse[known] = (previous.hashes[previous_rows[known]] == hashes[known]).all(
+            axis=1
+        )
+
+    # the arrays of this build, published together by the manifest
+    build_id = uuid.uuid4().hex
+    files = {
+        key: f"{path.stem}.{build_id}{path.suffix}" for key, path in ARRAY_FILES.items()
+    }
+    encode: Encoder | None = None
+    vectors: np.ndarray | None = None
+    dimension = previous.dimension if previous is not None else None
+    matrix_path = CACHE_EMBEDDINGS_FILE.with_name(files["vectors"])
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+
+    def flush(rows: list[int], texts: list[str]) -> None:
+        nonlocal encode, vectors, dimension
+        if encode is None:
+            encode = encoder()
+        embedded = normalize(encode(texts))
+        if vectors is None:
+            if dimension is not None and dimension != embedded.shape[1]:
+                raise ValueError(
+                    f"Model {model} returned {embedded.shape[1]} dimensions,"
+                    f" the stored embeddings have {dimension}"
+                )
+            dimension = embedded.shape[1]
+            vectors = _create_matrix(matrix_path, len(doc_ids), dimension)
+        vectors[rows] = embedded
+
+    # pass 2: encode new and changed documents in batches
+    batch_rows: list[int] = []
+    batch_texts: list[str] = []
+    if not reuse.all():
+        for movie in movies():
+            row = int(np.searchsorted(doc_ids, movie["id"]))
+            if reuse[row]:
+                continue
+
+            batch_rows.append(row)
+            batch_texts.append(document_text(movie))
+            if len(batch_texts) == batch_size:
+                flush(batch_rows, batch_texts)
+                batch_rows, batch_texts = [], []
+
+        if batch_texts:
+            flush(batch_rows, batch_texts)
+
+    if vectors is None:
+        # every document was reused
+        vectors = _create_matrix(matrix_path, len(doc_ids), previous.dimension)
+
+    if previous is not None:
+        # copy reused rows in chunks, so the old matrix is never read at once
+        reused_rows = np.flatnonzero(reuse)
+        for start in range(0, len(reused_rows), COPY_ROWS):
+            rows = reused_rows[start : start + COPY_ROWS]
+            vectors[rows] = previous.vectors[previous_rows[rows]]
+
+    vectors.flush()
+    del vectors
+    save_array(CACHE_EMBEDDING_IDS_FILE.with_name(files["ids"]), doc_ids)
+    save_array(CACHE_EMBEDDING_HASHES_FILE.with_name(files["hashes"]), hashes)
+
+    manifest = {
+        "version": EMBEDDINGS_VERSION,
+        "model": model,
+        "dimension": dimension,
+        "count": len(doc_ids),
+        "dtype": np.dtype(EMBEDDING_DTYPE).name,
+        "hash": f"blake2b-{HASH_SIZE * 8}",
+        "build_id": build_id,
+        "files": files,
+    }
+    tmp_manifest = CACHE_EMBEDDINGS_MANIFEST_FILE.with_suffix(".json.tmp")
+    with open(tmp_manifest, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_manifest, CACHE_EMBEDDINGS_MANIFEST_FILE)
+    _remove_stale_arrays(files.values())
+
+    reused = int(reuse.sum())
+    return len(doc_ids) - reused, reused
+
+
+def _read_manifest() -> dict:
+    with open(CACHE_EMBEDDINGS_MANIFEST_FILE, "r") as f:
+        return json.load(f)
+
+
+def _array_paths(manifest: dict) -> list[Path]:
+    # of the vectors, ids and hashes; stores built before the names were
+    # versioned use the plain ones
+    files = manifest.get("files", {})
+    return [
+        path.with_name(files.get(key, path.name)) for key, path in ARRAY_FILES.items()
+    ]
+
+
+def _remove_stale_arrays(current: Iterable[str]) -> None:
+    # arrays of earlier (or failed) builds; processes that mapped them keep
+    # reading them until they reload
+    current = set(current)
+    for path in ARRAY_FILES.values():
+        for stale in [path, *path.parent.glob(f"{path.stem}.*{path.suffix}")]:
+            if stale.name not in current:
+                stale.unlink(missing_ok=True)
+
+
+def _load_previous(model: str) -> EmbeddingStore | None:
+    # embeddings of another model (or a broken store) are not reused
+    try:
+        store = EmbeddingStore.load()
+    except (FileNotFoundError, ValueError):
+        return None
+
+    return store if store.model == model else None
+
+
+def _create_matrix(path: Path, rows: int, dimension: int) -> np.ndarray:
+    return np.lib.format.open_memmap(
+        path, mode="w+", dtype=EMBEDDING_DTYPE, shape=(rows, dimension)
+    )
+
+
+def save_array(path: Path, values: np.ndarray) -> None:
+    # np.save appends ".npy" to paths, but not to open files
+    tmp_path = path.with_suffix(".npy.tmp")
+    with open(tmp_path, "wb") as f:
+        np.save(f, values)
+    os.replace(tmp_path, path)
@@ -0,0 +1,210 @@
+import time
+from collections.abc import Callable, Mapping, Sequence
+from concurrent.futures import Executor, ThreadPoolExecutor
+
+import numpy as np
+from config import (
+    BM25_B,
+    BM25_K1,
+    HYBRID_ALPHA,
+    HYBRID_CANDIDATES,
+    MAX_SEARCH_RESULTS,
+    RRF_K,
+    TRANSFORMER_MODEL,
+)
+from lib import client, embeddings
+from lib.embedding_cache import EmbeddingCache
+from lib.inverted_index import InvertedIndex
+from lib.search import load_index, print_daemon_latency, search_index
+from lib.semantic_search import SemanticSearch
+from lib.utils import print_search_results
+
+FUSIONS = ("rrf", "weighted")
+
+
+def reciprocal_rank_fusion(
+    rankings: Sequence[Sequence[int]], k: int = RRF_K
+) -> dict[int, float]:
+    # sum of 1 / (k + rank) over the rankings a document appears in
+    scores: dict[int, float] = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, 1):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1 / (k + rank)
+    return scores
+
+
+def weighted_fusion(
+    results: Sequence[Mapping[int, float]], weights: Sequence[float]
+) -> dict[int, float]:
+    # weighted sum of min-max normalized scores; absent documents score 0
+    scores: dict[int, float] = {}
+    for result, weight in zip(results, weights):
+        if not result:
+            continue
+        low, high = min(result.values()), max(result.values())
+        span = high - low
+        for doc_id, score in result.items():
+            normalized = (score - low) / span if span else 1.0
+            scores[doc_id] = scores.get(doc_id, 0.0) + weight * normalized
+    return scores
+
+
+class HybridSearch:
+    """BM25 and semantic retrieval, run concurrently and fused.
+
+    Both retrievers return up to `candidates` documents, which are fused
+    with reciprocal rank fusion or a weighted sum of normalized scores. With
+    `rerank`, only the BM25 candidates are scored semantically (one small
+    matrix product instead of the whole corpus), while the query is
+    embedded concurrently with BM25.
+    """
+
+    def __init__(
+        self,
+        index: InvertedIndex,
+        semantic: SemanticSearch,
+        executor: Executor | None = None,
+    ) -> None:
+        self.index = index
+        self.semantic = semantic
+        self.executor = executor or ThreadPoolExecutor(2)
+
+    def search(
+        self,
+        query: str,
+        limit: int = MAX_SEARCH_RESULTS,
+        fusion: str = "rrf",
+        alpha: float = HYBRID_ALPHA,
+        candidates: int = HYBRID_CANDIDATES,
+        rerank: bool = False,
+        k1: float = BM25_K1,
+        b: float = BM25_B,
+    ) -> tuple[list[tuple[int, float]], dict[str, float]]:
+        """Fused ``(doc_id, score)`` results and per-stage timings in ms.
+
+        `alpha` weighs BM25 against semantic scores in weighted fusion.
+        """
+        if fusion not in FUSIONS:
+            raise ValueError(f"Unknown fusion {fusion!r}, expected one of {FUSIONS}")
+        if self.semantic.store is None:
+            self.semantic.load_embeddings()
+
+        timings: dict[str, float] = {}
+        start = time.perf_counter()
+        keyword = self.executor.submit(
+            _timed, timings, "bm25", self.index.bm25_search, query, candidates, k1, b
+        )
+        if rerank:
+            embedded = self.executor.submit(
+                _timed, timings, "embed", self.__embed, query
+            )
+            bm25 = keyword.result()
+            semantic = _timed(
+                timings, "rescore", self.__rescore, embedded.result(), list(bm25)
+            )
+        else:
+            retrieved = self.executor.submit(
+                _timed, timings, "semantic", self.__retrieve, query, candidates
+            )
+            bm25 = keyword.result()
+            semantic = retrieved.result()
+
+        def fuse() -> list[tuple[int, float]]:
+            if fusion == "rrf":
+                scores = reciprocal_rank_fusion([list(bm25), list(semantic)])
+            else:
+                scores = weighted_fusion([bm25, semantic], [alpha, 1 - alpha])
+            ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+            return ranked[:limit]
+
+        results = _timed(timings, "fusion", fuse)
+        timings["total"] = (time.perf_counter() - start) * 1000
+        return results, timings
+
+    def close(self) -> None:
+        self.executor.shutdown()
+
+    def __embed(self, query: str) -> np.ndarray:
+        return embeddings.normalize(self.semantic.embed_queries([query]))[0]
+
+    def __retrieve(self, query: str, candidates: int) -> dict[int, float]:
+        [hits] = self.semantic.search([query], candidates)
+        return dict(hits)
+
+    def __rescore(self, query: np.ndarray, doc_ids: list[int]) -> dict[int, float]:
+        # cosine similarity of the candidates only, best first; candidates
+        # without an embedding are left out
+        store = self.semantic.store
+        rows = store.rows(np.array(doc_ids, dtype=np.int64))
+        found = rows >= 0
+        order = np.argsort(rows[found])
+        rows, ids = rows[found][order], np.array(doc_ids)[found][order]
+        scores = store.vectors[rows] @ query
+        ranked = np.lexsort((ids, -scores))
+        return {int(ids[i]): float(scores[i]) for i in ranked}
+
+
+def _timed(timings: dict[str, float], stage: str, run: Callable, *args):
+    start = time.perf_counter()
+    try:
+        return run(*args)
+    finally:
+        timings[stage] = (time.perf_counter() - start) * 1000
+
+
+def hybrid_search(
+    query: str,
+    limit: int,
+    fusion: str = "rrf",
+    alpha: float = HYBRID_ALPHA,
+    candidates: int = HYBRID_CANDIDATES,
+    rerank: bool = False,
+) -> None:
+    # answered by the search daemon if one is running
+    payload = {
+        "query": query,
+        "limit": limit,
+        "fusion": fusion,
+        "alpha": alpha,
+        "candidates": candidates,
+        "rerank": rerank,
+    }
+    response = client.request("/hybrid", payload)
+    if response is not None:
+        results = [
+            (hit["id"], hit["title"], hit["score"]) for hit in response["results"]
+        ]
+        print_hybrid_results(results, response["timings"])
+        print_daemon_latency(response)
+        return
+
+    if not load_index():
+        return
+
+    cache = EmbeddingCache()
+    hybrid = HybridSearch(search_index, SemanticSearch(TRANSFORMER_MODEL, cache))
+    try:
+        hits, timings = hybrid.search(query, limit, fusion, alpha, candidates, rerank)
+    except (FileNotFoundError, ValueError) as err:
+        print(err)
+        return
+    finally:
+        hybrid.close()
+        cache.close()
+
+    titles = search_index.hydrate(doc_id for doc_id, _ in hits)
+    results = [
+        (doc_id, hit["title"], score) for (doc_id, score), hit in zip(hits, titles)
+    ]
+    print_hybrid_results(results, timings)
+
+
+def print_hybrid_results(
+    results: list[tuple[int, str, float]], timings: dict[str, float]
+) -> None:
+    if not results:
+        print("Nothing found")
+    else:
+        print_search_results(results, bm25=True)
+
+    print(" | ".join(f"{stage} {ms:.1f} ms" for stage, ms in timings.items()))
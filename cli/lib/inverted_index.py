@@ -1,55 +1,262 @@
+import heapq
 import math
 import pickle
-from collections import Counter, defaultdict
+import re
+import tempfile
+import warnings
+from array import array
+from bisect import bisect_left
+from collections import Counter, defaultdict, deque
+from collections.abc import Callable, Iterable, Iterator, Sequence
+from concurrent.futures import ProcessPoolExecutor
+from itertools import batched, pairwise, takewhile
+from pathlib import Path
+from typing import TYPE_CHECKING
 
 from config import (
+    BM25_B,
+    BM25_ENGINE,
+    BM25_ENGINES,
+    BM25_IMPACT_PARAMS_CACHED,
+    BM25_K1,
+    BUILD_BATCH_DOCS,
+    BUILD_MEMORY_BUDGET,
+    BUILD_PENDING_BATCHES_PER_WORKER,
+    CACHE_BUILD_FILE,
     CACHE_DIR,
     CACHE_DOC_LENGTH_FILE,
     CACHE_DOCMAP_FILE,
     CACHE_INDEX_FILE,
+    CACHE_MANIFEST_FILE,
+    CACHE_SEGMENT_FILE,
+    CACHE_STEMS_FILE,
     CACHE_TF_FILE,
+    PROXIMITY_DEPTH,
+    STEM_TABLE_MAX_WORDS,
 )
-from lib.tokenize import tokenize_single_str, tokenize_str
-from lib.utils import load_movies
+from lib import boolean_query, trace
+from lib.boolean_query import AndCursor, Cursor, FilterCursor, OrCursor, OrdinalCursor
+from lib.postings import IMPACT_TYPE, Postings, PostingsBuilder
+from lib.segment import Segment, StoredDocuments
+from lib.segment_set import (
+    SegmentSet,
+    SegmentSetDocuments,
+    SegmentSetPostings,
+    TieredMergePolicy,
+)
+from lib.spill import RunMerger, SpillingBuilder
+from lib.stem_table import StemTable
+from lib.tokenize import get_tokenizer, tokenize_single_str, tokenize_str
+from lib.top_k import TermCursor, max_score_top_k
+from lib.utils import document_text, iter_movies
+
+if TYPE_CHECKING:
+    from lib.sparse_bm25 import SparseBM25
 
 
 class InvertedIndex:
     def __init__(self) -> None:
-        self.index: dict[str, set[int]] = defaultdict(set)
-        self.docmap: dict[int, dict] = {}
-        self.term_frequencies: dict[int, Counter[str]] = defaultdict(Counter)
-        self.doc_length: dict[int, int] = {}
-
-    def __add_document(self, doc_id: int, text: str) -> None:
-        tokens = tokenize_str(text)
-        self.doc_length[doc_id] = len(tokens)
-
-        for token in tokens:
-            self.term_frequencies[doc_id][token] += 1
-            self.index[token].add(doc_id)
-
-    def get_documents(self, term: str) -> list[int]:
-        documents_set: set[int] = set()
-        query_tokens = tokenize_str(term)
-
-        for token in set(query_tokens):
-            documents_set |= self.index.get(token, set())
-
-        return sorted(documents_set)
+        self.postings: Postings | SegmentSetPostings = Postings.empty()
+        self.docmap: dict[int, dict] | StoredDocuments | SegmentSetDocuments = {}
+        self.avg_doc_length: float = 0.0
+
+        # the saved index, and changes not yet committed to it
+        self.segments: SegmentSet | None = None
+        self.built_segment: Path | None = None
+        self.pending_docs: dict[int, dict] = {}
+        self.pending_deletes: set[int] = set()
+        # word -> stem of the built vocabulary, until saved
+        self.stems: dict[str, str] = {}
+
+        # BM25 impacts for the last BM25_IMPACT_PARAMS_CACHED non-default
+        # (k1, b) pairs, parallel to the token's postings; the default pair is
+        # stored in the postings themselves
+        # (k1, b) -> token -> array of idf * bm25_tf
+        self.bm25_impacts: dict[tuple[float, float], dict[str, array]] = {}
+
+    @property
+    def generation(self) -> int | None:
+        # of the saved index searched; None for an unsaved or pickled index
+        return None if self.segments is None else self.segments.generation
+
+    @property
+    def index_id(self) -> str | None:
+        # random id of the saved index, which tells a rebuilt index apart from
+        # an older one at the same generation
+        return None if self.segments is None else self.segments.index_id
+
+    def iter_documents(self, query: str) -> Iterator[int]:
+        """Doc ids matching the boolean `query`, lazily in ascending order.
+
+        Words side by side match any of them; AND, OR, NOT, parentheses,
+        quoted phrases and title:/description: prefixes narrow that down (see
+        `lib.boolean_query`). Matches are only searched for as they are
+        consumed, so taking the first few stops early.
+        """
+        with trace.span("boolean.parse"):
+            node = boolean_query.parse(query)
+        if node is None:
+            return
+
+        # ordinals only ascend with doc ids within a segment, so every
+        # segment's matches are walked by a cursor of their own and merged
+        doc_ids = self.postings.doc_ids
+        titles: dict[int, list[str]] = {}
+        phrases: dict[tuple[str, ...], dict[int, set[int]]] = {}
+        runs = []
+        for start, end in pairwise(self.__segment_bases()):
+            with trace.span("boolean.lookup"):
+                cursor = self.__compile(node, titles, phrases)
+            if cursor is None:
+                return
+            matches = boolean_query.matches(cursor, start)
+            runs.append(
+                doc_ids[ordinal]
+                for ordinal in takewhile(
+                    lambda ordinal, end=end: ordinal < end, matches
+                )
+            )
+        yield from runs[0] if len(runs) == 1 else heapq.merge(*runs)
+
+    def get_documents(self, query: str) -> list[int]:
+        # all matches at once, e.g. for benchmarks; the same order as
+        # iter_documents
+        with trace.span("boolean.parse"):
+            node = boolean_query.parse(query)
+        if node is None:
+            return []
+
+        with trace.span("boolean.lookup"):
+            cursor = self.__compile(node, {}, {})
+        if cursor is None:
+            return []
+
+        doc_ids = self.postings.doc_ids
+        found = [doc_ids[ordinal] for ordinal in boolean_query.collect(cursor)]
+        if len(self.__segment_bases()) > 2:
+            found.sort()  # ascending runs, one per segment
+        return found
+
+    def __segment_bases(self) -> Sequence[int]:
+        # the first ordinal of every segment, and the ordinal after the last
+        if isinstance(self.postings, SegmentSetPostings):
+            return self.postings.bases
+        return [0, len(self.postings.doc_ids)]
+
+    def __compile(
+        self,
+        node: boolean_query.Node,
+        titles: dict[int, list[str]],
+        phrases: dict[tuple[str, ...], dict[int, set[int]]],
+    ) -> Cursor | None:
+        # None for parts without indexed words (e.g. only stop words), which
+        # are left out of the query; `titles` and `phrases` keep the title
+        # tokens and phrase starts found, for compiling the query again
+        if isinstance(node, boolean_query.Term):
+            return self.__term_cursor(node, titles, phrases)
+
+        if isinstance(node, boolean_query.Or):
+            children = [
+                self.__compile(child, titles, phrases) for child in node.children
+            ]
+            children = [child for child in children if child is not None]
+            if len(children) < 2:
+                return children[0] if children else None
+            return OrCursor(children)
+
+        # AND, or a NOT on its own: negated children exclude documents from
+        # the others, or from all documents
+        included: list[Cursor] = []
+        excluded: list[Cursor] = []
+        for child in node.children if isinstance(node, boolean_query.And) else [node]:
+            if isinstance(child, boolean_query.Not):
+                cursor = self.__compile(child.child, titles, phrases)
+                if cursor is not None:
+                    excluded.append(cursor)
+            elif (cursor := self.__compile(child, titles, phrases)) is not None:
+                included.append(cursor)
+
+        if not excluded:
+            if len(included) < 2:
+                return included[0] if included else None
+            return AndCursor(included, [])
+        if not included:
+            included.append(OrdinalCursor(self.postings.live_ordinals))
+        return AndCursor(included, excluded)
+
+    def __term_cursor(
+        self,
+        term: boolean_query.Term,
+        titles: dict[int, list[str]],
+        phrases: dict[tuple[str, ...], dict[int, set[int]]],
+    ) -> Cursor | None:
+        tokens = tokenize_str(term.text)
+        if not tokens:
+            return None
+
+        if term.phrase and len(tokens) > 1:
+            key = tuple(tokens)
+            if key not in phrases:
+                phrases[key] = self.phrase_starts(tokens)
+            starts = phrases[key]
+            cursor = OrdinalCursor(list(starts))
+            if term.field is None:
+                return cursor
+
+            # the title's tokens come first in a document, at positions
+            # 0..len(title) - 1
+            def in_field(ordinal: int) -> bool:
+                title_length = len(self.__title_tokens(ordinal, titles))
+                if term.field == "title":
+                    return min(starts[ordinal]) + len(tokens) <= title_length
+                return max(starts[ordinal]) >= title_length
+
+            return FilterCursor(cursor, in_field)
+
+        # a word, or a one word phrase: any of its tokens
+        cursors: list[Cursor] = []
+        for token in dict.fromkeys(tokens):
+            cursor = OrdinalCursor(self.postings.lookup(token)[0])
+            if term.field is not None:
+                cursor = FilterCursor(
+                    cursor, self.__field_check(token, term.field, titles)
+                )
+            cursors.append(cursor)
+        return cursors[0] if len(cursors) == 1 else OrCursor(cursors)
+
+    def __field_check(
+        self, token: str, field: str, titles: dict[int, list[str]]
+    ) -> Callable[[int], bool]:
+        # the index has a single field, so title occurrences are told apart
+        # by the stored title; the rest of the term frequency is description
+        def in_field(ordinal: int) -> bool:
+            in_title = self.__title_tokens(ordinal, titles).count(token)
+            if field == "title":
+                return in_title > 0
+            return self.postings.get_tf(ordinal, token) > in_title
+
+        return in_field
+
+    def __title_tokens(self, ordinal: int, titles: dict[int, list[str]]) -> list[str]:
+        if ordinal not in titles:
+            trace.count("title_checks")
+            doc_id = self.postings.doc_ids[ordinal]
+            titles[ordinal] = tokenize_str(self.hydrate([doc_id])[0].get("title", ""))
+        return titles[ordinal]
 
     def get_tf(self, doc_id: int, term: str) -> int:
         token = tokenize_single_str(term)
-        document_counters = self.term_frequencies.get(doc_id)
+        ordinal = self.postings.ordinal(doc_id)
 
-        if document_counters is None:
+        if ordinal is None:
             return 0
 
-        return document_counters.get(token, 0)
+        return self.postings.get_tf(ordinal, token)
 
     def get_idf(self, term: str) -> float:
         token = tokenize_single_str(term)
-        total_doc_count = len(self.docmap)
-        term_match_doc_count = len(self.index[token])
+        total_doc_count = self.postings.doc_count
+        term_match_doc_count = self.postings.document_frequency(token)
 
         return math.log((total_doc_count + 1) / (term_match_doc_count + 1))
 
@@ -62,9 +269,9 @@ class InvertedIndex:
     def get_bm25_tf(self, doc_id: int, term: str, k1: float, b: float) -> float:
         tf = self.get_tf(doc_id, term)
 
-        doc_len = self.doc_length.get(doc_id, 0)
-        avg_doc_len = self.__get_avg_doc_length()
-        len_norm = 1 - b + b * (doc_len / avg_doc_len)
+        ordinal = self.postings.ordinal(doc_id)
+        doc_len = 0 if ordinal is None else self.postings.doc_lengths[ordinal]
+        len_norm = 1 - b + b * (doc_len / self.avg_doc_length)
 
         # BM25 Algorithm:
         # tf -> total number of terms in doc
@@ -77,21 +284,11 @@ class InvertedIndex:
 
     def get_bm25_idf(self, term: str) -> float:
         token = tokenize_single_str(term)
-        total_doc_count = len(self.docmap)
-        term_match_doc_count = len(self.index[token])
+        return self.__get_bm25_idf_for_token(token)
 
-        # BM25 Algorithm:
-        # N -> total number of docs
-        # df -> docs with the term
-        # (N - df) -> docs without term
-        # 0.5 -> laplace smoothing
-        # 1 -> ensures idf is always positve; handles edge cases
-        # log((N - df + 0.5) / (df + 0.5) + 1)
-
-        return math.log(
-            (total_doc_count - term_match_doc_count + 0.5)
-            / (term_match_doc_count + 0.5)
-            + 1
+    def __get_bm25_idf_for_token(self, token: str) -> float:
+        return _bm25_idf(
+            self.postings.doc_count, self.postings.document_frequency(token)
         )
 
     def get_bm25_score(self, doc_id: int, term: str, k1: float, b: float) -> float:
@@ -99,54 +296,534 @@ class InvertedIndex:
         idf = self.get_bm25_idf(term)
         return tf * idf
 
+    def get_bm25_impacts(self, token: str, k1: float, b: float) -> Sequence[float]:
+        if self.postings.impact_params == (k1, b):
+            return self.postings.lookup_impacts(token)
+
+        impacts = self.bm25_impacts.get((k1, b))
+        if impacts is None:
+            # daemon clients may ask for any pair, so only the latest are kept;
+            # replaced rather than changed, for threads reading the old one
+            impacts = {}
+            pairs = list(self.bm25_impacts.items())
+            pairs = pairs[max(0, len(pairs) + 1 - BM25_IMPACT_PARAMS_CACHED) :]
+            self.bm25_impacts = dict([*pairs, ((k1, b), impacts)])
+
+        token_impacts = impacts.get(token)
+
+        if token_impacts is None:
+            token_impacts = self.__compute_bm25_impacts(token, k1, b)
+            impacts[token] = token_impacts
+
+        return token_impacts
+
+    def get_bm25_max_impact(self, token: str, k1: float, b: float) -> float:
+        # upper bound of the token's contribution to any document's score
+        if self.postings.impact_params == (k1, b):
+            return self.postings.max_impact(token)
+
+        return max(self.get_bm25_impacts(token, k1, b), default=0.0)
+
+    def __compute_bm25_impacts(self, token: str, k1: float, b: float) -> array:
+        ordinals, tfs = self.postings.lookup(token)
+        return _bm25_impacts(
+            ordinals,
+            tfs,
+            self.postings.doc_lengths,
+            self.__get_bm25_idf_for_token(token),
+            self.avg_doc_length,
+            k1,
+            b,
+        )
+
     def bm25_search(
+        self,
+        query: str,
+        limit: int,
+        k1: float,
+        b: float,
+        proximity: float = 0.0,
+        engine: str = BM25_ENGINE,
+    ) -> dict[int, float]:
+        """Top BM25 hits of all query words.
+
+        Quoted phrases must occur in a hit as they are; an index without
+        positions warns and scores their words like the others. With
+        `proximity`, the top PROXIMITY_DEPTH hits get a boost of `proximity`
+        / distance for every pair of adjacent query words. `engine` is one
+        of BM25_ENGINES; both find the same hits and scores.
+        """
+        with trace.span("bm25.tokenize"):
+            tokens, phrases = bm25_query_tokens(query)
+
+        depth = max(limit, PROXIMITY_DEPTH) if proximity else limit
+        top = self.__top_k_phrases(tokens, phrases, depth, k1, b, engine)
+
+        if proximity:
+            with trace.span("bm25.proximity"):
+                top = self.__proximity_rerank(tokens, top, proximity)
+
+        doc_ids = self.postings.doc_ids
+        return {doc_ids[ordinal]: score for ordinal, score in top[:limit]}
+
+    def bm25_search_tokens(
+        self,
+        tokens: Sequence[str],
+        limit: int,
+        k1: float,
+        b: float,
+        engine: str = BM25_ENGINE,
+    ) -> dict[int, float]:
+        doc_ids = self.postings.doc_ids
+        top = self.__top_k(tokens, limit, k1, b, engine)
+        return {doc_ids[ordinal]: score for ordinal, score in top}
+
+    def bm25_search_tokens_many(
+        self,
+        queries: Sequence[Sequence[str]],
+        limit: int,
+        k1: float,
+        b: float,
+        engine: str = BM25_ENGINE,
+        phrases: Sequence[Sequence[Sequence[str]]] | None = None,
+    ) -> list[dict[int, float]]:
+        # `phrases` are those of each query, as bm25_query_tokens splits them;
+        # the sparse engine scores the queries without any in a few matrix
+        # products
+        if phrases is None:
+            phrases = [[] for _ in queries]
+        tops: list[list[tuple[int, float]] | None] = [
+            self.__top_k_phrases(tokens, query_phrases, limit, k1, b, engine)
+            if query_phrases or engine != "sparse"
+            else None
+            for tokens, query_phrases in zip(queries, phrases)
+        ]
+        batch = [i for i, top in enumerate(tops) if top is None]
+        if batch:
+            batch_tops = self.__sparse_engine(k1, b).top_k_many(
+                [queries[i] for i in batch], limit
+            )
+            for i, top in zip(batch, batch_tops):
+                tops[i] = top
+
+        doc_ids = self.postings.doc_ids
+        return [{doc_ids[ordinal]: score for ordinal, score in top} for top in tops]
+
+    def __sparse_engine(self, k1: float, b: float) -> "SparseBM25":
+        # numpy is only imported by searches that use it
+        from lib.sparse_bm25 import SparseBM25
+
+        return SparseBM25(
+            self.postings, lambda token: self.get_bm25_impacts(token, k1, b)
+        )
+
+    def __top_k_phrases(
+        self,
+        tokens: Sequence[str],
+        phrases: Sequence[Sequence[str]],
+        limit: int,
+        k1: float,
+        b: float,
+        engine: str = BM25_ENGINE,
+    ) -> list[tuple[int, float]]:
+        # the top hits of `tokens` among the documents with all `phrases`
+        if phrases and not self.postings.positional:
+            warnings.warn(
+                "The index has no token positions, so quoted phrases are"
+                " searched as words; rebuild it with 'build --positions'",
+                stacklevel=3,
+            )
+            phrases = []
+        if not phrases:
+            return self.__top_k(tokens, limit, k1, b, engine)
+
+        with trace.span("bm25.phrase"):
+            candidates = self.phrase_ordinals(phrases[0])
+            for phrase in phrases[1:]:
+                candidates = _intersect(candidates, self.phrase_ordinals(phrase))
+        with trace.span("bm25.score"):
+            return self.__score_ordinals(tokens, candidates, limit, k1, b)
+
+    def __top_k(
+        self,
+        tokens: Sequence[str],
+        limit: int,
+        k1: float,
+        b: float,
+        engine: str = BM25_ENGINE,
+    ) -> list[tuple[int, float]]:
+        if engine not in BM25_ENGINES:
+            raise ValueError(
+                f"Unknown BM25 engine '{engine}' (one of {', '.join(BM25_ENGINES)})"
+            )
+        if engine == "sparse":
+            return self.__sparse_engine(k1, b).top_k(tokens, limit)
+
+        # one cursor per distinct token, walked document-at-a-time with
+        # MaxScore pruning instead of scoring every matching document
+        term_indexes: dict[str, int] = {}
+        query_terms = [
+            term_indexes.setdefault(token, len(term_indexes)) for token in tokens
+        ]
+
+        cursors: list[TermCursor] = []
+        with trace.span("bm25.lookup"):
+            for token, term_index in term_indexes.items():
+                ordinals, _ = self.postings.lookup(token)
+                if not len(ordinals):
+                    continue
+
+                cursors.append(
+                    TermCursor(
+                        term_index,
+                        ordinals,
+                        self.get_bm25_impacts(token, k1, b),
+                        self.get_bm25_max_impact(token, k1, b),
+                        query_terms.count(term_index),
+                    )
+                )
+        trace.count("postings_scanned", sum(cursor.size for cursor in cursors))
+
+        with trace.span("bm25.score"):
+            return max_score_top_k(cursors, query_terms, limit)
+
+    def __score_ordinals(
+        self,
+        tokens: Sequence[str],
+        ordinals: Sequence[int],
+        limit: int,
+        k1: float,
+        b: float,
+    ) -> list[tuple[int, float]]:
+        # exhaustive BM25 of the given documents, e.g. the matches of a phrase;
+        # summed in query order like max_score_top_k
+        impacts: dict[str, list[float]] = {}
+        for token in set(tokens):
+            token_ordinals, _ = self.postings.lookup(token)
+            token_impacts = self.get_bm25_impacts(token, k1, b)
+            found = impacts[token] = []
+            lo = 0
+            for ordinal in ordinals:
+                lo = bisect_left(token_ordinals, ordinal, lo)
+                if lo < len(token_ordinals) and token_ordinals[lo] == ordinal:
+                    found.append(token_impacts[lo])
+                else:
+                    found.append(0.0)
+        trace.count("documents_scored", len(ordinals))
+
+        scored = []
+        for i, ordinal in enumerate(ordinals):
+            score = 0.0
+            for token in tokens:
+                score += impacts[token][i]
+            scored.append((ordinal, score))
+
+        return heapq.nsmallest(limit, scored, key=lambda hit: (-hit[1], hit[0]))
+
+    def __require_positions(self) -> None:
+        if not self.postings.positional:
+            raise ValueError(
+                "Phrase and proximity queries need token positions,"
+                " rebuild the index with 'build --positions'"
+            )
+
+    def phrase_ordinals(self, tokens: Sequence[str]) -> list[int]:
+        """Sorted ordinals of the documents with `tokens` at consecutive positions."""
+        self.__require_positions()
+        if len(tokens) == 1:
+            return list(self.postings.lookup(tokens[0])[0])
+        return list(self.phrase_starts(tokens))
+
+    def phrase_starts(self, tokens: Sequence[str]) -> dict[int, set[int]]:
+        """Ordinal -> positions where `tokens` start consecutively, by ordinal.
+
+        Candidates must contain every token, intersected from the rarest
+        token's postings on; only their positions get decoded.
+        """
+        self.__require_positions()
+        distinct = sorted(set(tokens), key=self.postings.document_frequency)
+        candidates: Sequence[int] = self.postings.lookup(distinct[0])[0]
+        for token in distinct[1:]:
+            if not candidates:
+                break
+            candidates = _intersect(candidates, self.postings.lookup(token)[0])
+        trace.count("phrase_candidates", len(candidates))
+
+        # candidate -> positions where the phrase could start, narrowed
+        # token by token
+        starts = {
+            ordinal: set(positions)
+            for ordinal, positions in zip(
+                candidates, self.postings.positions_in(tokens[0], candidates)
+            )
+        }
+        for offset in range(1, len(tokens)):
+            alive = list(starts)
+            narrowed = {}
+            for ordinal, positions in zip(
+                alive, self.postings.positions_in(tokens[offset], alive)
+            ):
+                found = starts[ordinal].intersection(
+                    position - offset for position in positions
+                )
+                if found:
+                    narrowed[ordinal] = found
+            starts = narrowed
+
+        return starts
+
+    def __proximity_rerank(
+        self, tokens: Sequence[str], top: list[tuple[int, float]], weight: float
+    ) -> list[tuple[int, float]]:
+        self.__require_positions()
+        # a word next to itself is always at distance 0, and not boosted
+        pairs = [(a, b) for a, b in pairwise(tokens) if a != b]
+        ordinals = sorted(ordinal for ordinal, _ in top)
+        positions = {
+            token: dict(zip(ordinals, self.postings.positions_in(token, ordinals)))
+            for token in set(tokens)
+        }
+
+        boosted = []
+        for ordinal, score in top:
+            for a, b in pairs:
+                distance = _min_distance(positions[a][ordinal], positions[b][ordinal])
+                if distance:
+                    score += weight / distance
+            boosted.append((ordinal, score))
+
+        boosted.sort(key=lambda hit: (-hit[1], hit[0]))
+        return boosted
+
+    def bm25_search_exhaustive(
         self, query: str, limit: int, k1: float, b: float
     ) -> dict[int, float]:
+        # reference implementation: scores every matching document
         tokens = tokenize_str(query)
 
-        # calculate bm25 scores for each token and each document
+        # accumulate precomputed bm25 impacts for each token and each document
         scores: dict[int, float] = defaultdict(float)
 
         for token in tokens:
-            
-            for doc_id in self.index.get(token, []):
-                scores[doc_id] += self.get_bm25_score(doc_id, token, k1, b)
+            ordinals, _ = self.postings.lookup(token)
+            for ordinal, impact in zip(ordinals, self.get_bm25_impacts(token, k1, b)):
+                scores[ordinal] += impact
+
+        # sort by descending score, ties by ascending doc id; no hits for a
+        # limit below 1, like max_score_top_k
+        sorted_scores = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+
+        doc_ids = self.postings.doc_ids
+        top = sorted_scores[: max(limit, 0)]
+        return {doc_ids[ordinal]: score for ordinal, score in top}
+
+    def hydrate(
+        self, doc_ids: Iterable[int], fields: Sequence[str] = ("title",)
+    ) -> list[dict]:
+        """The given fields of each document, {} for documents not indexed.
+
+        Meant for the few hits of a query: stored documents read titles from
+        their own column and decompress a block only for other fields.
+        """
+        documents = self.docmap
+        hydrated = []
+        for doc_id in doc_ids:
+            try:
+                if isinstance(documents, dict):
+                    # an unsaved build or a pickle cache, all in memory
+                    movie = documents[doc_id]
+                    hydrated.append({f: movie[f] for f in fields if f in movie})
+                else:
+                    hydrated.append(documents.project(doc_id, fields))
+            except KeyError:
+                hydrated.append({})
+        return hydrated
+
+    def __update_corpus_stats(self) -> None:
+        if not self.postings.doc_count:
+            self.avg_doc_length = 0.0
+        else:
+            self.avg_doc_length = (
+                self.postings.total_doc_length / self.postings.doc_count
+            )
 
-        # sort values of dict in descending order
-        sorted_scores = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        # impacts depend on N, df and avgdl, so they are stale now
+        self.bm25_impacts = {}
+
+    def build(
+        self,
+        workers: int = 1,
+        memory_budget: int = BUILD_MEMORY_BUDGET,
+        positions: bool = False,
+    ) -> None:
+        # the corpus is streamed in batches; once the inverted batches exceed
+        # the memory budget they are spilled to sorted runs on disk
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        self.segments = None  # until the build is saved
+        with tempfile.TemporaryDirectory(dir=CACHE_DIR) as run_dir:
+            builder = SpillingBuilder(Path(run_dir), memory_budget)
+            self.stems = {}
+            with trace.span("build.invert"):
+                for (postings, stems), movies in _invert_batches(
+                    iter_movies(), workers, positions
+                ):
+                    builder.add(postings, movies)
+                    if len(self.stems) < STEM_TABLE_MAX_WORDS:
+                        self.stems.update(stems)
+                    trace.count("documents_indexed", len(movies))
+
+            if not builder.runs:
+                with trace.span("build.merge"):
+                    self.postings = builder.merged()
+                    self.docmap = builder.documents
+                    self.built_segment = None
+                    self.__update_corpus_stats()
+                with trace.span("build.impacts"):
+                    self.__precompute_bm25_impacts(BM25_K1, BM25_B)
+                return
+
+            with trace.span("build.merge"):
+                builder.spill()
+                trace.count("runs_spilled", len(builder.runs))
+                self.__merge_runs(RunMerger(builder.runs), BM25_K1, BM25_B)
+
+        segment = Segment(CACHE_BUILD_FILE)
+        self.postings = segment.postings
+        self.docmap = segment.documents
+        self.built_segment = CACHE_BUILD_FILE
+        self.__update_corpus_stats()
+
+    def __merge_runs(self, merger: RunMerger, k1: float, b: float) -> None:
+        # impacts are computed while merging, from the whole corpus' stats
+        doc_count = merger.doc_count
+        avg_doc_len = merger.total_doc_length / doc_count
+
+        def impacts(ordinals: Sequence[int], tfs: Sequence[int]) -> array:
+            idf = _bm25_idf(doc_count, len(ordinals))
+            return _bm25_impacts(
+                ordinals, tfs, merger.doc_lengths, idf, avg_doc_len, k1, b
+            )
 
-        return dict(sorted_scores[:limit])
+        merger.write(CACHE_BUILD_FILE, impacts, (k1, b))
 
-    def __get_avg_doc_length(self) -> float:
-        if not self.doc_length:
-            return 0
+    def __precompute_bm25_impacts(self, k1: float, b: float) -> None:
+        # one impact per posting, stored alongside the postings so they get saved
+        impacts = array(IMPACT_TYPE)
+        max_impacts = array(IMPACT_TYPE)
 
-        return sum(self.doc_length.values()) / len(self.doc_length)
+        # term ids follow sorted term order, and so do the postings slices
+        for token in sorted(self.postings.terms):
+            token_impacts = self.__compute_bm25_impacts(token, k1, b)
+            impacts.extend(token_impacts)
+            max_impacts.append(max(token_impacts, default=0.0))
 
-    def build(self) -> None:
-        for movie in load_movies():
-            key = f"{movie['title']} {movie['description']}"
-            self.__add_document(movie["id"], key)
-            self.docmap[movie["id"]] = movie
+        self.postings.impacts = impacts
+        self.postings.max_impacts = max_impacts
+        self.postings.impact_params = (k1, b)
 
-    def save(self) -> None:
-        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    def add_document(self, movie: dict) -> None:
+        doc_id = movie["id"]
+        if doc_id in self.pending_docs or self.__is_committed(doc_id):
+            raise ValueError(f"Document {doc_id} is already indexed")
 
-        with open(CACHE_INDEX_FILE, "wb") as f:
-            pickle.dump(dict(self.index), f)  # convert default dict to nomal dict
+        self.pending_docs[doc_id] = movie
 
-        with open(CACHE_DOCMAP_FILE, "wb") as f:
-            pickle.dump(self.docmap, f)
+    def update_document(self, movie: dict) -> None:
+        self.delete_document(movie["id"])
+        self.pending_docs[movie["id"]] = movie
 
-        with open(CACHE_TF_FILE, "wb") as f:
-            pickle.dump(
-                dict(self.term_frequencies), f
-            )  # convert default dict to nomal dict
+    def delete_document(self, doc_id: int) -> None:
+        committed = self.__is_committed(doc_id)
+        if doc_id not in self.pending_docs and not committed:
+            raise ValueError(f"Document {doc_id} is not indexed")
 
-        with open(CACHE_DOC_LENGTH_FILE, "wb") as f:
-            pickle.dump(self.doc_length, f)
+        self.pending_docs.pop(doc_id, None)
+        if committed:
+            self.pending_deletes.add(doc_id)
+
+    def __is_committed(self, doc_id: int) -> bool:
+        return (
+            doc_id not in self.pending_deletes
+            and self.postings.ordinal(doc_id) is not None
+        )
+
+    def commit(self, policy: TieredMergePolicy | None = None) -> None:
+        # pending additions become a small delta segment, deletions become
+        # tombstones; then the merge policy compacts the segments if due
+        if self.segments is None:
+            raise ValueError("The index must be saved before changes are committed")
+
+        delta, _ = _build_shard(
+            _batch_docs(self.pending_docs.values()), self.postings.positional
+        )
+        get_tokenizer().stop_collecting_stems()
+        with self.segments.writing():
+            self.segments.commit(delta, self.pending_docs, self.pending_deletes)
+            self.pending_docs = {}
+            self.pending_deletes = set()
+
+            self.segments.apply_merges(policy or TieredMergePolicy())
+        self.__open_segments(self.segments)
+
+    def merge(self, full: bool = False) -> None:
+        if self.segments is None:
+            raise ValueError("The index must be saved before it can be merged")
+
+        if not full:
+            self.segments.apply_merges(TieredMergePolicy())
+            self.__open_segments(self.segments)
+            return
+
+        # a single segment again, with the default BM25 impacts stored; no
+        # other process may commit until it replaced the merged segments
+        with self.segments.writing():
+            # the documents too may have changed since the index was loaded
+            self.docmap = self.segments.documents
+            self.postings = Postings.merge(self.segments.parts())
+            self.__update_corpus_stats()
+            self.__precompute_bm25_impacts(BM25_K1, BM25_B)
+            self.save()
+
+    def save(self) -> None:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        with trace.span("index.save"):
+            if self.built_segment is not None:
+                # the build already wrote the segment
+                self.segments = SegmentSet.install(
+                    CACHE_MANIFEST_FILE, self.built_segment
+                )
+                self.built_segment = None
+            else:
+                self.segments = SegmentSet.create(
+                    CACHE_MANIFEST_FILE, self.postings, self.docmap
+                )
+            if self.stems:
+                StemTable.write(CACHE_STEMS_FILE, self.stems)
+                self.stems = {}
 
     def load(self) -> None:
+        with trace.span("index.load"):
+            if CACHE_MANIFEST_FILE.exists():
+                self.segments = SegmentSet.open(CACHE_MANIFEST_FILE)
+            elif CACHE_SEGMENT_FILE.exists():
+                self.segments = SegmentSet.from_segment(
+                    CACHE_MANIFEST_FILE, CACHE_SEGMENT_FILE
+                )
+            else:
+                raise FileNotFoundError(
+                    f"File not found: {CACHE_MANIFEST_FILE}"
+                    " (run 'build', or 'convert' for an old pickle cache)"
+                )
+
+            self.__open_segments(self.segments)
+
+    def __open_segments(self, segments: SegmentSet) -> None:
+        # postings and documents stay on disk and are paged in on access
+        self.postings = segments.postings
+        self.docmap = segments.documents
+        self.__update_corpus_stats()
+
+    def load_pickle_cache(self) -> None:
         if not CACHE_INDEX_FILE.exists() or not CACHE_DOCMAP_FILE.exists():
             raise FileNotFoundError(
                 f"Files not found: {CACHE_INDEX_FILE}, {CACHE_DOCMAP_FILE}"
@@ -154,16 +831,147 @@ class InvertedIndex:
 
         with open(CACHE_INDEX_FILE, "rb") as f:
             data = pickle.load(f)
-            self.index = defaultdict(set, data)  # reconvert dict back to default dict
+
+        if isinstance(data, Postings):
+            # pickled before postings had term ids: terms -> (start, length)
+            self.postings = Postings.from_term_slices(
+                data.terms, data.doc_ordinals, data.tfs, data.doc_ids, data.doc_lengths
+            )
+        else:
+            self.postings = self.__load_legacy_postings(data)
 
         with open(CACHE_DOCMAP_FILE, "rb") as f:
             self.docmap = pickle.load(f)
 
+        self.__update_corpus_stats()
+        self.__precompute_bm25_impacts(BM25_K1, BM25_B)
+
+    def __load_legacy_postings(self, index: dict[str, set[int]]) -> Postings:
+        # caches written before the columnar layout: set/Counter/dict pickles
         with open(CACHE_TF_FILE, "rb") as f:
-            data = pickle.load(f)
-            self.term_frequencies = defaultdict(
-                Counter, data
-            )  # reconvert dict back to default dict
+            term_frequencies: dict[int, Counter[str]] = pickle.load(f)
 
         with open(CACHE_DOC_LENGTH_FILE, "rb") as f:
-            self.doc_length = pickle.load(f)
+            doc_length: dict[int, int] = pickle.load(f)
+
+        return Postings.from_legacy(index, term_frequencies, doc_length)
+
+
+def _bm25_idf(doc_count: int, document_frequency: int) -> float:
+    # BM25 Algorithm:
+    # N -> total number of docs
+    # df -> docs with the term
+    # (N - df) -> docs without term
+    # 0.5 -> laplace smoothing
+    # 1 -> ensures idf is always positve; handles edge cases
+    # log((N - df + 0.5) / (df + 0.5) + 1)
+
+    return math.log(
+        (doc_count - document_frequency + 0.5) / (document_frequency + 0.5) + 1
+    )
+
+
+def _bm25_impacts(
+    ordinals: Iterable[int],
+    tfs: Iterable[int],
+    doc_lengths: Sequence[int],
+    idf: float,
+    avg_doc_len: float,
+    k1: float,
+    b: float,
+) -> array:
+    # same formula as get_bm25_score, but with idf and avgdl computed once
+    # per token instead of once per posting
+    token_impacts = array(IMPACT_TYPE)
+    for ordinal, tf in zip(ordinals, tfs):
+        len_norm = 1 - b + b * (doc_lengths[ordinal] / avg_doc_len)
+        token_impacts.append((tf * (k1 + 1)) / (tf + k1 * len_norm) * idf)
+
+    return token_impacts
+
+
+def _invert_batches(
+    movies: Iterable[dict], workers: int, positional: bool = False
+) -> Iterator[tuple[tuple[Postings, dict[str, str]], tuple[dict, ...]]]:
+    # inverted batches in corpus order; with several workers a bounded number
+    # of batches is queued ahead, so the stream is never read in full
+    batches = batched(movies, BUILD_BATCH_DOCS)
+    if workers <= 1:
+        try:
+            for batch in batches:
+                yield _build_shard(_batch_docs(batch), positional), batch
+        finally:
+            get_tokenizer().stop_collecting_stems()
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for batch in batches:
+            future = executor.submit(_build_shard, _batch_docs(batch), positional)
+            pending.append((future, batch))
+            if len(pending) >= workers * BUILD_PENDING_BATCHES_PER_WORKER:
+                future, done = pending.popleft()
+                yield future.result(), done
+
+        while pending:
+            future, done = pending.popleft()
+            yield future.result(), done
+
+
+def _batch_docs(movies: Iterable[dict]) -> list[tuple[int, str]]:
+    return [(movie["id"], document_text(movie)) for movie in movies]
+
+
+def _build_shard(
+    docs: list[tuple[int, str]], positional: bool = False
+) -> tuple[Postings, dict[str, str]]:
+    # module level so it can be pickled into worker processes; also returns
+    # the stems of the words this process had not stemmed before
+    tokenizer = get_tokenizer()
+    tokenizer.collect_stems()
+    builder = PostingsBuilder(positional)
+    texts = (text for _, text in docs)
+    for (doc_id, _), tokens in zip(docs, tokenizer.tokenize_many(texts)):
+        builder.add_tokens(doc_id, tokens)
+
+    return builder.build(), tokenizer.collect_stems()
+
+
+def bm25_query_tokens(query: str) -> tuple[list[str], list[list[str]]]:
+    # the tokens bm25_search scores, and those of each quoted phrase
+    phrases = [
+        phrase for phrase in map(tokenize_str, _split_phrases(query)[1]) if phrase
+    ]
+    return tokenize_str(query), phrases
+
+
+def _split_phrases(query: str) -> tuple[str, list[str]]:
+    # the query outside of double quotes, and the quoted phrases
+    phrases = re.findall(r'"([^"]*)"', query)
+    return re.sub(r'"[^"]*"', " ", query), phrases
+
+
+def _intersect(ordinals: Sequence[int], others: Sequence[int]) -> list[int]:
+    # both sorted; each match resumes the binary search where the last ended
+    found = []
+    lo = 0
+    for ordinal in ordinals:
+        lo = bisect_left(others, ordinal, lo)
+        if lo == len(others):
+            break
+        if others[lo] == ordinal:
+            found.append(ordinal)
+    return found
+
+
+def _min_distance(positions: Sequence[int], others: Sequence[int]) -> int:
+    # smallest gap from a position to a later one of `others`, both sorted;
+    # 0 if there is none, so pairs in reverse query order are not boosted
+    best = 0
+    i = 0
+    for other in others:
+        while i < len(positions) and positions[i] < other:
+            i += 1
+        if i and (not best or other - positions[i - 1] < best):
+            best = other - positions[i - 1]
+    return best
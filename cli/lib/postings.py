@@ -0,0 +1,515 @@
+import heapq
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from collections.abc import Buffer, Iterable, Iterator, Mapping, Sequence
+from collections.abc import Set as AbstractSet
+from itertools import accumulate, pairwise, repeat
+from operator import itemgetter
+
+# typecodes of the columnar buffers
+DOC_ID_TYPE = "q"  # signed 64 bit, movie ids as given in the corpus
+ORDINAL_TYPE = "I"  # unsigned 32 bit, dense internal doc number
+TF_TYPE = "I"
+DOC_LENGTH_TYPE = "I"
+IMPACT_TYPE = "d"
+OFFSET_TYPE = "Q"
+
+
+class Postings:
+    """Columnar postings lists.
+
+    Every term maps to a term id (terms are numbered in sorted order), and
+    ``postings_offsets[term_id:term_id + 2]`` is the term's slice of two
+    parallel buffers: the sorted internal doc ordinals and their term
+    frequencies. Ordinals are assigned in ascending doc id order, so
+    ``doc_ids[ordinal]`` is sorted and doubles as the doc id -> ordinal lookup
+    table (binary search).
+
+    The buffers are either in-memory arrays or zero-copy views into a
+    memory-mapped segment file (see `lib.segment`). Optionally a third buffer
+    parallel to the postings holds precomputed BM25 impacts for one
+    ``(k1, b)`` pair, and ``max_impacts[term_id]`` their per-term maximum.
+
+    Positional postings also have the token positions of every posting:
+    ``positions[position_offsets[i]:position_offsets[i + 1]]`` are those of
+    posting ``i``, encoded with `encode_positions`.
+    """
+
+    def __init__(
+        self,
+        terms: Mapping[str, int],
+        postings_offsets: Sequence[int],
+        doc_ordinals: Sequence[int],
+        tfs: Sequence[int],
+        doc_ids: Sequence[int],
+        doc_lengths: Sequence[int],
+        total_doc_length: int | None = None,
+        impacts: Sequence[float] | None = None,
+        max_impacts: Sequence[float] | None = None,
+        impact_params: tuple[float, float] | None = None,
+        position_offsets: Sequence[int] | None = None,
+        positions: Buffer | None = None,
+    ) -> None:
+        self.terms = terms
+        self.postings_offsets = postings_offsets
+        self.doc_ordinals = doc_ordinals
+        self.tfs = tfs
+        self.doc_ids = doc_ids
+        self.doc_lengths = doc_lengths
+        self.total_doc_length = (
+            sum(doc_lengths) if total_doc_length is None else total_doc_length
+        )
+        self.impacts = impacts
+        self.max_impacts = max_impacts
+        self.impact_params = impact_params
+        self.position_offsets = position_offsets
+        self.positions = positions
+
+    @classmethod
+    def empty(cls) -> "Postings":
+        return cls(
+            {},
+            array(OFFSET_TYPE, [0]),
+            array(ORDINAL_TYPE),
+            array(TF_TYPE),
+            array(DOC_ID_TYPE),
+            array(DOC_LENGTH_TYPE),
+        )
+
+    @classmethod
+    def from_legacy(
+        cls,
+        index: dict[str, set[int]],
+        term_frequencies: dict[int, Counter[str]],
+        doc_length: dict[int, int],
+    ) -> "Postings":
+        # rebuild from the dict/set/Counter layout of the old pickle caches
+        builder = PostingsBuilder()
+        for doc_id in sorted(doc_length):
+            builder.add_document(doc_id, term_frequencies.get(doc_id, Counter()))
+
+        postings = builder.build()
+        if sum(len(doc_ids) for doc_ids in index.values()) != len(postings.tfs):
+            raise ValueError(
+                "Inconsistent legacy cache: index and term frequencies differ"
+            )
+
+        return postings
+
+    @classmethod
+    def from_term_slices(
+        cls,
+        term_slices: Mapping[str, tuple[int, int]],
+        doc_ordinals: Sequence[int],
+        tfs: Sequence[int],
+        doc_ids: Sequence[int],
+        doc_lengths: Sequence[int],
+    ) -> "Postings":
+        # re-lay out postings addressed by (start, length) per term
+        terms: dict[str, int] = {}
+        postings_offsets = array(OFFSET_TYPE, [0])
+        new_ordinals = array(ORDINAL_TYPE)
+        new_tfs = array(TF_TYPE)
+
+        for term_id, token in enumerate(sorted(term_slices)):
+            start, length = term_slices[token]
+            terms[token] = term_id
+            new_ordinals.extend(doc_ordinals[start : start + length])
+            new_tfs.extend(tfs[start : start + length])
+            postings_offsets.append(len(new_ordinals))
+
+        return cls(
+            terms,
+            postings_offsets,
+            new_ordinals,
+            new_tfs,
+            array(DOC_ID_TYPE, doc_ids),
+            array(DOC_LENGTH_TYPE, doc_lengths),
+        )
+
+    @classmethod
+    def concat(cls, shards: Sequence["Postings"]) -> "Postings":
+        # shards hold disjoint doc id ranges in ascending order, so appending
+        # each term's postings shard by shard keeps them sorted
+        doc_ids = array(DOC_ID_TYPE)
+        doc_lengths = array(DOC_LENGTH_TYPE)
+        bases: list[int] = []
+        for shard in shards:
+            if len(doc_ids) and shard.doc_count and shard.doc_ids[0] <= doc_ids[-1]:
+                raise ValueError("Shards must cover ascending, disjoint doc ids")
+
+            bases.append(len(doc_ids))
+            doc_ids.extend(shard.doc_ids)
+            doc_lengths.extend(shard.doc_lengths)
+
+        terms: dict[str, int] = {}
+        postings_offsets = array(OFFSET_TYPE, [0])
+        doc_ordinals = array(ORDINAL_TYPE)
+        tfs = array(TF_TYPE)
+        positions = PositionsBuilder.of(shards)
+
+        tokens = sorted(set().union(*(shard.terms for shard in shards)))
+        for term_id, token in enumerate(tokens):
+            terms[token] = term_id
+            for shard, base in zip(shards, bases):
+                ordinals, shard_tfs = shard.lookup(token)
+                doc_ordinals.extend(ordinal + base for ordinal in ordinals)
+                tfs.extend(shard_tfs)
+                if positions is not None:
+                    positions.extend(shard.encoded_positions(token))
+            postings_offsets.append(len(doc_ordinals))
+
+        return cls(
+            terms,
+            postings_offsets,
+            doc_ordinals,
+            tfs,
+            doc_ids,
+            doc_lengths,
+            total_doc_length=sum(shard.total_doc_length for shard in shards),
+            **(positions.sections() if positions is not None else {}),
+        )
+
+    @classmethod
+    def merge(cls, parts: Sequence[tuple["Postings", AbstractSet[int]]]) -> "Postings":
+        # parts are (postings, deleted ordinals) in any doc id order; live
+        # documents are renumbered in doc id order and deleted ones dropped
+        nonempty = [postings for postings, _ in parts if postings.doc_count]
+        if not any(deleted for _, deleted in parts) and all(
+            prev.doc_ids[-1] < postings.doc_ids[0]
+            for prev, postings in pairwise(nonempty)
+        ):
+            return cls.concat([postings for postings, _ in parts])
+
+        # a part's ordinals follow its doc ids, and so do the new ordinals:
+        # every part's postings stay sorted when renumbered, and the parts
+        # are merged lazily, without materializing the postings of a term
+        live = heapq.merge(
+            *(
+                _live_documents(postings, deleted, part)
+                for part, (postings, deleted) in enumerate(parts)
+            )
+        )
+
+        remaps = [array("q", [-1]) * postings.doc_count for postings, _ in parts]
+        doc_ids = array(DOC_ID_TYPE)
+        doc_lengths = array(DOC_LENGTH_TYPE)
+        for new_ordinal, (doc_id, part, ordinal) in enumerate(live):
+            if len(doc_ids) and doc_ids[-1] == doc_id:
+                raise ValueError(f"Duplicate doc id {doc_id}")
+
+            remaps[part][ordinal] = new_ordinal
+            doc_ids.append(doc_id)
+            doc_lengths.append(parts[part][0].doc_lengths[ordinal])
+
+        terms: dict[str, int] = {}
+        postings_offsets = array(OFFSET_TYPE, [0])
+        doc_ordinals = array(ORDINAL_TYPE)
+        tfs = array(TF_TYPE)
+        positions = PositionsBuilder.of([postings for postings, _ in parts])
+
+        for token in sorted(set().union(*(postings.terms for postings, _ in parts))):
+            start = len(doc_ordinals)
+            for ordinal, tf, data in heapq.merge(
+                *(
+                    _renumbered(postings, token, remap, positions is not None)
+                    for (postings, _), remap in zip(parts, remaps)
+                )
+            ):
+                doc_ordinals.append(ordinal)
+                tfs.append(tf)
+                if positions is not None:
+                    positions.append(data)
+
+            # terms that only occurred in deleted documents disappear
+            if len(doc_ordinals) == start:
+                continue
+
+            terms[token] = len(terms)
+            postings_offsets.append(len(doc_ordinals))
+
+        return cls(
+            terms,
+            postings_offsets,
+            doc_ordinals,
+            tfs,
+            doc_ids,
+            doc_lengths,
+            **(positions.sections() if positions is not None else {}),
+        )
+
+    def __contains__(self, token: str) -> bool:
+        return token in self.terms
+
+    def __len__(self) -> int:
+        return len(self.terms)
+
+    @property
+    def doc_count(self) -> int:
+        return len(self.doc_ids)
+
+    @property
+    def positional(self) -> bool:
+        return self.positions is not None
+
+    @property
+    def live_ordinals(self) -> Sequence[int]:
+        return range(self.doc_count)
+
+    def term_range(self, token: str) -> tuple[int, int]:
+        term_id = self.terms.get(token)
+        if term_id is None:
+            return 0, 0
+
+        return self.postings_offsets[term_id], self.postings_offsets[term_id + 1]
+
+    def document_frequency(self, token: str) -> int:
+        start, end = self.term_range(token)
+        return end - start
+
+    def lookup(self, token: str) -> tuple[Sequence[int], Sequence[int]]:
+        # zero-copy views of the token's ordinals and term frequencies
+        start, end = self.term_range(token)
+        return (
+            memoryview(self.doc_ordinals)[start:end],
+            memoryview(self.tfs)[start:end],
+        )
+
+    def encoded_positions(self, token: str) -> Iterator[memoryview]:
+        # the encoded positions of each of the token's postings
+        if self.positions is None:
+            raise ValueError("Postings have no positions")
+
+        start, end = self.term_range(token)
+        offsets = self.position_offsets
+        blob = memoryview(self.positions)
+        for i in range(start, end):
+            yield blob[offsets[i] : offsets[i + 1]]
+
+    def positions_in(self, token: str, ordinals: Sequence[int]) -> list[list[int]]:
+        # token positions in each document of the ascending `ordinals`, [] in
+        # those without the token; one pass over the token's postings
+        if self.positions is None:
+            raise ValueError("Postings have no positions")
+
+        start, end = self.term_range(token)
+        doc_ordinals = self.doc_ordinals
+        offsets = self.position_offsets
+        blob = memoryview(self.positions)
+        found = []
+        for ordinal in ordinals:
+            start = bisect_left(doc_ordinals, ordinal, start, end)
+            if start < end and doc_ordinals[start] == ordinal:
+                found.append(
+                    decode_positions(blob[offsets[start] : offsets[start + 1]])
+                )
+            else:
+                found.append([])
+        return found
+
+    def lookup_impacts(self, token: str) -> Sequence[float]:
+        if self.impacts is None:
+            raise ValueError("Postings have no precomputed impacts")
+
+        start, end = self.term_range(token)
+        return memoryview(self.impacts)[start:end]
+
+    def max_impact(self, token: str) -> float:
+        if self.max_impacts is None:
+            raise ValueError("Postings have no precomputed impacts")
+
+        term_id = self.terms.get(token)
+        return 0.0 if term_id is None else self.max_impacts[term_id]
+
+    def ordinal(self, doc_id: int) -> int | None:
+        pos = bisect_left(self.doc_ids, doc_id)
+        if pos < len(self.doc_ids) and self.doc_ids[pos] == doc_id:
+            return pos
+
+        return None
+
+    def get_tf(self, ordinal: int, token: str) -> int:
+        ordinals, tfs = self.lookup(token)
+        pos = bisect_left(ordinals, ordinal)
+        if pos < len(ordinals) and ordinals[pos] == ordinal:
+            return tfs[pos]
+
+        return 0
+
+
+class PostingsBuilder:
+    """Collects documents in any order and freezes them into `Postings`.
+
+    With `positional` set, documents must be added with `add_tokens`, whose
+    token positions are kept.
+    """
+
+    def __init__(self, positional: bool = False) -> None:
+        self.positional = positional
+        self.doc_ids: list[int] = []
+        self.doc_lengths: list[int] = []
+        # token -> flat [insertion number, tf, insertion number, tf, ...]
+        self.term_postings: dict[str, array] = {}
+        # token -> encoded positions, parallel to its term_postings
+        self.term_positions: dict[str, list[bytes]] = {}
+
+    def add_document(self, doc_id: int, term_counts: Counter[str]) -> None:
+        insertion = len(self.doc_ids)
+        self.doc_ids.append(doc_id)
+        self.doc_lengths.append(term_counts.total())
+
+        for token, tf in term_counts.items():
+            postings = self.term_postings.get(token)
+            if postings is None:
+                postings = self.term_postings[token] = array(ORDINAL_TYPE)
+            postings.append(insertion)
+            postings.append(tf)
+
+    def add_tokens(self, doc_id: int, tokens: Iterable[str]) -> None:
+        if not self.positional:
+            self.add_document(doc_id, Counter(tokens))
+            return
+
+        token_positions: dict[str, list[int]] = {}
+        for position, token in enumerate(tokens):
+            token_positions.setdefault(token, []).append(position)
+
+        self.add_document(
+            doc_id,
+            Counter({token: len(found) for token, found in token_positions.items()}),
+        )
+        for token, found in token_positions.items():
+            self.term_positions.setdefault(token, []).append(encode_positions(found))
+
+    def build(self) -> "Postings":
+        if len(set(self.doc_ids)) != len(self.doc_ids):
+            raise ValueError("Duplicate doc ids in corpus")
+
+        # ordinals follow ascending doc ids
+        order = sorted(range(len(self.doc_ids)), key=self.doc_ids.__getitem__)
+        remap = [0] * len(order)
+        for ordinal, insertion in enumerate(order):
+            remap[insertion] = ordinal
+
+        terms: dict[str, int] = {}
+        postings_offsets = array(OFFSET_TYPE, [0])
+        doc_ordinals = array(ORDINAL_TYPE)
+        tfs = array(TF_TYPE)
+        positions = PositionsBuilder() if self.positional else None
+
+        for term_id, token in enumerate(sorted(self.term_postings)):
+            flat = self.term_postings[token]
+            encoded = self.term_positions[token] if self.positional else repeat(None)
+            postings = sorted(
+                zip((remap[i] for i in flat[::2]), flat[1::2], encoded),
+                key=itemgetter(0),
+            )
+            terms[token] = term_id
+            doc_ordinals.extend(ordinal for ordinal, _, _ in postings)
+            tfs.extend(tf for _, tf, _ in postings)
+            if positions is not None:
+                positions.extend(data for _, _, data in postings)
+            postings_offsets.append(len(doc_ordinals))
+
+        return Postings(
+            terms,
+            postings_offsets,
+            doc_ordinals,
+            tfs,
+            array(DOC_ID_TYPE, (self.doc_ids[i] for i in order)),
+            array(DOC_LENGTH_TYPE, (self.doc_lengths[i] for i in order)),
+            **(positions.sections() if positions is not None else {}),
+        )
+
+
+class PositionsBuilder:
+    """Appends the encoded positions of postings, in postings order."""
+
+    def __init__(self) -> None:
+        self.position_offsets = array(OFFSET_TYPE, [0])
+        self.positions = bytearray()
+
+    @classmethod
+    def of(cls, parts: Sequence[Postings]) -> "PositionsBuilder | None":
+        # positions are only kept if every part has them
+        if parts and all(part.positional for part in parts):
+            return cls()
+        return None
+
+    def extend(self, encoded: Iterable[Buffer]) -> None:
+        for data in encoded:
+            self.positions += data
+            self.position_offsets.append(len(self.positions))
+
+    def append(self, data: Buffer) -> None:
+        self.positions += data
+        self.position_offsets.append(len(self.positions))
+
+    def sections(self) -> dict:
+        return {
+            "position_offsets": self.position_offsets,
+            "positions": self.positions,
+        }
+
+
+def _live_documents(
+    postings: Postings, deleted: AbstractSet[int], part: int
+) -> Iterator[tuple[int, int, int]]:
+    # (doc id, part, ordinal) of the part's live documents, by doc id
+    doc_ids = postings.doc_ids
+    for ordinal in range(postings.doc_count):
+        if ordinal not in deleted:
+            yield doc_ids[ordinal], part, ordinal
+
+
+def _renumbered(
+    postings: Postings, token: str, remap: Sequence[int], positional: bool
+) -> Iterator[tuple[int, int, Buffer | None]]:
+    # (new ordinal, tf, encoded positions or None) of the token's live
+    # postings, ascending
+    ordinals, tfs = postings.lookup(token)
+    encoded = postings.encoded_positions(token) if positional else repeat(None)
+    for ordinal, tf, data in zip(ordinals, tfs, encoded):
+        new_ordinal = remap[ordinal]
+        if new_ordinal >= 0:
+            yield new_ordinal, tf, data
+
+
+def encode_positions(positions: Sequence[int]) -> bytes:
+    # ascending positions as varints of their gaps (7 bits per byte, high bit
+    # set on all but the last byte of a number)
+    gaps = [position - previous for previous, position in pairwise([0, *positions])]
+    if not gaps or max(gaps) < 0x80:
+        # single byte gaps only, the common case
+        return bytes(gaps)
+
+    encoded = bytearray()
+    for gap in gaps:
+        while gap >= 0x80:
+            encoded.append(gap & 0x7F | 0x80)
+            gap >>= 7
+        encoded.append(gap)
+    return bytes(encoded)
+
+
+def decode_positions(data: Buffer) -> list[int]:
+    data = bytes(data)
+    if not data or max(data) < 0x80:
+        # single byte gaps only, the common case
+        return list(accumulate(data))
+
+    positions = []
+    position = 0
+    gap = 0
+    shift = 0
+    for byte in data:
+        gap |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        position += gap
+        positions.append(position)
+        gap = 0
+        shift = 0
+    return positions
@@ -0,0 +1,293 @@
+import json
+import os
+import time
+from collections.abc import Sequence
+
+import numpy as np
+from config import (
+    ANN_KMEANS_ITERATIONS,
+    CACHE_DIR,
+    CACHE_QUANTIZED_CODEBOOK_FILE,
+    CACHE_QUANTIZED_CODES_FILE,
+    CACHE_QUANTIZED_MANIFEST_FILE,
+    PQ_SUBSPACES,
+    PQ_TRAIN_ROWS,
+    QUANTIZED_BLOCK_ROWS,
+    SEMANTIC_BLOCK_ROWS,
+)
+from lib.ann import assign, kmeans, recall_at_k, sample_rows
+from lib.embeddings import EMBEDDING_DTYPE, normalize, save_array, top_k, top_k_rows
+
+# Quantized copy of the embedding matrix, derived from one embeddings build:
+#
+#   quantized.json            manifest: kind, row count, dimension, build id
+#   quantized_codes.npy       int8 [rows, dimension] or uint8 [rows, subspaces]
+#   quantized_codebook.npy    int8: float32 [dimension] scale per dimension
+#                             pq:   float32 [subspaces, 256, dimension / subspaces]
+#
+# Candidates are scored on the codes only; the float matrix is read just for
+# the rows of a rescoring shortlist.
+
+QUANTIZED_VERSION = 1
+KINDS = ("int8", "pq")
+PQ_CENTROIDS = 256  # one uint8 code per subspace
+INT8_MAX = 127
+
+
+class QuantizedEmbeddings:
+    """Compressed embedding rows with approximate dot-product scoring.
+
+    int8: every dimension is scaled symmetrically to [-127, 127]; a row
+    costs one byte per dimension. pq (product quantization): a row is cut
+    into `subspaces` chunks and each chunk is replaced by the id of its
+    closest k-means centroid; a row costs one byte per subspace.
+    """
+
+    def __init__(self, manifest: dict, codes: np.ndarray, codebook: np.ndarray):
+        self.manifest = manifest
+        self.codes = codes
+        self.codebook = codebook
+
+    @property
+    def kind(self) -> str:
+        return self.manifest["kind"]
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + self.codebook.nbytes
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    @classmethod
+    def build(
+        cls,
+        vectors: np.ndarray,
+        build_id: str | None,
+        kind: str = "int8",
+        subspaces: int = PQ_SUBSPACES,
+        iterations: int = ANN_KMEANS_ITERATIONS,
+        train_rows: int = PQ_TRAIN_ROWS,
+        seed: int = 0,
+    ) -> "QuantizedEmbeddings":
+        if kind not in KINDS:
+            raise ValueError(f"Unknown quantization {kind!r}, expected one of {KINDS}")
+        if not len(vectors):
+            raise ValueError("There are no embeddings to quantize")
+
+        dimension = vectors.shape[1]
+        if kind == "int8":
+            codebook = _int8_scales(vectors)
+            codes = np.empty((len(vectors), dimension), dtype=np.int8)
+            for start in range(0, len(vectors), SEMANTIC_BLOCK_ROWS):
+                block = np.asarray(vectors[start : start + SEMANTIC_BLOCK_ROWS])
+                codes[start : start + len(block)] = np.rint(block / codebook)
+        else:
+            if dimension % subspaces:
+                raise ValueError(
+                    f"{dimension} dimensions cannot be split into {subspaces} subspaces"
+                )
+            rng = np.random.default_rng(seed)
+            train = sample_rows(vectors, train_rows, rng)
+            codebook, codes = _product_quantize(
+                vectors, train, subspaces, iterations, rng
+            )
+
+        manifest = {
+            "version": QUANTIZED_VERSION,
+            "kind": kind,
+            "count": len(vectors),
+            "dimension": dimension,
+            "embeddings_build_id": build_id,
+        }
+        return cls(manifest, codes, codebook)
+
+    def save(self) -> None:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        save_array(CACHE_QUANTIZED_CODES_FILE, self.codes)
+        save_array(CACHE_QUANTIZED_CODEBOOK_FILE, self.codebook)
+
+        tmp_manifest = CACHE_QUANTIZED_MANIFEST_FILE.with_suffix(".json.tmp")
+        with open(tmp_manifest, "w") as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp_manifest, CACHE_QUANTIZED_MANIFEST_FILE)
+
+    @classmethod
+    def load(cls, build_id: str | None) -> "QuantizedEmbeddings":
+        """Load the codes of the embeddings with `build_id` into memory."""
+        if not CACHE_QUANTIZED_MANIFEST_FILE.exists():
+            raise FileNotFoundError(
+                f"File not found: {CACHE_QUANTIZED_MANIFEST_FILE}"
+                " (run 'build_quantized')"
+            )
+
+        with open(CACHE_QUANTIZED_MANIFEST_FILE, "r") as f:
+            manifest = json.load(f)
+
+        if manifest.get("version") != QUANTIZED_VERSION:
+            raise ValueError(
+                f"Unsupported quantized embeddings version {manifest.get('version')}"
+                f" (expected {QUANTIZED_VERSION}), please run 'build_quantized'"
+            )
+        if build_id is None or manifest["embeddings_build_id"] != build_id:
+            raise ValueError(
+                "The quantized embeddings were built from other embeddings,"
+                " please run 'build_quantized'"
+            )
+
+        # the codes are what is kept resident, unlike the mmap'd float matrix
+        codes = np.load(CACHE_QUANTIZED_CODES_FILE)
+        codebook = np.load(CACHE_QUANTIZED_CODEBOOK_FILE)
+        if len(codes) != manifest["count"]:
+            raise ValueError(
+                f"Corrupt quantized embeddings in {CACHE_DIR},"
+                " please run 'build_quantized'"
+            )
+
+        return cls(manifest, codes, codebook)
+
+    def scorer(self, queries: np.ndarray):
+        """`score(start, end)` of approximate dot products, for `top_k`."""
+        queries = np.asarray(queries, dtype=EMBEDDING_DTYPE)
+        if self.kind == "int8":
+            scaled = queries * self.codebook
+            return lambda start, end: (
+                scaled @ self.codes[start:end].T.astype(EMBEDDING_DTYPE)
+            )
+
+        # a lookup table of every subspace centroid's dot product with the
+        # query; a row's score is the sum of its codes' table entries
+        subspaces, centroids, width = self.codebook.shape
+        chunks = queries.reshape(len(queries), subspaces, width)
+        tables = np.einsum("qsw,scw->qsc", chunks, self.codebook).reshape(
+            len(queries), -1
+        )
+        offsets = np.arange(subspaces) * centroids
+
+        def score(start: int, end: int) -> np.ndarray:
+            positions = self.codes[start:end] + offsets
+            return np.stack([table[positions].sum(axis=1) for table in tables])
+
+        return score
+
+    def search(
+        self,
+        queries: np.ndarray,
+        limit: int,
+        vectors: np.ndarray | None = None,
+        rescore: int = 0,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Approximate `top_k_rows` on the codes.
+
+        With `vectors` (the float matrix) and `rescore` > 0, the best
+        `max(rescore, limit)` rows by approximate score are scored exactly
+        and the scores returned are exact.
+        """
+        queries = np.asarray(queries, dtype=EMBEDDING_DTYPE)
+        rescoring = vectors is not None and rescore > 0
+        shortlist = max(rescore, limit) if rescoring else limit
+        block_rows = (
+            QUANTIZED_BLOCK_ROWS if self.kind == "int8" else SEMANTIC_BLOCK_ROWS
+        )
+        rows, scores = top_k(
+            self.scorer(queries), len(self), len(queries), shortlist, block_rows
+        )
+        if not rescoring:
+            return rows, scores
+
+        results = []
+        for query, candidates in zip(queries, rows):
+            candidates = np.sort(candidates)
+            hits, exact = top_k_rows(vectors[candidates], query[None], limit)
+            results.append((candidates[hits[0]], exact[0]))
+
+        return np.stack([r for r, _ in results]), np.stack([s for _, s in results])
+
+
+def evaluate(
+    quantized: QuantizedEmbeddings,
+    vectors: np.ndarray,
+    queries: np.ndarray,
+    limit: int,
+    rescores: Sequence[int],
+) -> list[dict]:
+    """Memory, per-query latency and recall@limit vs. unquantized search.
+
+    The first result is the float matrix itself (``rescore`` None).
+    """
+    queries = normalize(queries)
+
+    def run(search) -> tuple[list[np.ndarray], list[float]]:
+        found, latencies = [], []
+        for query in queries:
+            start = time.perf_counter()
+            rows, _ = search(query[None])
+            latencies.append(time.perf_counter() - start)
+            found.append(rows[0])
+        return found, latencies
+
+    exact, latencies = run(lambda query: top_k_rows(vectors, query, limit))
+    results = [_result("float32", None, 1.0, latencies, vectors.nbytes)]
+    for rescore in rescores:
+        found, latencies = run(
+            lambda query, rescore=rescore: quantized.search(
+                query, limit, vectors, rescore
+            )
+        )
+        recall = recall_at_k(found, np.array(exact))
+        results.append(
+            _result(quantized.kind, rescore, recall, latencies, quantized.nbytes)
+        )
+
+    return results
+
+
+def _result(
+    kind: str, rescore: int | None, recall: float, latencies: list[float], nbytes: int
+) -> dict:
+    ms = np.array(latencies) * 1000
+    return {
+        "kind": kind,
+        "rescore": rescore,
+        "recall": recall,
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p95_ms": float(np.percentile(ms, 95)),
+        "bytes": nbytes,
+    }
+
+
+def _int8_scales(vectors: np.ndarray) -> np.ndarray:
+    # symmetric per-dimension scale: the largest |value| maps to 127
+    peak = np.zeros(vectors.shape[1], dtype=EMBEDDING_DTYPE)
+    for start in range(0, len(vectors), SEMANTIC_BLOCK_ROWS):
+        block = np.asarray(vectors[start : start + SEMANTIC_BLOCK_ROWS])
+        np.maximum(peak, np.abs(block).max(axis=0), out=peak)
+
+    return np.maximum(peak, np.finfo(EMBEDDING_DTYPE).tiny) / INT8_MAX
+
+
+def _product_quantize(
+    vectors: np.ndarray,
+    train: np.ndarray,
+    subspaces: int,
+    iterations: int,
+    rng: np.random.Generator,
+) -> tuple[np.ndarray, np.ndarray]:
+    # k-means per subspace, then every row's closest centroid per subspace
+    width = vectors.shape[1] // subspaces
+    centroids = min(PQ_CENTROIDS, len(train))
+    codebook = np.zeros((subspaces, PQ_CENTROIDS, width), dtype=EMBEDDING_DTYPE)
+    for i in range(subspaces):
+        chunk = np.ascontiguousarray(train[:, i * width : (i + 1) * width])
+        codebook[i, :centroids] = kmeans(chunk, centroids, iterations, rng)
+
+    codes = np.empty((len(vectors), subspaces), dtype=np.uint8)
+    for start in range(0, len(vectors), SEMANTIC_BLOCK_ROWS):
+        block = np.asarray(vectors[start : start + SEMANTIC_BLOCK_ROWS])
+        for i in range(subspaces):
+            chunk = block[:, i * width : (i + 1) * width]
+            codes[start : start + len(block), i] = assign(
+                chunk, codebook[i, :centroids]
+            )
+
+    return codebook, codes
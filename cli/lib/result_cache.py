@@ -0,0 +1,198 @@
+import json
+import threading
+from collections import OrderedDict
+from collections.abc import Callable
+from itertools import islice
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+from config import BM25_ENGINE, RESULT_CACHE_SIZE
+from lib import boolean_query, trace
+from lib.inverted_index import InvertedIndex, bm25_query_tokens
+from lib.tokenize import tokenize_str
+
+if TYPE_CHECKING:
+    import sqlite3
+
+# layout of the sqlite table, kept in its user_version
+RESULTS_SCHEMA_VERSION = 2
+
+
+class ResultCache:
+    """Search results by normalized query and parameters, for one index.
+
+    Keys are what the search makes of a query (its tokens, and the boolean
+    structure or quoted phrases) plus the parameters, so queries that only
+    differ in case, spacing, stop words or word forms share an entry. Every
+    entry belongs to the index generation it was computed on, of the index
+    with that id; the first lookup against another generation (after
+    'build', 'add', 'merge', ...) or another index (a wiped and rebuilt
+    cache dir, whose generations start over) drops them all.
+
+    An LRU in memory of at most `max_entries` results (0 turns the cache
+    off), over an sqlite table at `path` that keeps the current
+    generation's results across restarts. Memory-only without a path. Safe
+    to share between threads.
+    """
+
+    def __init__(
+        self, path: Path | None = None, max_entries: int = RESULT_CACHE_SIZE
+    ) -> None:
+        self.max_entries = max_entries
+        self.entries: OrderedDict[str, Any] = OrderedDict()
+        self.index_id: str | None = None
+        self.generation: int | None = None
+        self.hits = 0  # found in memory
+        self.disk_hits = 0  # found on disk
+        self.misses = 0  # searched
+        self.evictions = 0  # dropped from memory
+        self.invalidations = 0  # generations dropped
+        self.lock = threading.Lock()
+
+        self.db: sqlite3.Connection | None = None
+        if path is not None and max_entries > 0:
+            self.db = _open_results_db(path)
+
+    def bm25_search(
+        self,
+        index: InvertedIndex,
+        query: str,
+        limit: int,
+        k1: float,
+        b: float,
+        proximity: float = 0.0,
+        engine: str = BM25_ENGINE,
+    ) -> dict[int, float]:
+        # JSON keeps the (doc id, score) pairs, not int keys; the engines
+        # find the same hits, so they share entries
+        key = ("bm25", *bm25_query_tokens(query), limit, k1, b, proximity)
+        pairs = self.__get_or_search(
+            index,
+            key,
+            lambda: list(
+                index.bm25_search(query, limit, k1, b, proximity, engine).items()
+            ),
+        )
+        return dict(pairs)
+
+    def search(self, index: InvertedIndex, query: str, limit: int) -> list[int]:
+        # the first `limit` boolean matches
+        key = ("search", boolean_query.normalize(query, tokenize_str), limit)
+        return self.__get_or_search(
+            index, key, lambda: list(islice(index.iter_documents(query), limit))
+        )
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "hit_ratio": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+                "entries": len(self.entries),
+                "index_id": self.index_id,
+                "generation": self.generation,
+            }
+
+    def close(self) -> None:
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def __get_or_search(
+        self, index: InvertedIndex, key: tuple, search: Callable[[], Any]
+    ) -> Any:
+        # an unsaved index has no generation to tie results to
+        index_id, generation = index.index_id, index.generation
+        if index_id is None or generation is None or self.max_entries <= 0:
+            return search()
+
+        text = json.dumps(key)
+        with self.lock:
+            if (index_id, generation) != (self.index_id, self.generation):
+                self.__invalidate(index_id, generation)
+            result = self.__get(text)
+        if result is not None:
+            trace.count("result_cache_hits")
+            return result
+
+        # searched outside the lock, concurrent misses of one query may both
+        # search
+        trace.count("result_cache_misses")
+        result = search()
+        with self.lock:
+            self.misses += 1
+            if (index_id, generation) == (self.index_id, self.generation):
+                self.__put(text, result)
+                if self.db is not None:
+                    self.db.execute(
+                        "INSERT OR REPLACE INTO search_results VALUES (?, ?, ?, ?)",
+                        (text, index_id, generation, json.dumps(result)),
+                    )
+                    self.db.commit()
+        return result
+
+    def __invalidate(self, index_id: str, generation: int) -> None:
+        if self.generation is not None:
+            self.invalidations += 1
+        self.entries.clear()
+        self.index_id, self.generation = index_id, generation
+        if self.db is not None:
+            self.db.execute(
+                "DELETE FROM search_results WHERE index_id != ? OR generation != ?",
+                (index_id, generation),
+            )
+            self.db.commit()
+
+    def __get(self, key: str) -> Any:
+        result = self.entries.get(key)
+        if result is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return result
+
+        if self.db is None:
+            return None
+
+        row = self.db.execute(
+            "SELECT result FROM search_results"
+            " WHERE key = ? AND index_id = ? AND generation = ?",
+            (key, self.index_id, self.generation),
+        ).fetchone()
+        if row is None:
+            return None
+
+        result = json.loads(row[0])
+        self.disk_hits += 1
+        self.__put(key, result)
+        return result
+
+    def __put(self, key: str, result: Any) -> None:
+        self.entries[key] = result
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+
+def _open_results_db(path: Path) -> "sqlite3.Connection":
+    # only persisting caches pay for importing sqlite
+    import sqlite3
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    db = sqlite3.connect(path, check_same_thread=False)
+    # results of an older layout are dropped, they are only a cache
+    (schema,) = db.execute("PRAGMA user_version").fetchone()
+    if schema != RESULTS_SCHEMA_VERSION:
+        db.execute("DROP TABLE IF EXISTS search_results")
+        db.execute(f"PRAGMA user_version = {RESULTS_SCHEMA_VERSION}")
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS search_results ("
+        " key TEXT PRIMARY KEY, index_id TEXT NOT NULL,"
+        " generation INTEGER NOT NULL, result TEXT NOT NULL) WITHOUT ROWID"
+    )
+    db.commit()
+    return db
@@ -1,52 +1,226 @@
-from config import MAX_SEARCH_RESULTS
+import sys
+import time
+from contextlib import ExitStack
+from pathlib import Path
+
+from config import BM25_ENGINE, BUILD_MEMORY_BUDGET, MAX_SEARCH_RESULTS
+from lib import bulk_search, client, trace
 from lib.inverted_index import InvertedIndex
+from lib.result_cache import ResultCache
 
-from .utils import print_search_results
+from .utils import iter_movies, print_search_results
 
 search_index = InvertedIndex()
 index_is_loaded = False
+result_cache = ResultCache()
 
 
 def search(query: str) -> None:
-    if not index_is_loaded:
-        load_index()
-
-    search_results = []
-    index_results = search_index.get_documents(query)
-    for doc_id in index_results[:MAX_SEARCH_RESULTS]:
-        search_results.append(search_index.docmap[doc_id]["title"])
+    # answered by the search daemon if one is running
+    response = client.request("/search", {"query": query, "limit": MAX_SEARCH_RESULTS})
+    if response is not None:
+        search_results = [result["title"] for result in response["results"]]
+    else:
+        try:
+            search_results = index_search(query)
+        except ValueError as err:
+            print(err)
+            return
 
     if not search_results:
         print("Nothing found")
     else:
         print_search_results(search_results)
 
+    if response is not None:
+        print_daemon_latency(response)
+
+
+def bm25_search(
+    query: str,
+    limit: int,
+    k1: float,
+    b: float,
+    proximity: float = 0.0,
+    engine: str = BM25_ENGINE,
+) -> None:
+    # answered by the search daemon if one is running
+    response = client.request(
+        "/bm25",
+        {
+            "query": query,
+            "limit": limit,
+            "k1": k1,
+            "b": b,
+            "proximity": proximity,
+            "engine": engine,
+        },
+    )
+    if response is not None:
+        search_results = [
+            (result["id"], result["title"], result["score"])
+            for result in response["results"]
+        ]
+    else:
+        try:
+            search_results = bm25_results(query, limit, k1, b, proximity, engine)
+        except ValueError as err:
+            print(err)
+            return
+
+    if not search_results:
+        print("Nothing found")
+    else:
+        print_search_results(search_results[:MAX_SEARCH_RESULTS], bm25=True)
+
+    if response is not None:
+        print_daemon_latency(response)
 
-def bm25_search(query: str, limit: int, k1: float, b: float) -> None:
+
+def bm25_results(
+    query: str,
+    limit: int,
+    k1: float,
+    b: float,
+    proximity: float = 0.0,
+    engine: str = BM25_ENGINE,
+) -> list[tuple[int, str, float]]:
     if not index_is_loaded:
         load_index()
 
     search_results: list[tuple[int, str, float]] = []
-    index_results = search_index.bm25_search(query, limit, k1, b)
-    for doc_id, bm25_score in index_results.items():
-        search_results.append(
-            (doc_id, search_index.docmap[doc_id]["title"], bm25_score)
+    with trace.span("bm25"):
+        index_results = result_cache.bm25_search(
+            search_index, query, limit, k1, b, proximity, engine
         )
+        with trace.span("bm25.titles"):
+            hits = search_index.hydrate(index_results)
+            for (doc_id, bm25_score), hit in zip(index_results.items(), hits):
+                search_results.append((doc_id, hit["title"], bm25_score))
+
+    return search_results
+
+
+def bm25_search_file(
+    queries_file: Path,
+    output: str,
+    limit: int,
+    k1: float,
+    b: float,
+    workers: int,
+    engine: str = BM25_ENGINE,
+) -> None:
+    # loads the index once for all queries; `output` "-" is stdout, opened
+    # only once the queries file is, so a missing one leaves it untouched
+    if not index_is_loaded and not load_index():
+        return
+
+    with ExitStack() as files:
+        try:
+            queries_in = files.enter_context(open(queries_file, "r"))
+        except OSError as err:
+            print(f"Invalid queries file {queries_file}: {err}", file=sys.stderr)
+            return
+        try:
+            out = (
+                sys.stdout if output == "-" else files.enter_context(open(output, "w"))
+            )
+        except OSError as err:
+            print(err, file=sys.stderr)
+            return
+
+        start = time.perf_counter()
+        try:
+            stats = bulk_search.bulk_bm25_search(
+                search_index,
+                bulk_search.read_queries(queries_in, queries_file.suffix == ".jsonl"),
+                out,
+                limit,
+                k1,
+                b,
+                workers,
+                engine,
+            )
+        except ValueError as err:
+            print(f"Invalid queries file {queries_file}: {err}", file=sys.stderr)
+            return
+
+    seconds = time.perf_counter() - start
+    print(
+        f"Searched {stats['queries']} queries ({stats['searched']} distinct) in"
+        f" {seconds:.2f} s, {stats['queries'] / seconds:.0f} queries/s",
+        file=sys.stderr,
+    )
+
+
+def print_daemon_latency(response: dict) -> None:
+    print(f"Answered by the search daemon in {response['latency_ms']:.1f} ms")
+
+
+def build_index(
+    workers: int = 1, memory_budget: int = BUILD_MEMORY_BUDGET, positions: bool = False
+) -> None:
+    with trace.span("build"):
+        search_index.build(workers, memory_budget, positions)
+    search_index.save()
 
-    if not search_results:
-        print("Nothing found")
-    else:
-        print_search_results(search_results[:MAX_SEARCH_RESULTS], bm25=True)
+    global index_is_loaded
+    index_is_loaded = False
 
 
-def build_index() -> None:
-    search_index.build()
+def convert_index() -> None:
+    search_index.load_pickle_cache()
     search_index.save()
 
     global index_is_loaded
     index_is_loaded = False
 
 
+def add_documents(path: Path, update: bool = False) -> None:
+    if not index_is_loaded and not load_index():
+        return
+
+    count = 0
+    try:
+        for movie in iter_movies(path):
+            if update:
+                search_index.update_document(movie)
+            else:
+                search_index.add_document(movie)
+            count += 1
+    except OSError as err:
+        print(f"Invalid documents file {path}: {err}", file=sys.stderr)
+        return
+    except ValueError as err:
+        print(err)
+        return
+
+    search_index.commit()
+    print(f"Indexed {count} documents")
+
+
+def delete_documents(doc_ids: list[int]) -> None:
+    if not index_is_loaded and not load_index():
+        return
+
+    try:
+        for doc_id in doc_ids:
+            search_index.delete_document(doc_id)
+    except ValueError as err:
+        print(err)
+        return
+
+    search_index.commit()
+    print(f"Deleted {len(doc_ids)} documents")
+
+
+def merge_segments(full: bool = False) -> None:
+    if not index_is_loaded and not load_index():
+        return
+
+    search_index.merge(full)
+
+
 def calculate_tf(doc_id: int, term: str) -> None:
     if not index_is_loaded:
         load_index()
@@ -92,9 +266,12 @@ def index_search(query: str) -> list[str] | None:
         load_index()
 
     results = []
-    index_results = search_index.get_documents(query)
-    for doc_id in index_results[:MAX_SEARCH_RESULTS]:
-        results.append(search_index.docmap[doc_id]["title"])
+    with trace.span("boolean"):
+        # the match stream stops at the last result shown
+        doc_ids = result_cache.search(search_index, query, MAX_SEARCH_RESULTS)
+        with trace.span("boolean.titles"):
+            for hit in search_index.hydrate(doc_ids):
+                results.append(hit["title"])
 
     return results
 
@@ -0,0 +1,410 @@
+import io
+import json
+import mmap
+import os
+import shutil
+import struct
+import sys
+import zlib
+from array import array
+from bisect import bisect_left
+from collections.abc import Buffer, Iterable, Iterator, Mapping
+from functools import lru_cache
+from pathlib import Path
+from typing import BinaryIO
+
+from config import DOC_BLOCK_CACHE_SIZE
+from lib import trace
+from lib.postings import (
+    DOC_ID_TYPE,
+    DOC_LENGTH_TYPE,
+    IMPACT_TYPE,
+    OFFSET_TYPE,
+    ORDINAL_TYPE,
+    TF_TYPE,
+    Postings,
+)
+
+# Segment file layout (little-endian):
+#
+#   header     magic, format version, corpus statistics, BM25 impact params
+#   directory  section name -> (offset, length) for every section below
+#   sections   8 byte aligned raw buffers
+#
+#   term_offsets      uint64[T + 1]  byte offsets of each term in term_blob
+#   term_blob         utf-8 terms, sorted
+#   postings_offsets  uint64[T + 1]  posting offsets of each term
+#   doc_ordinals      uint32[P]      sorted doc ordinals per term
+#   tfs               uint32[P]      term frequencies, parallel to doc_ordinals
+#   impacts           float64[P]     BM25 impacts (only if flagged in header)
+#   max_impacts       float64[T]     max BM25 impact per term (ditto)
+#   position_offsets  uint64[P + 1]  byte offsets of each posting's positions
+#                                    (only if flagged in header)
+#   positions         varint-encoded position gaps per posting (ditto)
+#   doc_ids           int64[N]       doc id per ordinal, ascending
+#   doc_lengths       uint32[N]      token count per ordinal
+#   title_offsets     uint64[N + 1]  byte offsets of each title in title_blob
+#   title_blob        utf-8 titles, one per ordinal
+#   block_offsets     uint64[B + 1]  byte offsets of each block in doc_blocks
+#   doc_blocks        zlib-compressed blocks of DOC_BLOCK_RECORDS json records
+#                     (of consecutive ordinals), newline separated
+
+SEGMENT_MAGIC = b"RAGSEG\x00\x00"
+SEGMENT_VERSION = 3
+
+HEADER = struct.Struct("<8sIIQQQQddI")
+DIRECTORY_ENTRY = struct.Struct("<16sQQ")
+FLAG_IMPACTS = 1
+FLAG_POSITIONS = 2
+ALIGNMENT = 8
+
+DOC_BLOCK_RECORDS = 16
+DOCUMENT_SECTIONS = ("title_offsets", "title_blob", "block_offsets", "doc_blocks")
+# fields answered from the doc ids and the title column, without a block
+COLUMN_FIELDS = frozenset({"id", "title"})
+
+
+class SegmentTerms(Mapping[str, int]):
+    """Sorted on-disk term dictionary, searched without decoding it upfront."""
+
+    def __init__(self, term_offsets: memoryview, term_blob: memoryview) -> None:
+        self.term_offsets = term_offsets
+        self.term_blob = term_blob
+        self.cache: dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.term_offsets) - 1
+
+    def __term_bytes(self, i: int) -> bytes:
+        return bytes(self.term_blob[self.term_offsets[i] : self.term_offsets[i + 1]])
+
+    def __getitem__(self, token: str) -> int:
+        found = self.cache.get(token)
+        if found is not None:
+            return found
+
+        # utf-8 byte order equals code point order, i.e. python's str order
+        key = token.encode()
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.__term_bytes(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        if lo == len(self) or self.__term_bytes(lo) != key:
+            raise KeyError(token)
+
+        self.cache[token] = lo
+        return lo
+
+    def __iter__(self) -> Iterator[str]:
+        for i in range(len(self)):
+            yield self.__term_bytes(i).decode()
+
+
+class StoredDocuments(Mapping[int, dict]):
+    """Doc id -> movie dict, json records decoded on access.
+
+    Records are read from their compressed block, and recently decompressed
+    blocks are kept in an LRU cache. Projections to id and title are read
+    from the title column and decompress nothing.
+    """
+
+    def __init__(
+        self,
+        doc_ids: memoryview,
+        title_offsets: memoryview,
+        title_blob: memoryview,
+        block_offsets: memoryview,
+        doc_blocks: memoryview,
+        block_cache_size: int = DOC_BLOCK_CACHE_SIZE,
+    ) -> None:
+        self.doc_ids = doc_ids
+        self.title_offsets = title_offsets
+        self.title_blob = title_blob
+        self.block_offsets = block_offsets
+        self.doc_blocks = doc_blocks
+        self.block = lru_cache(maxsize=block_cache_size)(self.__decompress)
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    def __ordinal(self, doc_id: int) -> int:
+        ordinal = bisect_left(self.doc_ids, doc_id)
+        if ordinal == len(self.doc_ids) or self.doc_ids[ordinal] != doc_id:
+            raise KeyError(doc_id)
+        return ordinal
+
+    def __contains__(self, doc_id: object) -> bool:
+        if not isinstance(doc_id, int):
+            return False
+        ordinal = bisect_left(self.doc_ids, doc_id)
+        return ordinal < len(self.doc_ids) and self.doc_ids[ordinal] == doc_id
+
+    def __getitem__(self, doc_id: int) -> dict:
+        return json.loads(self.record(self.__ordinal(doc_id)))
+
+    def project(self, doc_id: int, fields: Iterable[str]) -> dict:
+        """The given fields of a movie, decoding no more than needed."""
+        ordinal = self.__ordinal(doc_id)
+        fields = tuple(fields)
+        if not COLUMN_FIELDS.issuperset(fields):
+            movie = json.loads(self.record(ordinal))
+            return {field: movie[field] for field in fields if field in movie}
+
+        title = bytes(self.encoded_title(ordinal)).decode()
+        return {field: doc_id if field == "id" else title for field in fields}
+
+    def __decompress(self, block: int) -> list[bytes]:
+        trace.count("doc_blocks_decompressed")
+        data = self.doc_blocks[
+            self.block_offsets[block] : self.block_offsets[block + 1]
+        ]
+        return zlib.decompress(data).split(b"\n")
+
+    def record(self, ordinal: int) -> bytes:
+        # the encoded json record of the document at `ordinal`
+        block, position = divmod(ordinal, DOC_BLOCK_RECORDS)
+        return self.block(block)[position]
+
+    def encoded_title(self, ordinal: int) -> memoryview:
+        return self.title_blob[
+            self.title_offsets[ordinal] : self.title_offsets[ordinal + 1]
+        ]
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.doc_ids)
+
+
+class DocumentWriter:
+    """Writes the document sections, one document at a time by ordinal.
+
+    `files` are the binary files of DOCUMENT_SECTIONS; records are buffered
+    until a block is full and then compressed, `close` writes the last one.
+    """
+
+    def __init__(self, files: Mapping[str, BinaryIO]) -> None:
+        self.files = files
+        self.block: list[Buffer] = []
+        self.title_bytes = 0
+        self.block_bytes = 0
+        files["title_offsets"].write(array(OFFSET_TYPE, [0]))
+        files["block_offsets"].write(array(OFFSET_TYPE, [0]))
+
+    def add(self, record: Buffer, title: Buffer) -> None:
+        self.title_bytes += self.files["title_blob"].write(title)
+        self.files["title_offsets"].write(array(OFFSET_TYPE, [self.title_bytes]))
+
+        self.block.append(record)
+        if len(self.block) == DOC_BLOCK_RECORDS:
+            self.__write_block()
+
+    def add_movie(self, movie: dict) -> None:
+        self.add(
+            json.dumps(movie, separators=(",", ":")).encode(),
+            str(movie.get("title", "")).encode(),
+        )
+
+    def close(self) -> None:
+        if self.block:
+            self.__write_block()
+
+    def __write_block(self) -> None:
+        # compact json escapes newlines, so they can separate the records
+        self.block_bytes += self.files["doc_blocks"].write(
+            zlib.compress(b"\n".join(self.block))
+        )
+        self.files["block_offsets"].write(array(OFFSET_TYPE, [self.block_bytes]))
+        self.block = []
+
+
+class Segment:
+    def __init__(self, path: Path) -> None:
+        with open(path, "rb") as f:
+            # the mapping stays valid after the file is closed
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (
+            magic,
+            version,
+            flags,
+            term_count,
+            posting_count,
+            doc_count,
+            total_doc_length,
+            k1,
+            b,
+            section_count,
+        ) = HEADER.unpack_from(self.mm, 0)
+
+        if magic != SEGMENT_MAGIC:
+            raise ValueError(f"Not an index segment: {path}")
+        if version != SEGMENT_VERSION:
+            raise ValueError(
+                f"Unsupported segment version {version} (expected {SEGMENT_VERSION}),"
+                " please rebuild the index"
+            )
+        if sys.byteorder != "little":
+            raise ValueError("Segments can only be opened on little-endian hosts")
+
+        self.sections: dict[str, memoryview] = {}
+        view = memoryview(self.mm)
+        for i in range(section_count):
+            name, offset, length = DIRECTORY_ENTRY.unpack_from(
+                self.mm, HEADER.size + i * DIRECTORY_ENTRY.size
+            )
+            self.sections[name.rstrip(b"\x00").decode()] = view[
+                offset : offset + length
+            ]
+
+        terms = SegmentTerms(
+            self.sections["term_offsets"].cast(OFFSET_TYPE),
+            self.sections["term_blob"],
+        )
+        doc_ids = self.sections["doc_ids"].cast(DOC_ID_TYPE)
+
+        has_impacts = bool(flags & FLAG_IMPACTS)
+        has_positions = bool(flags & FLAG_POSITIONS)
+        self.postings = Postings(
+            terms,
+            self.sections["postings_offsets"].cast(OFFSET_TYPE),
+            self.sections["doc_ordinals"].cast(ORDINAL_TYPE),
+            self.sections["tfs"].cast(TF_TYPE),
+            doc_ids,
+            self.sections["doc_lengths"].cast(DOC_LENGTH_TYPE),
+            total_doc_length=total_doc_length,
+            impacts=self.sections["impacts"].cast(IMPACT_TYPE) if has_impacts else None,
+            max_impacts=(
+                self.sections["max_impacts"].cast(IMPACT_TYPE) if has_impacts else None
+            ),
+            impact_params=(k1, b) if has_impacts else None,
+            position_offsets=(
+                self.sections["position_offsets"].cast(OFFSET_TYPE)
+                if has_positions
+                else None
+            ),
+            positions=self.sections["positions"] if has_positions else None,
+        )
+        self.documents = StoredDocuments(
+            doc_ids,
+            self.sections["title_offsets"].cast(OFFSET_TYPE),
+            self.sections["title_blob"],
+            self.sections["block_offsets"].cast(OFFSET_TYPE),
+            self.sections["doc_blocks"],
+        )
+
+        if len(terms) != term_count or len(self.postings.tfs) != posting_count:
+            raise ValueError(f"Corrupt index segment: {path}")
+        if len(doc_ids) != doc_count:
+            raise ValueError(f"Corrupt index segment: {path}")
+
+
+def write_segment(
+    path: Path, postings: Postings, documents: Mapping[int, dict]
+) -> None:
+    if sys.byteorder != "little":
+        raise ValueError("Segments can only be written on little-endian hosts")
+
+    # term ids follow sorted term order, so the buffers are already laid out
+    tokens = sorted(postings.terms)
+
+    term_offsets = array(OFFSET_TYPE, [0])
+    term_blob = bytearray()
+    for token in tokens:
+        term_blob += token.encode()
+        term_offsets.append(len(term_blob))
+
+    files = {name: io.BytesIO() for name in DOCUMENT_SECTIONS}
+    writer = DocumentWriter(files)
+    for doc_id in postings.doc_ids:
+        writer.add_movie(documents[doc_id])
+    writer.close()
+
+    sections: dict[str, Buffer | BinaryIO] = {
+        "term_offsets": term_offsets,
+        "term_blob": term_blob,
+        "postings_offsets": postings.postings_offsets,
+        "doc_ordinals": postings.doc_ordinals,
+        "tfs": postings.tfs,
+        "impacts": postings.impacts or b"",
+        "max_impacts": postings.max_impacts or b"",
+        "position_offsets": postings.position_offsets or b"",
+        "positions": postings.positions or b"",
+        "doc_ids": postings.doc_ids,
+        "doc_lengths": postings.doc_lengths,
+        **files,
+    }
+
+    write_sections(
+        path,
+        sections,
+        term_count=len(tokens),
+        posting_count=len(postings.tfs),
+        doc_count=len(postings.doc_ids),
+        total_doc_length=postings.total_doc_length,
+        impact_params=postings.impact_params if postings.impacts is not None else None,
+        positional=postings.positions is not None,
+    )
+
+
+def write_sections(
+    path: Path,
+    sections: Mapping[str, Buffer | BinaryIO],
+    term_count: int,
+    posting_count: int,
+    doc_count: int,
+    total_doc_length: int,
+    impact_params: tuple[float, float] | None,
+    positional: bool = False,
+) -> None:
+    """Write a segment file from its sections, in the order of the layout.
+
+    A section is either a buffer or a binary file (e.g. a spooled temp
+    file), which is copied over in chunks.
+    """
+    k1, b = impact_params or (0.0, 0.0)
+    header = HEADER.pack(
+        SEGMENT_MAGIC,
+        SEGMENT_VERSION,
+        (FLAG_IMPACTS if impact_params is not None else 0)
+        | (FLAG_POSITIONS if positional else 0),
+        term_count,
+        posting_count,
+        doc_count,
+        total_doc_length,
+        k1,
+        b,
+        len(sections),
+    )
+
+    directory = bytearray()
+    layout: list[tuple[int, Buffer | BinaryIO]] = []
+    offset = HEADER.size + DIRECTORY_ENTRY.size * len(sections)
+    for name, data in sections.items():
+        if isinstance(data, Buffer):
+            length = memoryview(data).nbytes
+        else:
+            length = data.seek(0, os.SEEK_END)
+            data.seek(0)
+
+        padding = -offset % ALIGNMENT
+        directory += DIRECTORY_ENTRY.pack(name.encode(), offset + padding, length)
+        layout.append((padding, data))
+        offset += padding + length
+
+    # write to a temp file and swap it in, so processes that still map the
+    # old segment keep reading a consistent file
+    tmp_path = path.with_suffix(path.suffix + ".tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(header)
+        f.write(directory)
+        for padding, data in layout:
+            f.write(b"\x00" * padding)
+            if isinstance(data, Buffer):
+                f.write(data)
+            else:
+                shutil.copyfileobj(data, f)
+
+    os.replace(tmp_path, path)
@@ -0,0 +1,560 @@
+import json
+import math
+import os
+import uuid
+from array import array
+from bisect import bisect_right
+from collections import defaultdict
+from collections.abc import Callable, Iterable, Iterator, Mapping, Sequence
+from collections.abc import Set as AbstractSet
+from contextlib import contextmanager
+from functools import cached_property, lru_cache
+from itertools import groupby
+from pathlib import Path
+
+from config import (
+    MERGE_FACTOR,
+    MERGE_MAX_DELETED_RATIO,
+    MERGE_MIN_SEGMENT_DOCS,
+    SEGMENT_LOOKUP_CACHE_SIZE,
+)
+from lib.postings import ORDINAL_TYPE, TF_TYPE, Postings
+from lib.segment import Segment, write_segment
+
+try:
+    import fcntl
+except ImportError:  # not on Windows, where writers are not serialized
+    fcntl = None
+
+# Manifest (json), rewritten atomically on every change:
+#
+#   index_id      random id of this index, kept by every change; a cache
+#                 dir wiped and rebuilt gets a new one, while its
+#                 generations start over
+#   generation    bumped by every commit, merge and rebuild
+#   next_segment  number of the next segment file
+#   segments      [{"file": name, "deleted": [doc ids]}], oldest first
+#
+# A segment is immutable once written; deleting or updating a document only
+# adds its doc id to the segment's tombstones ("deleted"). Writers hold an
+# exclusive lock on the manifest's ".lock" file while they change the set.
+
+MANIFEST_VERSION = 1
+
+# lock files this process holds, and how often (the lock is reentrant)
+_held_locks: dict[Path, int] = {}
+
+
+class SegmentColumn(Sequence[int]):
+    """A per-document column of every segment, indexed by global ordinal."""
+
+    def __init__(self, columns: list[Sequence[int]], bases: list[int]) -> None:
+        self.columns = columns
+        self.bases = bases  # global ordinal of each segment's first document
+
+    def __len__(self) -> int:
+        return self.bases[-1]
+
+    def __getitem__(self, ordinal: int) -> int:
+        part = bisect_right(self.bases, ordinal) - 1
+        return self.columns[part][ordinal - self.bases[part]]
+
+
+class SegmentSetPostings:
+    """Read-only `Postings` view over several segments minus their tombstones.
+
+    Global ordinals number the segments' documents one segment after the
+    other, so a doc id only maps to ascending ordinals within a segment.
+    Statistics (doc count, total length, document frequency) only count
+    live documents. There are no stored impacts; BM25 impacts are computed
+    from the combined statistics.
+    """
+
+    impacts = None
+    max_impacts = None
+    impact_params = None
+
+    def __init__(
+        self,
+        parts: list[tuple[Postings, AbstractSet[int]]],
+        lookup_cache_size: int = SEGMENT_LOOKUP_CACHE_SIZE,
+    ) -> None:
+        self.parts = parts
+        self.bases = [0]
+        for postings, _ in parts:
+            self.bases.append(self.bases[-1] + postings.doc_count)
+
+        self.doc_ids = SegmentColumn(
+            [postings.doc_ids for postings, _ in parts], self.bases
+        )
+        self.doc_lengths = SegmentColumn(
+            [postings.doc_lengths for postings, _ in parts], self.bases
+        )
+        self.doc_count = sum(
+            postings.doc_count - len(deleted) for postings, deleted in parts
+        )
+        self.total_doc_length = sum(
+            postings.total_doc_length
+            - sum(postings.doc_lengths[ordinal] for ordinal in deleted)
+            for postings, deleted in parts
+        )
+        self.lookup = lru_cache(maxsize=lookup_cache_size)(self.__lookup)
+
+    @cached_property
+    def terms(self) -> AbstractSet[str]:
+        # may contain terms that only occur in deleted documents
+        return frozenset().union(*(postings.terms for postings, _ in self.parts))
+
+    @cached_property
+    def live_ordinals(self) -> Sequence[int]:
+        return array(
+            ORDINAL_TYPE,
+            (
+                base + ordinal
+                for (postings, deleted), base in zip(self.parts, self.bases)
+                for ordinal in range(postings.doc_count)
+                if ordinal not in deleted
+            ),
+        )
+
+    def __contains__(self, token: str) -> bool:
+        return self.document_frequency(token) > 0
+
+    def __lookup(self, token: str) -> tuple[Sequence[int], Sequence[int]]:
+        ordinals = array(ORDINAL_TYPE)
+        tfs = array(TF_TYPE)
+        for (postings, deleted), base in zip(self.parts, self.bases):
+            part_ordinals, part_tfs = postings.lookup(token)
+            if not deleted:
+                ordinals.extend(ordinal + base for ordinal in part_ordinals)
+                tfs.extend(part_tfs)
+                continue
+
+            for ordinal, tf in zip(part_ordinals, part_tfs):
+                if ordinal not in deleted:
+                    ordinals.append(ordinal + base)
+                    tfs.append(tf)
+
+        return ordinals, tfs
+
+    def document_frequency(self, token: str) -> int:
+        return len(self.lookup(token)[0])
+
+    def lookup_impacts(self, token: str) -> Sequence[float]:
+        raise ValueError("Postings have no precomputed impacts")
+
+    def max_impact(self, token: str) -> float:
+        raise ValueError("Postings have no precomputed impacts")
+
+    def locate(self, doc_id: int) -> tuple[int, int] | None:
+        # (segment, local ordinal) of the live document
+        for part in range(len(self.parts) - 1, -1, -1):
+            postings, deleted = self.parts[part]
+            ordinal = postings.ordinal(doc_id)
+            if ordinal is not None and ordinal not in deleted:
+                return part, ordinal
+
+        return None
+
+    def ordinal(self, doc_id: int) -> int | None:
+        location = self.locate(doc_id)
+        if location is None:
+            return None
+
+        part, ordinal = location
+        return self.bases[part] + ordinal
+
+    def get_tf(self, ordinal: int, token: str) -> int:
+        part = bisect_right(self.bases, ordinal) - 1
+        postings, deleted = self.parts[part]
+        local = ordinal - self.bases[part]
+        return 0 if local in deleted else postings.get_tf(local, token)
+
+    @cached_property
+    def positional(self) -> bool:
+        return all(postings.positional for postings, _ in self.parts)
+
+    def positions_in(self, token: str, ordinals: Sequence[int]) -> list[list[int]]:
+        # ascending global ordinals, handed to their segments in runs
+        found: list[list[int]] = []
+        for part, group in groupby(
+            ordinals, key=lambda ordinal: bisect_right(self.bases, ordinal) - 1
+        ):
+            postings, deleted = self.parts[part]
+            local = [ordinal - self.bases[part] for ordinal in group]
+            found.extend(
+                [] if ordinal in deleted else positions
+                for ordinal, positions in zip(
+                    local, postings.positions_in(token, local)
+                )
+            )
+        return found
+
+
+class SegmentSetDocuments(Mapping[int, dict]):
+    """Doc id -> movie dict over the live documents of several segments."""
+
+    def __init__(self, segments: list[Segment], postings: SegmentSetPostings) -> None:
+        self.segments = segments
+        self.postings = postings
+
+    def __len__(self) -> int:
+        return self.postings.doc_count
+
+    def __contains__(self, doc_id: object) -> bool:
+        return isinstance(doc_id, int) and self.postings.locate(doc_id) is not None
+
+    def __getitem__(self, doc_id: int) -> dict:
+        location = self.postings.locate(doc_id)
+        if location is None:
+            raise KeyError(doc_id)
+
+        return self.segments[location[0]].documents[doc_id]
+
+    def project(self, doc_id: int, fields: Iterable[str]) -> dict:
+        location = self.postings.locate(doc_id)
+        if location is None:
+            raise KeyError(doc_id)
+
+        return self.segments[location[0]].documents.project(doc_id, fields)
+
+    def __iter__(self) -> Iterator[int]:
+        for postings, deleted in self.postings.parts:
+            for ordinal, doc_id in enumerate(postings.doc_ids):
+                if ordinal not in deleted:
+                    yield doc_id
+
+
+class TieredMergePolicy:
+    """Picks segments to merge: `factor` segments of one size tier at a time.
+
+    A segment's tier is the order of magnitude (base `factor`) of its live
+    document count relative to `min_segment_docs`, so a stream of small
+    delta segments is merged into ever larger ones and every document is
+    rewritten only log(N) times. Segments with many tombstones are rewritten
+    on their own to drop the deleted documents.
+    """
+
+    def __init__(
+        self,
+        factor: int = MERGE_FACTOR,
+        min_segment_docs: int = MERGE_MIN_SEGMENT_DOCS,
+        max_deleted_ratio: float = MERGE_MAX_DELETED_RATIO,
+    ) -> None:
+        if factor < 2:
+            raise ValueError("Merge factor must be at least 2")
+
+        self.factor = factor
+        self.min_segment_docs = min_segment_docs
+        self.max_deleted_ratio = max_deleted_ratio
+
+    def tier(self, doc_count: int) -> int:
+        floor = self.min_segment_docs
+        return int(math.log(max(doc_count, floor) / floor, self.factor))
+
+    def find_merges(self, sizes: Sequence[tuple[int, int]]) -> list[list[int]]:
+        # sizes: (doc count, deleted count) per segment
+        merges: list[list[int]] = []
+        tiers: dict[int, list[int]] = defaultdict(list)
+        for i, (doc_count, deleted_count) in enumerate(sizes):
+            if doc_count and deleted_count / doc_count > self.max_deleted_ratio:
+                merges.append([i])
+            else:
+                tiers[self.tier(doc_count - deleted_count)].append(i)
+
+        for _, members in sorted(tiers.items()):
+            for start in range(0, len(members) - self.factor + 1, self.factor):
+                merges.append(members[start : start + self.factor])
+
+        return merges
+
+
+class SegmentSet:
+    """The index segments named by the manifest, searched as one index."""
+
+    def __init__(self, manifest_path: Path, manifest: dict) -> None:
+        self.manifest_path = manifest_path
+        self.directory = manifest_path.parent
+        self.__load(manifest)
+
+    def __load(self, manifest: dict) -> None:
+        # manifests written before index ids existed get one on their next
+        # change; until then every process makes up its own
+        self.index_id: str = manifest.get("index_id") or uuid.uuid4().hex
+        self.generation: int = manifest["generation"]
+        self.next_segment: int = manifest["next_segment"]
+        self.files: list[str] = [entry["file"] for entry in manifest["segments"]]
+        self.deleted: list[set[int]] = [
+            set(entry["deleted"]) for entry in manifest["segments"]
+        ]
+        self.__open()
+
+    @classmethod
+    def open(cls, manifest_path: Path) -> "SegmentSet":
+        return cls(manifest_path, cls.__read_manifest(manifest_path))
+
+    @staticmethod
+    def __read_manifest(manifest_path: Path) -> dict:
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+
+        if manifest.get("version") != MANIFEST_VERSION:
+            raise ValueError(
+                f"Unsupported manifest version {manifest.get('version')}"
+                f" (expected {MANIFEST_VERSION}), please rebuild the index"
+            )
+
+        return manifest
+
+    @classmethod
+    def from_segment(cls, manifest_path: Path, segment_path: Path) -> "SegmentSet":
+        # a lone segment written before manifests existed; the manifest is
+        # only written once the set changes
+        manifest = {
+            "generation": 0,
+            "next_segment": 1,
+            "segments": [{"file": segment_path.name, "deleted": []}],
+        }
+        return cls(manifest_path, manifest)
+
+    @classmethod
+    def create(
+        cls, manifest_path: Path, postings: Postings, documents: Mapping[int, dict]
+    ) -> "SegmentSet":
+        return cls.__replace_all(
+            manifest_path, lambda path: write_segment(path, postings, documents)
+        )
+
+    @classmethod
+    def install(cls, manifest_path: Path, segment_path: Path) -> "SegmentSet":
+        # a segment written elsewhere, e.g. by an external merge, is moved in
+        return cls.__replace_all(
+            manifest_path, lambda path: os.replace(segment_path, path)
+        )
+
+    @classmethod
+    def __replace_all(
+        cls, manifest_path: Path, write: Callable[[Path], None]
+    ) -> "SegmentSet":
+        # replace whatever the manifest lists with a single new segment; the
+        # old segments are not opened, they may be of an older format
+        with _manifest_lock(manifest_path):
+            if manifest_path.exists():
+                old = cls.__read_manifest(manifest_path)
+                index_id, generation, next_segment, old_files = (
+                    old.get("index_id") or uuid.uuid4().hex,
+                    old["generation"],
+                    old["next_segment"],
+                    [entry["file"] for entry in old["segments"]],
+                )
+            else:
+                index_id, generation, next_segment, old_files = (
+                    uuid.uuid4().hex,
+                    0,
+                    1,
+                    [],
+                )
+
+            name = segment_file_name(next_segment)
+            write(manifest_path.parent / name)
+            manifest = {
+                "index_id": index_id,
+                "generation": generation + 1,
+                "next_segment": next_segment + 1,
+                "segments": [{"file": name, "deleted": []}],
+            }
+            segment_set = cls(manifest_path, manifest)
+            segment_set.__write_manifest()
+            segment_set.__remove_files(old_files)
+            return segment_set
+
+    @contextmanager
+    def writing(self) -> Iterator[None]:
+        """Hold the manifest lock, for changes based on the current segments.
+
+        The set is brought up to date with the manifest first, in case
+        another process changed it since it was read.
+        """
+        with _manifest_lock(self.manifest_path) as acquired:
+            if acquired and self.manifest_path.exists():
+                manifest = self.__read_manifest(self.manifest_path)
+                if manifest["generation"] != self.generation or (
+                    manifest.get("index_id", self.index_id) != self.index_id
+                ):
+                    self.__load(manifest)
+            yield
+
+    def __open(self) -> None:
+        self.segments = [Segment(self.directory / name) for name in self.files]
+        parts = self.parts()
+
+        if len(parts) == 1 and not parts[0][1]:
+            # one segment without tombstones is searched directly, including
+            # the BM25 impacts stored in it
+            self.postings: Postings | SegmentSetPostings = self.segments[0].postings
+            self.documents: Mapping[int, dict] = self.segments[0].documents
+        else:
+            postings = SegmentSetPostings(parts)
+            self.postings = postings
+            self.documents = SegmentSetDocuments(self.segments, postings)
+
+    def parts(self) -> list[tuple[Postings, AbstractSet[int]]]:
+        # every segment's postings and its tombstones as local ordinals
+        parts: list[tuple[Postings, AbstractSet[int]]] = []
+        for segment, deleted in zip(self.segments, self.deleted):
+            ordinals = (segment.postings.ordinal(doc_id) for doc_id in deleted)
+            parts.append(
+                (
+                    segment.postings,
+                    frozenset(ordinal for ordinal in ordinals if ordinal is not None),
+                )
+            )
+
+        return parts
+
+    def sizes(self) -> list[tuple[int, int]]:
+        return [
+            (segment.postings.doc_count, len(deleted))
+            for segment, deleted in zip(self.segments, self.deleted)
+        ]
+
+    def commit(
+        self,
+        postings: Postings,
+        documents: Mapping[int, dict],
+        deleted_doc_ids: AbstractSet[int],
+    ) -> None:
+        """Add a delta segment and tombstones as the next generation."""
+        with self.writing():
+            # another process may have changed the same documents meanwhile
+            for doc_id in postings.doc_ids:
+                if doc_id not in deleted_doc_ids and self.__locate(doc_id) is not None:
+                    raise ValueError(f"Document {doc_id} is already indexed")
+
+            for doc_id in deleted_doc_ids:
+                location = self.__locate(doc_id)
+                if location is None:
+                    raise KeyError(doc_id)
+                self.deleted[location].add(doc_id)
+
+            if postings.doc_count:
+                name = segment_file_name(self.next_segment)
+                write_segment(self.directory / name, postings, documents)
+                self.next_segment += 1
+                self.files.append(name)
+                self.deleted.append(set())
+
+            # segments without live documents are dropped right away
+            dropped = [
+                name
+                for name, segment, deleted in zip(
+                    self.files, self.segments, self.deleted
+                )
+                if len(deleted) == segment.postings.doc_count
+            ]
+            self.__replace(dropped, None)
+
+    def merge(self, indexes: Sequence[int]) -> None:
+        """Merge the given segments into one, dropping deleted documents.
+
+        `indexes` refer to the segments as they are; hold `writing()` while
+        choosing them, so that no other process changes them in between.
+        """
+        with self.writing():
+            parts = [self.parts()[i] for i in indexes]
+            merged = Postings.merge(parts)
+            # read from their segments one at a time, as they are written
+            documents = SegmentSetDocuments(
+                [self.segments[i] for i in indexes], SegmentSetPostings(parts)
+            )
+
+            name = segment_file_name(self.next_segment)
+            write_segment(self.directory / name, merged, documents)
+            self.next_segment += 1
+            self.__replace([self.files[i] for i in indexes], name)
+
+    def apply_merges(self, policy: TieredMergePolicy) -> int:
+        # one merge at a time: a merged segment may complete the next tier
+        merges = 0
+        with self.writing():
+            while plan := policy.find_merges(self.sizes()):
+                self.merge(plan[0])
+                merges += 1
+
+        return merges
+
+    def __locate(self, doc_id: int) -> int | None:
+        for i in range(len(self.segments) - 1, -1, -1):
+            if (
+                doc_id not in self.deleted[i]
+                and self.segments[i].postings.ordinal(doc_id) is not None
+            ):
+                return i
+
+        return None
+
+    def __replace(self, old_files: list[str], new_file: str | None) -> None:
+        # swap segments in the manifest, then delete the files it no longer
+        # lists; segments this process still maps stay readable
+        keep = [i for i, name in enumerate(self.files) if name not in old_files]
+        self.files = [self.files[i] for i in keep]
+        self.deleted = [self.deleted[i] for i in keep]
+        if new_file is not None:
+            self.files.append(new_file)
+            self.deleted.append(set())
+
+        self.generation += 1
+        self.__write_manifest()
+        self.__open()
+        self.__remove_files(old_files)
+
+    def __write_manifest(self) -> None:
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "index_id": self.index_id,
+            "generation": self.generation,
+            "next_segment": self.next_segment,
+            "segments": [
+                {"file": name, "deleted": sorted(deleted)}
+                for name, deleted in zip(self.files, self.deleted)
+            ],
+        }
+
+        tmp_path = self.manifest_path.with_suffix(self.manifest_path.suffix + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f, indent=2)
+
+        os.replace(tmp_path, self.manifest_path)
+
+    def __remove_files(self, names: list[str]) -> None:
+        for name in names:
+            if name not in self.files:
+                (self.directory / name).unlink(missing_ok=True)
+
+
+def segment_file_name(number: int) -> str:
+    return f"segment_{number:06d}.seg"
+
+
+@contextmanager
+def _manifest_lock(manifest_path: Path) -> Iterator[bool]:
+    # exclusive between processes, reentrant within one; yields whether this
+    # call acquired the lock
+    lock_path = manifest_path.with_suffix(".lock")
+    if _held_locks.get(lock_path):
+        _held_locks[lock_path] += 1
+        try:
+            yield False
+        finally:
+            _held_locks[lock_path] -= 1
+        return
+
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(lock_path, "a") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        _held_locks[lock_path] = 1
+        try:
+            yield True
+        finally:
+            del _held_locks[lock_path]
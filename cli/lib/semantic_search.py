@@ -1,18 +1,145 @@
-from config import TRANSFORMER_MODEL
-from sentence_transformers import SentenceTransformer
+import time
+from collections.abc import Callable
+from typing import TYPE_CHECKING
+
+import numpy as np
+from config import (
+    ANN_KMEANS_ITERATIONS,
+    ANN_LISTS,
+    EMBEDDING_BATCH_SIZE,
+    PQ_SUBSPACES,
+    QUANTIZED_RESCORE,
+    TRANSFORMER_MODEL,
+)
+from lib import ann, client, embeddings, quantize, trace
+from lib.embedding_cache import EmbeddingCache
+from lib.search import load_index, print_daemon_latency, search_index
+from lib.utils import iter_movies, print_search_results
+
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer
 
 
 class SemanticSearch:
-    def __init__(self, model: str):
-        self.model = SentenceTransformer(model)
+    def __init__(
+        self,
+        model: str,
+        cache: EmbeddingCache | None = None,
+        transformer: "SentenceTransformer | None" = None,
+    ):
+        # `transformer`: the model, if already loaded elsewhere
+        self.model_name = model
+        self.cache = cache
+        self.__model = transformer
+        # encodes query texts; replaceable, e.g. by a `BatchingEncoder`
+        self.encode: Callable[[list[str]], np.ndarray] = self.generate_embeddings
+        self.store: embeddings.EmbeddingStore | None = None
+        self.ann: ann.IVFIndex | None = None
+        self.quantized: quantize.QuantizedEmbeddings | None = None
+
+    @property
+    def model(self) -> "SentenceTransformer":
+        return self.load_model()
+
+    def load_model(self) -> "SentenceTransformer":
+        # loaded (and sentence_transformers imported, which takes seconds) on
+        # first use: queries answered from the cache never need it
+        if self.__model is None:
+            with trace.span("semantic.model_load"):
+                from sentence_transformers import SentenceTransformer
+
+                self.__model = SentenceTransformer(self.model_name)
+        return self.__model
 
     def generate_embedding(self, text: str):
         if not text.strip():
             raise ValueError("You must provide a text.")
 
-        embedding: list = self.model.encode([text])
+        return self.embed_queries([text])[0]
+
+    def embed_queries(self, queries: list[str]) -> np.ndarray:
+        # through the query cache, if any; only misses reach the model
+        if self.cache is None:
+            return self.encode(queries)
+
+        return self.cache.get_many(self.model_name, queries, self.encode)
+
+    def generate_embeddings(
+        self, texts: list[str], batch_size: int = EMBEDDING_BATCH_SIZE
+    ) -> np.ndarray:
+        return self.model.encode(texts, batch_size=batch_size, convert_to_numpy=True)
+
+    def load_embeddings(self) -> None:
+        with trace.span("semantic.load"):
+            store = embeddings.EmbeddingStore.load()
+        if store.model != self.model_name:
+            raise ValueError(
+                f"The embeddings were built with {store.model}, not"
+                f" {self.model_name} (run 'build_embeddings')"
+            )
+
+        self.store = store
+
+    def load_ann(self) -> None:
+        if self.store is None:
+            self.load_embeddings()
+
+        self.ann = ann.IVFIndex.load(self.store.manifest.get("build_id"))
+
+    def load_quantized(self) -> None:
+        if self.store is None:
+            self.load_embeddings()
 
-        return embedding[0]
+        self.quantized = quantize.QuantizedEmbeddings.load(
+            self.store.manifest.get("build_id")
+        )
+
+    def search(
+        self,
+        queries: list[str],
+        limit: int,
+        nprobe: int | None = None,
+        quantized: bool = False,
+        rescore: int = QUANTIZED_RESCORE,
+    ) -> list[list[tuple[int, float]]]:
+        # all queries are encoded in one batch; with `nprobe` only that many
+        # IVF lists are scored per query, with `quantized` the compressed
+        # codes (and a rescored shortlist), otherwise the whole matrix
+        if self.store is None:
+            self.load_embeddings()
+        if nprobe is not None and self.ann is None:
+            self.load_ann()
+        if quantized and self.quantized is None:
+            self.load_quantized()
+
+        with trace.span("semantic.embed"):
+            query_vectors = embeddings.normalize(self.embed_queries(queries))
+        trace.count("queries_embedded", len(queries))
+
+        with trace.span("semantic.score"):
+            if quantized:
+                rows, scores = self.quantized.search(
+                    query_vectors, limit, self.store.vectors, rescore
+                )
+            elif nprobe is not None:
+                rows, scores = zip(
+                    *self.ann.search(self.store.vectors, query_vectors, limit, nprobe)
+                )
+            else:
+                rows, scores = embeddings.top_k_rows(
+                    self.store.vectors, query_vectors, limit
+                )
+                trace.count("vectors_scored", len(self.store) * len(queries))
+
+        with trace.span("semantic.doc_ids"):
+            doc_ids = self.store.doc_ids
+            return [
+                [
+                    (int(doc_ids[row]), float(score))
+                    for row, score in zip(hits, hit_scores)
+                ]
+                for hits, hit_scores in zip(rows, scores)
+            ]
 
 
 def verify_model(model: str) -> None:
@@ -27,9 +154,217 @@ def verify_model(model: str) -> None:
 
 
 def embed_text(text):
-    semantic_search = SemanticSearch(TRANSFORMER_MODEL)
+    cache = EmbeddingCache()
+    semantic_search = SemanticSearch(TRANSFORMER_MODEL, cache)
     embedding = semantic_search.generate_embedding(text)
+    cache.close()
 
     print(f"Text: {text}")
     print(f"First 3 dimensions: {embedding[:3]}")
     print(f"Dimensions: {embedding.shape[0]}")
+    print_cache_stats(cache)
+
+
+def print_cache_stats(cache: EmbeddingCache) -> None:
+    stats = cache.stats()
+    print(
+        f"Query cache: {stats['hits']} memory hits, {stats['disk_hits']} disk hits,"
+        f" {stats['misses']} misses, {stats['evictions']} evictions"
+    )
+
+
+def build_embeddings(batch_size: int = EMBEDDING_BATCH_SIZE) -> None:
+    def encoder() -> embeddings.Encoder:
+        semantic_search = SemanticSearch(TRANSFORMER_MODEL)
+        return lambda texts: semantic_search.generate_embeddings(texts, batch_size)
+
+    start = time.perf_counter()
+    with trace.span("embeddings.build"):
+        encoded, reused = embeddings.build_embeddings(
+            iter_movies, TRANSFORMER_MODEL, encoder, batch_size
+        )
+    seconds = time.perf_counter() - start
+    trace.count("documents_encoded", encoded)
+
+    print(f"Encoded {encoded} documents, reused {reused} unchanged embeddings")
+    print(f"Took {seconds:.1f}s")
+
+
+def build_ann(
+    n_lists: int | None = ANN_LISTS, iterations: int = ANN_KMEANS_ITERATIONS
+) -> None:
+    try:
+        store = embeddings.EmbeddingStore.load()
+    except (FileNotFoundError, ValueError) as err:
+        print(err)
+        return
+
+    start = time.perf_counter()
+    index = ann.IVFIndex.build(
+        store.vectors, store.manifest.get("build_id"), n_lists, iterations
+    )
+    index.save()
+    seconds = time.perf_counter() - start
+
+    print(f"Indexed {len(index)} embeddings in {index.n_lists} lists")
+    print(f"Took {seconds:.1f}s")
+
+
+def evaluate_ann(sample: int, limit: int, nprobes: list[int], seed: int = 0) -> None:
+    # stored embeddings of random documents serve as queries
+    try:
+        store = embeddings.EmbeddingStore.load()
+        index = ann.IVFIndex.load(store.manifest.get("build_id"))
+    except (FileNotFoundError, ValueError) as err:
+        print(err)
+        return
+
+    rng = np.random.default_rng(seed)
+    rows = np.sort(rng.choice(len(store), size=min(sample, len(store)), replace=False))
+    results = ann.evaluate(index, store.vectors, store.vectors[rows], limit, nprobes)
+
+    print(f"{len(rows)} queries, {len(store)} embeddings, {index.n_lists} lists")
+    print(f"{'nprobe':>8} {'recall@' + str(limit):>10} {'p50 ms':>8} {'p95 ms':>8}")
+    for result in results:
+        nprobe = "exact" if result["nprobe"] is None else result["nprobe"]
+        print(
+            f"{nprobe:>8} {result['recall']:>10.3f} {result['p50_ms']:>8.2f}"
+            f" {result['p95_ms']:>8.2f}   scanned {result['scanned']:.1%}"
+        )
+
+
+def build_quantized(kind: str, subspaces: int = PQ_SUBSPACES) -> None:
+    try:
+        store = embeddings.EmbeddingStore.load()
+        start = time.perf_counter()
+        quantized = quantize.QuantizedEmbeddings.build(
+            store.vectors, store.manifest.get("build_id"), kind, subspaces
+        )
+    except (FileNotFoundError, ValueError) as err:
+        print(err)
+        return
+
+    quantized.save()
+    seconds = time.perf_counter() - start
+
+    float_bytes = store.vectors.nbytes
+    print(
+        f"Quantized {len(quantized)} embeddings to {kind}:"
+        f" {quantized.nbytes / 2**20:.1f} MiB"
+        f" (float32 {float_bytes / 2**20:.1f} MiB,"
+        f" {float_bytes / quantized.nbytes:.1f}x smaller)"
+    )
+    print(f"Took {seconds:.1f}s")
+
+
+def evaluate_quantized(
+    sample: int, limit: int, rescores: list[int], seed: int = 0
+) -> None:
+    # stored embeddings of random documents serve as queries
+    try:
+        store = embeddings.EmbeddingStore.load()
+        quantized = quantize.QuantizedEmbeddings.load(store.manifest.get("build_id"))
+    except (FileNotFoundError, ValueError) as err:
+        print(err)
+        return
+
+    rng = np.random.default_rng(seed)
+    rows = np.sort(rng.choice(len(store), size=min(sample, len(store)), replace=False))
+    results = quantize.evaluate(
+        quantized, store.vectors, store.vectors[rows], limit, rescores
+    )
+
+    print(f"{len(rows)} queries, {len(store)} embeddings")
+    print(
+        f"{'kind':>8} {'rescore':>8} {'MiB':>8} {'recall@' + str(limit):>10}"
+        f" {'p50 ms':>8} {'p95 ms':>8}"
+    )
+    for result in results:
+        rescore = "-" if result["rescore"] is None else result["rescore"]
+        print(
+            f"{result['kind']:>8} {rescore:>8} {result['bytes'] / 2**20:>8.1f}"
+            f" {result['recall']:>10.3f} {result['p50_ms']:>8.2f}"
+            f" {result['p95_ms']:>8.2f}"
+        )
+
+
+def search(
+    queries: list[str],
+    limit: int,
+    nprobe: int | None = None,
+    quantized: bool = False,
+    rescore: int = QUANTIZED_RESCORE,
+) -> None:
+    # answered by the search daemon if one is running
+    start = time.perf_counter()
+    response = client.request(
+        "/semantic",
+        {
+            "queries": queries,
+            "limit": limit,
+            "nprobe": nprobe,
+            "quantized": quantized,
+            "rescore": rescore,
+        },
+    )
+    if response is not None:
+        seconds = time.perf_counter() - start
+        results = [
+            [(hit["id"], hit["title"], hit["score"]) for hit in hits]
+            for hits in response["results"]
+        ]
+        print_semantic_results(queries, results, seconds)
+        print_daemon_latency(response)
+        return
+
+    cache = EmbeddingCache()
+    semantic_search = SemanticSearch(TRANSFORMER_MODEL, cache)
+    try:
+        semantic_search.load_embeddings()
+        if nprobe is not None:
+            semantic_search.load_ann()
+        if quantized:
+            semantic_search.load_quantized()
+    except (FileNotFoundError, ValueError) as err:
+        print(err)
+        cache.close()
+        return
+
+    start = time.perf_counter()
+    hits = semantic_search.search(queries, limit, nprobe, quantized, rescore)
+    seconds = time.perf_counter() - start
+
+    # titles come from the keyword index' stored documents
+    indexed = load_index()
+    results = []
+    for query_hits in hits:
+        doc_ids = [doc_id for doc_id, _ in query_hits]
+        stored = search_index.hydrate(doc_ids) if indexed else [{}] * len(doc_ids)
+        results.append(
+            [
+                (doc_id, hit.get("title", ""), score)
+                for (doc_id, score), hit in zip(query_hits, stored)
+            ]
+        )
+
+    # includes loading the model, unless every query was cached
+    print_semantic_results(queries, results, seconds)
+    print_cache_stats(cache)
+    cache.close()
+
+
+def print_semantic_results(
+    queries: list[str], results: list[list[tuple[int, str, float]]], seconds: float
+) -> None:
+    for query, hits in zip(queries, results):
+        print(f"Results for: {query}")
+        if not hits:
+            print("Nothing found")
+            continue
+
+        print_search_results(hits, bm25=True)
+
+    print(
+        f"{len(queries)} queries in {seconds * 1000:.1f} ms"
+        f" ({len(queries) / seconds:.1f} queries/s)"
+    )
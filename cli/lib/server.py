@@ -0,0 +1,459 @@
+import json
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+from asyncio import QueueFull
+from collections import deque
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+from config import (
+    BATCH_MAX_QUEUE,
+    BATCH_MAX_SIZE,
+    BATCH_MAX_WAIT_MS,
+    BM25_B,
+    BM25_ENGINE,
+    BM25_K1,
+    CACHE_DIR,
+    CACHE_EMBEDDINGS_MANIFEST_FILE,
+    CACHE_IVF_MANIFEST_FILE,
+    CACHE_MANIFEST_FILE,
+    CACHE_QUANTIZED_MANIFEST_FILE,
+    CACHE_RESULTS_FILE,
+    CACHE_SEGMENT_FILE,
+    CACHE_SERVE_FILE,
+    HYBRID_ALPHA,
+    HYBRID_CANDIDATES,
+    MAX_SEARCH_RESULTS,
+    QUANTIZED_RESCORE,
+    RESULT_CACHE_SIZE,
+    SERVE_LATENCY_WINDOW,
+    TRANSFORMER_MODEL,
+)
+from lib import trace
+from lib.batcher import BatchingEncoder
+from lib.inverted_index import InvertedIndex
+from lib.result_cache import ResultCache
+
+# JSON API (POST bodies and responses are JSON objects):
+#
+#   POST /search     {"query", "limit"?}                     boolean match
+#   POST /bm25       {"query", "limit"?, "k1"?, "b"?, "proximity"?, "engine"?}
+#                                                            BM25 ranking
+#   POST /semantic   {"queries", "limit"?, "nprobe"?, "quantized"?, "rescore"?}
+#   POST /hybrid     {"query", "limit"?, "fusion"?, "alpha"?, "candidates"?,
+#                     "rerank"?}                             fused, with timings
+#   GET  /stats      request counts and latency percentiles per endpoint,
+#                    result cache hit ratio, embedding batch fill rate and
+#                    queueing delay
+#   GET  /metrics    traced stages and counters as Prometheus text (empty
+#                    unless the daemon was started with --profile/--metrics)
+#
+# Every answer carries "latency_ms", the time spent in the daemon; errors
+# are {"error": message} with status 400 (bad request), 503 (no index, or
+# too many queries waiting for the model) or 500 (a bug, logged with its
+# traceback).
+
+
+class ServiceUnavailable(Exception):
+    pass
+
+
+class SearchService:
+    """Keyword index, embeddings and model, loaded once for all requests.
+
+    Before a request is answered, the index or embeddings are reloaded if
+    their manifests changed on disk (after 'add', 'build_embeddings', ...).
+    A reload swaps in new objects (the model is kept), so requests in
+    flight finish on the old ones; it happens outside of `lock`, which only
+    guards the swap and the request stats. Boolean and BM25 results are cached per
+    index generation. Queries of concurrent requests that miss the query
+    cache are encoded together by a `BatchingEncoder`.
+    """
+
+    def __init__(
+        self,
+        semantic: bool = True,
+        max_batch_size: int = BATCH_MAX_SIZE,
+        max_wait_ms: float = BATCH_MAX_WAIT_MS,
+        max_queue: int = BATCH_MAX_QUEUE,
+        result_cache_size: int = RESULT_CACHE_SIZE,
+        persist_results: bool = False,
+    ) -> None:
+        self.index = InvertedIndex()
+        self.index_version: tuple | None = None
+        self.results = ResultCache(
+            CACHE_RESULTS_FILE if persist_results else None, result_cache_size
+        )
+        self.semantic = None
+        self.new_semantic: Callable[[], Any] | None = None
+        self.hybrid: Callable[..., Any] | None = None
+        # runs the two retrievers of hybrid requests side by side
+        self.executor = ThreadPoolExecutor(thread_name_prefix="hybrid")
+        self.batcher: BatchingEncoder | None = None
+        self.embeddings_version: tuple | None = None
+        self.lock = threading.Lock()
+        # one reload of the index, and of the embeddings, at a time
+        self.index_lock = threading.Lock()
+        self.embeddings_lock = threading.Lock()
+        self.latencies: dict[str, deque[float]] = {}
+        self.counts: dict[str, int] = {}
+        self.errors: dict[str, int] = {}
+        self.started = time.time()
+
+        if semantic:
+            # optional: without sentence_transformers only keyword search runs
+            try:
+                import sentence_transformers  # noqa: F401
+                from lib.embedding_cache import EmbeddingCache
+                from lib.hybrid_search import HybridSearch
+                from lib.semantic_search import SemanticSearch
+            except ImportError as err:
+                print(f"Semantic search disabled: {err}", file=sys.stderr)
+            else:
+                cache = EmbeddingCache()
+                self.semantic = SemanticSearch(TRANSFORMER_MODEL, cache)
+                self.batcher = BatchingEncoder(
+                    self.semantic.generate_embeddings,
+                    max_batch_size=max_batch_size,
+                    max_wait_ms=max_wait_ms,
+                    max_queue=max_queue,
+                )
+                self.semantic.encode = self.batcher
+
+                def new_semantic():
+                    semantic = SemanticSearch(
+                        TRANSFORMER_MODEL, cache, self.semantic.model
+                    )
+                    semantic.encode = self.batcher
+                    return semantic
+
+                self.new_semantic = new_semantic
+                self.hybrid = HybridSearch
+
+    def keyword_index(self) -> InvertedIndex:
+        version = _file_version(CACHE_MANIFEST_FILE, CACHE_SEGMENT_FILE)
+        with self.lock:
+            if version == self.index_version:
+                return self.index
+
+        with self.index_lock:
+            # unless another request loaded it meanwhile
+            with self.lock:
+                if version == self.index_version:
+                    return self.index
+
+            index = InvertedIndex()
+            try:
+                index.load()
+            except FileNotFoundError as err:
+                raise ServiceUnavailable(str(err)) from err
+            with self.lock:
+                self.index, self.index_version = index, version
+            return index
+
+    def semantic_search(self, nprobe: int | None = None, quantized: bool = False):
+        if self.semantic is None:
+            raise ServiceUnavailable("Semantic search is not enabled in this daemon")
+
+        version = _file_version(
+            CACHE_EMBEDDINGS_MANIFEST_FILE,
+            CACHE_IVF_MANIFEST_FILE,
+            CACHE_QUANTIZED_MANIFEST_FILE,
+        )
+
+        def loaded(semantic) -> bool:
+            return (nprobe is None or semantic.ann is not None) and (
+                not quantized or semantic.quantized is not None
+            )
+
+        with self.lock:
+            semantic = self.semantic
+            if version == self.embeddings_version and loaded(semantic):
+                return semantic
+
+        with self.embeddings_lock:
+            with self.lock:
+                semantic, current = self.semantic, self.embeddings_version
+            try:
+                if version != current:
+                    semantic = self.new_semantic()
+                    semantic.load_embeddings()
+                if nprobe is not None and semantic.ann is None:
+                    semantic.load_ann()
+                if quantized and semantic.quantized is None:
+                    semantic.load_quantized()
+            except (FileNotFoundError, ValueError) as err:
+                raise ServiceUnavailable(str(err)) from err
+            with self.lock:
+                self.semantic, self.embeddings_version = semantic, version
+            return semantic
+
+    def warm_up(self) -> None:
+        # load everything up front, so the first request does not pay for it
+        try:
+            self.keyword_index()
+        except ServiceUnavailable as err:
+            print(err, file=sys.stderr)
+
+        if self.semantic is not None:
+            self.semantic.load_model()
+            try:
+                self.semantic_search()
+            except ServiceUnavailable as err:
+                print(err, file=sys.stderr)
+
+    def answer_search(self, payload: dict) -> dict:
+        index = self.keyword_index()
+        limit = int(payload.get("limit", MAX_SEARCH_RESULTS))
+        doc_ids = self.results.search(index, str(payload["query"]), limit)
+        return {"results": index.hydrate(doc_ids, ("id", "title"))}
+
+    def answer_bm25(self, payload: dict) -> dict:
+        index = self.keyword_index()
+        scores = self.results.bm25_search(
+            index,
+            str(payload["query"]),
+            int(payload.get("limit", MAX_SEARCH_RESULTS)),
+            float(payload.get("k1", BM25_K1)),
+            float(payload.get("b", BM25_B)),
+            float(payload.get("proximity", 0.0)),
+            str(payload.get("engine", BM25_ENGINE)),
+        )
+        hits = index.hydrate(scores, ("id", "title"))
+        return {
+            "results": [
+                {**hit, "score": score} for hit, score in zip(hits, scores.values())
+            ]
+        }
+
+    def answer_semantic(self, payload: dict) -> dict:
+        queries = [str(query) for query in payload["queries"]]
+        nprobe = payload.get("nprobe")
+        nprobe = None if nprobe is None else int(nprobe)
+        quantized = bool(payload.get("quantized", False))
+
+        semantic = self.semantic_search(nprobe, quantized)
+        results = semantic.search(
+            queries,
+            int(payload.get("limit", MAX_SEARCH_RESULTS)),
+            nprobe,
+            quantized,
+            int(payload.get("rescore", QUANTIZED_RESCORE)),
+        )
+
+        # titles come from the keyword index' stored documents
+        try:
+            index = self.keyword_index()
+        except ServiceUnavailable:
+            index = None
+
+        def titled(hits: list[tuple[int, float]]) -> list[dict]:
+            doc_ids = [doc_id for doc_id, _ in hits]
+            stored = index.hydrate(doc_ids) if index else [{}] * len(hits)
+            return [
+                {"id": doc_id, "title": hit.get("title", ""), "score": score}
+                for (doc_id, score), hit in zip(hits, stored)
+            ]
+
+        return {
+            "results": [titled(hits) for hits in results],
+            "cache": semantic.cache.stats(),
+        }
+
+    def answer_hybrid(self, payload: dict) -> dict:
+        semantic = self.semantic_search()
+        index = self.keyword_index()
+        hybrid = self.hybrid(index, semantic, self.executor)
+        results, timings = hybrid.search(
+            str(payload["query"]),
+            int(payload.get("limit", MAX_SEARCH_RESULTS)),
+            str(payload.get("fusion", "rrf")),
+            float(payload.get("alpha", HYBRID_ALPHA)),
+            int(payload.get("candidates", HYBRID_CANDIDATES)),
+            bool(payload.get("rerank", False)),
+        )
+        hits = index.hydrate((doc_id for doc_id, _ in results), ("id", "title"))
+        return {
+            "results": [
+                {**hit, "score": score} for hit, (_, score) in zip(hits, results)
+            ],
+            "timings": timings,
+        }
+
+    def record(self, endpoint: str, seconds: float, failed: bool) -> None:
+        with self.lock:
+            window = self.latencies.setdefault(
+                endpoint, deque(maxlen=SERVE_LATENCY_WINDOW)
+            )
+            window.append(seconds)
+            self.counts[endpoint] = self.counts.get(endpoint, 0) + 1
+            if failed:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def stats(self) -> dict:
+        # latency percentiles over the last SERVE_LATENCY_WINDOW requests
+        with self.lock:
+            endpoints = {}
+            for endpoint, window in self.latencies.items():
+                ms = np.array(window) * 1000
+                endpoints[endpoint] = {
+                    "requests": self.counts[endpoint],
+                    "errors": self.errors.get(endpoint, 0),
+                    "p50_ms": float(np.percentile(ms, 50)),
+                    "p95_ms": float(np.percentile(ms, 95)),
+                    "p99_ms": float(np.percentile(ms, 99)),
+                }
+            stats = {"uptime_s": time.time() - self.started, "endpoints": endpoints}
+
+        stats["result_cache"] = self.results.stats()
+        if self.batcher is not None:
+            stats["batcher"] = self.batcher.stats()
+        return stats
+
+    def close(self) -> None:
+        self.executor.shutdown()
+        self.results.close()
+        if self.batcher is not None:
+            self.batcher.close()
+
+
+ROUTES: dict[str, Callable[[SearchService, dict], dict]] = {
+    "/search": SearchService.answer_search,
+    "/bm25": SearchService.answer_bm25,
+    "/semantic": SearchService.answer_semantic,
+    "/hybrid": SearchService.answer_hybrid,
+}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: "SearchServer"
+
+    def do_GET(self) -> None:
+        if self.path == "/metrics":
+            self.__respond_text(HTTPStatus.OK, trace.prometheus_text())
+        elif self.path == "/stats":
+            self.__respond(HTTPStatus.OK, self.server.service.stats())
+        else:
+            self.__respond(HTTPStatus.NOT_FOUND, {"error": f"No route {self.path}"})
+
+    def do_POST(self) -> None:
+        start = time.perf_counter()
+        route = ROUTES.get(self.path)
+        if route is None:
+            self.__respond(HTTPStatus.NOT_FOUND, {"error": f"No route {self.path}"})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            body = route(self.server.service, json.loads(self.rfile.read(length)))
+            status = HTTPStatus.OK
+        except KeyError as err:
+            status, body = HTTPStatus.BAD_REQUEST, {"error": f"Missing field {err}"}
+        except (TypeError, ValueError) as err:
+            status, body = HTTPStatus.BAD_REQUEST, {"error": str(err)}
+        except ServiceUnavailable as err:
+            status, body = HTTPStatus.SERVICE_UNAVAILABLE, {"error": str(err)}
+        except QueueFull:
+            status = HTTPStatus.SERVICE_UNAVAILABLE
+            body = {"error": "Too many queries waiting to be embedded"}
+        except Exception as err:  # noqa: BLE001
+            # answered and counted like any other error, not a dropped
+            # connection
+            traceback.print_exc()
+            status = HTTPStatus.INTERNAL_SERVER_ERROR
+            body = {"error": f"Internal error: {err!r}"}
+
+        seconds = time.perf_counter() - start
+        body["latency_ms"] = seconds * 1000
+        self.server.service.record(self.path, seconds, status != HTTPStatus.OK)
+        self.__respond(status, body)
+        self.log_message('"POST %s" %d %.1f ms', self.path, status, seconds * 1000)
+
+    def log_request(self, code="-", size="-") -> None:
+        # POST requests are logged with their latency instead
+        if self.command != "POST":
+            super().log_request(code, size)
+
+    def __respond(self, status: HTTPStatus, body: dict) -> None:
+        self.__send(status, json.dumps(body).encode(), "application/json")
+
+    def __respond_text(self, status: HTTPStatus, text: str) -> None:
+        self.__send(status, text.encode(), "text/plain; version=0.0.4")
+
+    def __send(self, status: HTTPStatus, data: bytes, content_type: str) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class SearchServer(ThreadingHTTPServer):
+    # one thread per connection, so slow clients do not block others
+    daemon_threads = True
+    request_queue_size = 128  # pending connections before clients are refused
+
+    def __init__(self, address: tuple[str, int], service: SearchService) -> None:
+        super().__init__(address, _Handler)
+        self.service = service
+
+
+def serve(host: str, port: int, semantic: bool = True, **options) -> None:
+    """Serve until interrupted; `options` go to `SearchService`."""
+    service = SearchService(semantic, **options)
+    service.warm_up()
+
+    server = SearchServer((host, port), service)
+    host, port = server.server_address[:2]
+    _write_serve_file({"host": host, "port": port, "pid": os.getpid()})
+
+    # SIGTERM unwinds like Ctrl-C, so the serve file is removed
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    print(f"Serving on http://{host}:{port} (pid {os.getpid()})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        _remove_serve_file(os.getpid())
+
+
+def _file_version(*paths: Path) -> tuple:
+    # (mtime, size) of every file; None for files that do not exist
+    versions = []
+    for path in paths:
+        try:
+            stat = path.stat()
+            versions.append((stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            versions.append(None)
+    return tuple(versions)
+
+
+def _write_serve_file(info: dict) -> None:
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp_path = CACHE_SERVE_FILE.with_suffix(".json.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(info, f)
+    os.replace(tmp_path, CACHE_SERVE_FILE)
+
+
+def _remove_serve_file(pid: int) -> None:
+    # only our own: another daemon may have started since
+    try:
+        with open(CACHE_SERVE_FILE, "r") as f:
+            if json.load(f).get("pid") == pid:
+                CACHE_SERVE_FILE.unlink()
+    except (FileNotFoundError, ValueError):
+        pass
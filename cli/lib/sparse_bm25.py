@@ -0,0 +1,179 @@
+from collections.abc import Callable, Sequence
+from itertools import pairwise
+
+import numpy as np
+from config import SPARSE_BATCH_POSTINGS
+from lib import trace
+from lib.postings import IMPACT_TYPE, ORDINAL_TYPE, Postings
+from lib.segment_set import SegmentSetPostings
+
+Column = tuple[np.ndarray, np.ndarray]  # (doc ordinals, impacts)
+
+# queries with a posting per this many documents get dense rows of doc scores:
+# zeroing and scanning a row is much cheaper per document than sorting is
+# per posting
+DENSE_DOCS_PER_POSTING = 16
+DENSE_BLOCK_CELLS = 1 << 22  # doc scores of the dense rows summed at once
+
+
+class SparseBM25:
+    """BM25 top-k as sparse matrix products, with numpy.
+
+    The BM25 impacts of all postings form a doc x term matrix in CSC layout:
+    column t holds term t's postings, its doc ordinals as row indices and
+    its impacts as values. That is the postings layout itself, so columns
+    are zero-copy views of the postings and of `impacts(token)` (stored in
+    the segment for the default (k1, b), computed from term frequencies and
+    doc lengths otherwise).
+
+    A batch of queries is a sparse query x term matrix of token counts, and
+    its product with the transposed doc matrix the query x doc scores: one
+    entry per query token and posting, summed per (query, doc) cell. The
+    entries of a cell are added in query token order, like the reference
+    implementation does, so the scores are equal to the last bit. Impacts
+    are positive, so cells without entries are the documents not matched.
+    The top hits of every query are then selected by partitioning.
+    """
+
+    def __init__(
+        self,
+        postings: Postings | SegmentSetPostings,
+        impacts: Callable[[str], Sequence[float]],
+        batch_postings: int = SPARSE_BATCH_POSTINGS,
+    ) -> None:
+        self.postings = postings
+        self.impacts = impacts
+        self.batch_postings = batch_postings
+        # ordinals of deleted documents included, they are never scored
+        self.doc_count = len(postings.doc_ids)
+
+    def top_k(self, tokens: Sequence[str], limit: int) -> list[tuple[int, float]]:
+        return self.top_k_many([tokens], limit)[0]
+
+    def top_k_many(
+        self, queries: Sequence[Sequence[str]], limit: int
+    ) -> list[list[tuple[int, float]]]:
+        """Top `limit` (ordinal, score) of each query, like `max_score_top_k`.
+
+        Queries are multiplied in batches of at most `batch_postings`
+        postings (a single larger query on its own), which bounds the
+        memory of the product.
+        """
+        if limit <= 0:
+            return [[] for _ in queries]
+
+        columns: dict[str, Column] = {}
+        found: list[list[tuple[int, float]]] = []
+        batch: list[Sequence[str]] = []
+        batch_size = 0
+        for tokens in queries:
+            size = 0
+            for token in tokens:
+                if token not in columns:
+                    columns[token] = self.__column(token)
+                size += len(columns[token][0])
+
+            if batch and batch_size + size > self.batch_postings:
+                found.extend(self.__multiply(batch, columns, limit))
+                batch, batch_size = [], 0
+            batch.append(tokens)
+            batch_size += size
+
+        if batch:
+            found.extend(self.__multiply(batch, columns, limit))
+        return found
+
+    def __column(self, token: str) -> Column:
+        ordinals, _ = self.postings.lookup(token)
+        return (
+            np.frombuffer(ordinals, dtype=np.dtype(ORDINAL_TYPE)),
+            np.frombuffer(self.impacts(token), dtype=np.dtype(IMPACT_TYPE)),
+        )
+
+    def __multiply(
+        self,
+        batch: list[Sequence[str]],
+        columns: dict[str, Column],
+        limit: int,
+    ) -> list[list[tuple[int, float]]]:
+        # a query with many postings per document is summed into a dense
+        # row of doc scores, the others by sorting their postings
+        dense, sparse = [], []
+        for query, tokens in enumerate(batch):
+            postings = sum(len(columns[token][0]) for token in tokens)
+            if postings * DENSE_DOCS_PER_POSTING >= self.doc_count:
+                dense.append(query)
+            else:
+                sparse.append(query)
+
+        hits: dict[int, tuple[np.ndarray, np.ndarray]] = {}
+        with trace.span("bm25.score"):
+            rows = max(1, DENSE_BLOCK_CELLS // max(self.doc_count, 1))
+            for start in range(0, len(dense), rows):
+                block = dense[start : start + rows]
+                hits.update(zip(block, self.__sum_dense(block, batch, columns)))
+            hits.update(zip(sparse, self.__sum_sparse(sparse, batch, columns)))
+            trace.count(
+                "documents_scored", sum(len(found[0]) for found in hits.values())
+            )
+
+        with trace.span("bm25.top_k"):
+            return [_top_k(*hits[query], limit) for query in range(len(batch))]
+
+    def __entries(
+        self, queries: list[int], batch: list[Sequence[str]], columns: dict[str, Column]
+    ) -> tuple[np.ndarray, np.ndarray]:
+        # one entry per (query token, posting), keyed by its cell
+        # row * doc_count + ordinal, in query token order
+        keys = [np.empty(0, dtype=np.int64)]
+        values = [np.empty(0)]
+        for row, query in enumerate(queries):
+            for token in batch[query]:
+                ordinals, impacts = columns[token]
+                keys.append(ordinals + np.int64(row * self.doc_count))
+                values.append(impacts)
+
+        keys, values = np.concatenate(keys), np.concatenate(values)
+        trace.count("postings_scanned", len(keys))
+        return keys, values
+
+    def __sum_dense(
+        self, queries: list[int], batch: list[Sequence[str]], columns: dict[str, Column]
+    ) -> list[tuple[np.ndarray, np.ndarray]]:
+        # bincount sums each cell's entries in input order, from 0.0; cells
+        # without entries stay 0.0
+        keys, values = self.__entries(queries, batch, columns)
+        cells = len(queries) * self.doc_count
+        rows = np.bincount(keys, weights=values, minlength=cells)
+        found = []
+        for scores in rows.reshape(len(queries), self.doc_count):
+            ordinals = np.flatnonzero(scores)
+            found.append((ordinals, scores[ordinals]))
+        return found
+
+    def __sum_sparse(
+        self, queries: list[int], batch: list[Sequence[str]], columns: dict[str, Column]
+    ) -> list[tuple[np.ndarray, np.ndarray]]:
+        # the distinct cells, sorted by row and ordinal, and the sums of
+        # their entries (in input order, from 0.0, like the dense rows)
+        keys, values = self.__entries(queries, batch, columns)
+        cells, entry_cells = np.unique(keys, return_inverse=True)
+        scores = np.bincount(entry_cells, weights=values, minlength=len(cells))
+        rows, ordinals = np.divmod(cells, self.doc_count)
+        bounds = np.searchsorted(rows, np.arange(len(queries) + 1))
+        return [
+            (ordinals[start:end], scores[start:end]) for start, end in pairwise(bounds)
+        ]
+
+
+def _top_k(
+    ordinals: np.ndarray, scores: np.ndarray, limit: int
+) -> list[tuple[int, float]]:
+    # by descending score, ties by ascending ordinal; only the scores tied
+    # with or above the limit-th best get sorted
+    if len(scores) > limit:
+        keep = scores >= np.partition(scores, -limit)[-limit]
+        ordinals, scores = ordinals[keep], scores[keep]
+
+    top = np.lexsort((ordinals, -scores))[:limit]
+    return list(zip(ordinals[top].tolist(), scores[top].tolist()))
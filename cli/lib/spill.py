@@ -0,0 +1,253 @@
+import heapq
+import tempfile
+from array import array
+from collections.abc import Callable, Iterable, Iterator, Sequence
+from contextlib import ExitStack
+from itertools import groupby, pairwise, repeat
+from operator import itemgetter
+from pathlib import Path
+
+from lib.postings import (
+    DOC_ID_TYPE,
+    DOC_LENGTH_TYPE,
+    IMPACT_TYPE,
+    OFFSET_TYPE,
+    ORDINAL_TYPE,
+    TF_TYPE,
+    Postings,
+)
+from lib.segment import (
+    DOCUMENT_SECTIONS,
+    DocumentWriter,
+    Segment,
+    write_sections,
+    write_segment,
+)
+
+# rough in-memory cost of the builder's data, used against the memory budget
+POSTING_BYTES = 8  # uint32 ordinal + uint32 tf
+POSITION_OFFSET_BYTES = 8  # uint64 offset of a posting's encoded positions
+TERM_BYTES = 200  # term dict entry, str object, offsets
+DOCUMENT_BYTES = 600  # movie dict and its str objects, excluding the text
+
+
+class SpillingBuilder:
+    """Holds inverted batches in memory and spills them to sorted runs.
+
+    Every batch is the `Postings` of some documents plus the documents
+    themselves. Once their estimated size exceeds `memory_budget` bytes the
+    batches are merged into one run, written as a segment (without impacts)
+    to `run_dir`, and dropped from memory.
+    """
+
+    def __init__(self, run_dir: Path, memory_budget: int) -> None:
+        self.run_dir = run_dir
+        self.memory_budget = memory_budget
+        self.batches: list[Postings] = []
+        self.documents: dict[int, dict] = {}
+        self.held_bytes = 0
+        self.runs: list[Segment] = []
+
+    def add(self, postings: Postings, movies: Sequence[dict]) -> None:
+        self.batches.append(postings)
+        self.held_bytes += POSTING_BYTES * len(postings.tfs) + TERM_BYTES * len(
+            postings.terms
+        )
+        if postings.positional:
+            self.held_bytes += len(postings.positions) + POSITION_OFFSET_BYTES * len(
+                postings.tfs
+            )
+        for movie in movies:
+            self.documents[movie["id"]] = movie
+            self.held_bytes += DOCUMENT_BYTES + sum(
+                len(value) for value in movie.values() if isinstance(value, str)
+            )
+
+        if self.held_bytes > self.memory_budget:
+            self.spill()
+
+    def merged(self) -> Postings:
+        return Postings.merge([(batch, frozenset()) for batch in self.batches])
+
+    def spill(self) -> None:
+        if not self.batches:
+            return
+
+        path = self.run_dir / f"run_{len(self.runs):06d}.seg"
+        write_segment(path, self.merged(), self.documents)
+        self.runs.append(Segment(path))
+
+        self.batches = []
+        self.documents = {}
+        self.held_bytes = 0
+
+
+class RunMerger:
+    """k-way merge of sorted runs into a single segment, streamed to disk.
+
+    Only per-document columns (doc ids, lengths and where each document
+    came from) and one term's postings at a time are held in memory; all
+    other sections are spooled to temp files next to the output.
+    """
+
+    def __init__(self, runs: Sequence[Segment]) -> None:
+        self.runs = runs
+        self.doc_ids = array(DOC_ID_TYPE)
+        self.doc_lengths = array(DOC_LENGTH_TYPE)
+        # run and local ordinal of every merged ordinal, and the inverse
+        self.sources = array(ORDINAL_TYPE)
+        self.locals = array(ORDINAL_TYPE)
+        self.remaps = [
+            array(ORDINAL_TYPE, bytes(4 * run.postings.doc_count)) for run in runs
+        ]
+
+        # ordinals follow ascending doc ids across all runs
+        doc_streams = [_tagged(run.postings.doc_ids, i) for i, run in enumerate(runs)]
+        for ordinal, (doc_id, i, local) in enumerate(heapq.merge(*doc_streams)):
+            if len(self.doc_ids) and self.doc_ids[-1] == doc_id:
+                raise ValueError(f"Duplicate doc id {doc_id}")
+
+            self.doc_ids.append(doc_id)
+            self.doc_lengths.append(runs[i].postings.doc_lengths[local])
+            self.sources.append(i)
+            self.locals.append(local)
+            self.remaps[i][local] = ordinal
+
+        self.total_doc_length = sum(run.postings.total_doc_length for run in runs)
+        self.positional = all(run.postings.positional for run in runs)
+
+        # runs of a corpus sorted by id cover ascending, disjoint doc id
+        # ranges; their postings then only need to be concatenated
+        self.ordered = all(
+            prev.postings.doc_ids[-1] < run.postings.doc_ids[0]
+            for prev, run in pairwise(runs)
+        )
+
+    @property
+    def doc_count(self) -> int:
+        return len(self.doc_ids)
+
+    def terms(self) -> Iterator[tuple[str, array, array, list[memoryview]]]:
+        # term ids follow sorted term order, so each run's term dictionary
+        # is streamed in order together with its term ids
+        term_streams = [
+            _tagged(run.postings.terms, i) for i, run in enumerate(self.runs)
+        ]
+        for token, group in groupby(heapq.merge(*term_streams), key=itemgetter(0)):
+            ordinals = array(ORDINAL_TYPE)
+            tfs = array(TF_TYPE)
+            # encoded positions per posting, if every run has them
+            positions: list[memoryview] = []
+            for _, i, term_id in group:
+                postings = self.runs[i].postings
+                start = postings.postings_offsets[term_id]
+                end = postings.postings_offsets[term_id + 1]
+                remap = self.remaps[i]
+                ordinals.extend(
+                    remap[ordinal] for ordinal in postings.doc_ordinals[start:end]
+                )
+                tfs.frombytes(postings.tfs[start:end].cast("B"))
+                if self.positional:
+                    offsets = postings.position_offsets
+                    positions.extend(
+                        postings.positions[offsets[j] : offsets[j + 1]]
+                        for j in range(start, end)
+                    )
+
+            if not self.ordered:
+                merged = sorted(
+                    zip(ordinals, tfs, positions or repeat(None)), key=itemgetter(0)
+                )
+                ordinals = array(ORDINAL_TYPE, (ordinal for ordinal, _, _ in merged))
+                tfs = array(TF_TYPE, (tf for _, tf, _ in merged))
+                if self.positional:
+                    positions = [data for _, _, data in merged]
+
+            yield token, ordinals, tfs, positions
+
+    def write(
+        self,
+        path: Path,
+        impacts: Callable[[Sequence[int], Sequence[int]], array] | None = None,
+        impact_params: tuple[float, float] | None = None,
+    ) -> None:
+        """Write the merged segment; `impacts(ordinals, tfs)` scores a term."""
+        names = [
+            "term_offsets",
+            "term_blob",
+            "postings_offsets",
+            "doc_ordinals",
+            "tfs",
+            "impacts",
+            "max_impacts",
+            "position_offsets",
+            "positions",
+            *DOCUMENT_SECTIONS,
+        ]
+        with ExitStack() as stack:
+            # spool next to the output: /tmp may be backed by memory
+            spools = {
+                name: stack.enter_context(tempfile.TemporaryFile(dir=path.parent))
+                for name in names
+            }
+            for name in ("term_offsets", "postings_offsets"):
+                spools[name].write(array(OFFSET_TYPE, [0]))
+            if self.positional:
+                spools["position_offsets"].write(array(OFFSET_TYPE, [0]))
+
+            term_count = 0
+            term_bytes = 0
+            posting_count = 0
+            position_bytes = 0
+            for token, ordinals, tfs, positions in self.terms():
+                encoded = token.encode()
+                term_bytes += len(encoded)
+                posting_count += len(ordinals)
+                term_count += 1
+
+                spools["term_blob"].write(encoded)
+                spools["term_offsets"].write(array(OFFSET_TYPE, [term_bytes]))
+                spools["postings_offsets"].write(array(OFFSET_TYPE, [posting_count]))
+                spools["doc_ordinals"].write(ordinals)
+                spools["tfs"].write(tfs)
+                for data in positions:
+                    position_bytes += spools["positions"].write(data)
+                    spools["position_offsets"].write(
+                        array(OFFSET_TYPE, [position_bytes])
+                    )
+                if impacts is not None:
+                    token_impacts = impacts(ordinals, tfs)
+                    spools["impacts"].write(token_impacts)
+                    spools["max_impacts"].write(
+                        array(IMPACT_TYPE, [max(token_impacts, default=0.0)])
+                    )
+
+            # records are copied still encoded, only the blocks are redone
+            writer = DocumentWriter({name: spools[name] for name in DOCUMENT_SECTIONS})
+            for i, local in zip(self.sources, self.locals):
+                documents = self.runs[i].documents
+                writer.add(documents.record(local), documents.encoded_title(local))
+            writer.close()
+
+            sections = {
+                **{name: spools[name] for name in names[:9]},
+                "doc_ids": self.doc_ids,
+                "doc_lengths": self.doc_lengths,
+                **{name: spools[name] for name in DOCUMENT_SECTIONS},
+            }
+            write_sections(
+                path,
+                sections,
+                term_count=term_count,
+                posting_count=posting_count,
+                doc_count=self.doc_count,
+                total_doc_length=self.total_doc_length,
+                impact_params=impact_params if impacts is not None else None,
+                positional=self.positional,
+            )
+
+
+def _tagged(values: Iterable, source: int) -> Iterator[tuple]:
+    # (value, source, position) for a k-way merge of sorted streams
+    for position, value in enumerate(values):
+        yield value, source, position
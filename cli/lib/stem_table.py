@@ -0,0 +1,92 @@
+import mmap
+import os
+import struct
+from array import array
+from collections.abc import Mapping
+from pathlib import Path
+
+# Stem table file layout (little-endian):
+#
+#   header   magic, word count W
+#   offsets  uint64[2 * W + 1]  byte offsets of word 0, stem 0, word 1, ...
+#   blob     utf-8 words and their stems, interleaved, sorted by word
+
+STEMS_MAGIC = b"RAGSTEM\x00"
+HEADER = struct.Struct("<8sQ")
+
+
+class StemTable:
+    """Surface word -> stem of the indexed vocabulary, mmap'd from disk.
+
+    Written by 'build', so that query tokenization of known words needs
+    neither the stemmer nor importing nltk. Lookups binary search the sorted
+    words, nothing is decoded upfront.
+    """
+
+    def __init__(self, path: Path) -> None:
+        with open(path, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        size = len(self.mmap)
+        magic, self.count = (
+            HEADER.unpack_from(self.mmap) if size >= HEADER.size else (b"", 0)
+        )
+        self.blob_start = HEADER.size + 8 * (2 * self.count + 1)
+        if magic != STEMS_MAGIC or size < self.blob_start:
+            self.mmap.close()
+            raise ValueError(f"Not a stem table: {path}")
+
+        self.offsets = memoryview(self.mmap)[HEADER.size : self.blob_start].cast("Q")
+        if self.blob_start + self.offsets[-1] > size:
+            self.offsets.release()
+            self.mmap.close()
+            raise ValueError(f"Truncated stem table: {path}")
+
+    @classmethod
+    def open(cls, path: Path) -> "StemTable | None":
+        # only a cache of the stemmer: missing or damaged, it is not used and
+        # the next build writes it again
+        try:
+            return cls(path)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def __len__(self) -> int:
+        return self.count
+
+    def get(self, word: str) -> str | None:
+        # utf-8 byte order equals code point order, i.e. python's str order
+        key = word.encode()
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.__entry(2 * mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        if lo == self.count or self.__entry(2 * lo) != key:
+            return None
+        return self.__entry(2 * lo + 1).decode()
+
+    def __entry(self, i: int) -> bytes:
+        start = self.blob_start
+        return self.mmap[start + self.offsets[i] : start + self.offsets[i + 1]]
+
+    @staticmethod
+    def write(path: Path, stems: Mapping[str, str]) -> None:
+        offsets = array("Q", [0])
+        blob = bytearray()
+        for word in sorted(stems):
+            blob += word.encode()
+            offsets.append(len(blob))
+            blob += stems[word].encode()
+            offsets.append(len(blob))
+
+        # swapped in, so processes that still map the old table keep reading it
+        tmp_path = path.with_suffix(path.suffix + ".tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(HEADER.pack(STEMS_MAGIC, len(stems)))
+            f.write(offsets)
+            f.write(blob)
+        os.replace(tmp_path, path)
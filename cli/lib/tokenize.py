@@ -1,34 +1,120 @@
 import string
+from collections.abc import Iterable
+from functools import lru_cache
+from typing import TYPE_CHECKING
 
+from config import CACHE_STEMS_FILE, STEM_CACHE_SIZE
+from lib.stem_table import StemTable
 from lib.utils import load_stopwords
-from nltk.stem import PorterStemmer
+
+if TYPE_CHECKING:
+    from nltk.stem import PorterStemmer
+
+
+class Tokenizer:
+    def __init__(
+        self,
+        stopwords: Iterable[str] | None = None,
+        stem_cache_size: int = STEM_CACHE_SIZE,
+        stem_table: StemTable | None = None,
+    ) -> None:
+        if stopwords is None:
+            stopwords = load_stopwords()
+
+        self.stopwords: frozenset[str] = frozenset(stopwords)
+        self.punctuation_table = str.maketrans("", "", string.punctuation)
+        # stems of the indexed words, looked up before running the stemmer
+        self.stem_table = stem_table
+        self.__stemmer: PorterStemmer | None = None
+        # words stemmed since `collect_stems` was last called, while collecting
+        self.collected: dict[str, str] | None = None
+
+        # vocabularies are zipfian, so a bounded cache catches nearly every word
+        self.stem = lru_cache(maxsize=stem_cache_size)(self.__stem)
+
+    @property
+    def stemmer(self) -> "PorterStemmer":
+        # imported on first use: nltk takes longer to import than most queries
+        # take to run, and queries of indexed words never need it
+        if self.__stemmer is None:
+            from nltk.stem import PorterStemmer
+
+            self.__stemmer = PorterStemmer()
+        return self.__stemmer
+
+    def __stem(self, word: str) -> str:
+        stem = self.stem_table.get(word) if self.stem_table is not None else None
+        if stem is None:
+            stem = self.stemmer.stem(word)
+        if self.collected is not None:
+            self.collected[word] = stem
+        return stem
+
+    def collect_stems(self) -> dict[str, str]:
+        # the words stemmed since the previous call; the first call starts
+        # collecting, with an empty cache so that no word is missed, until
+        # `stop_collecting_stems`
+        if self.collected is None:
+            self.stem.cache_clear()
+        collected, self.collected = self.collected or {}, {}
+        return collected
+
+    def stop_collecting_stems(self) -> None:
+        # once the stems were taken; otherwise every word stemmed later, e.g.
+        # by queries, would be kept
+        self.collected = None
+
+    def tokenize(self, text: str) -> list[str]:
+        stopwords = self.stopwords
+        stem = self.stem
+        clean_text = text.lower().translate(self.punctuation_table)
+
+        return [stem(word) for word in clean_text.split() if word not in stopwords]
+
+    def tokenize_single(self, term: str) -> str:
+        tokens = self.tokenize(term)
+
+        if len(tokens) != 1:
+            raise ValueError("Only one word/token is allowed")
+
+        return tokens[0]
+
+    def tokenize_many(self, texts: Iterable[str]) -> list[list[str]]:
+        return [self.tokenize(text) for text in texts]
+
+
+_tokenizer: Tokenizer | None = None
+
+
+def get_tokenizer() -> Tokenizer:
+    global _tokenizer
+    if _tokenizer is None:
+        _tokenizer = Tokenizer(stem_table=StemTable.open(CACHE_STEMS_FILE))
+
+    return _tokenizer
 
 
 def tokenize_str(query: str) -> list[str]:
-    clean_query = remove_punctuation(query)
-    clean_query = remove_stopwords(clean_query)
-    return stemed_tokens(clean_query)
+    return get_tokenizer().tokenize(query)
 
 
 def tokenize_single_str(term: str) -> str:
-    tokens = tokenize_str(term)
+    return get_tokenizer().tokenize_single(term)
 
-    if len(tokens) != 1:
-        raise ValueError("Only one word/token is allowed")
 
-    return tokens[0]
+def tokenize_many(texts: Iterable[str]) -> list[list[str]]:
+    return get_tokenizer().tokenize_many(texts)
 
 
 def remove_punctuation(query: str) -> str:
-    punctuation_table = str.maketrans("", "", string.punctuation)
-    return query.lower().translate(punctuation_table)
+    return query.lower().translate(get_tokenizer().punctuation_table)
 
 
 def remove_stopwords(query: str) -> list[str]:
-    stopwords = load_stopwords()
+    stopwords = get_tokenizer().stopwords
     return [word for word in query.split() if word not in stopwords]
 
 
 def stemed_tokens(tokens: list[str]) -> list[str]:
-    stemmer = PorterStemmer()
-    return [stemmer.stem(word) for word in tokens]
+    stem = get_tokenizer().stem
+    return [stem(word) for word in tokens]
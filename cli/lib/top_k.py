@@ -0,0 +1,163 @@
+import heapq
+from bisect import bisect_left
+from collections.abc import Sequence
+
+from lib import trace
+
+# guards the upper-bound comparisons against float rounding: a sum of
+# per-term maxima may round below an exactly computed document score
+UPPER_BOUND_SLACK = 1 + 1e-9
+
+# doc of an exhausted cursor; larger than any uint32 ordinal
+EXHAUSTED = 1 << 32
+
+
+class TermCursor:
+    """Position in one query term's doc-ordinal sorted postings."""
+
+    def __init__(
+        self,
+        term_index: int,
+        ordinals: Sequence[int],
+        impacts: Sequence[float],
+        max_impact: float,
+        weight: int,
+    ) -> None:
+        self.term_index = term_index
+        self.ordinals = ordinals
+        self.impacts = impacts
+        self.weight = weight  # how often the term occurs in the query
+        self.upper_bound = max_impact * weight
+        self.size = len(ordinals)
+        self.pos = 0
+        self.doc = ordinals[0] if self.size else EXHAUSTED
+
+    def next(self) -> None:
+        self.pos += 1
+        self.doc = self.ordinals[self.pos] if self.pos < self.size else EXHAUSTED
+
+    def seek(self, ordinal: int) -> int:
+        # galloping forward from the current position, then binary search
+        ordinals, size = self.ordinals, self.size
+        pos, step = self.pos, 1
+        while pos + step < size and ordinals[pos + step] < ordinal:
+            pos += step
+            step *= 2
+
+        self.pos = bisect_left(ordinals, ordinal, pos, min(pos + step + 1, size))
+        self.doc = ordinals[self.pos] if self.pos < size else EXHAUSTED
+        return self.doc
+
+    def skip_below(self, bound: float, threshold: float) -> int:
+        # advance past postings that cannot beat the threshold even when
+        # `bound` (the other terms' best case) is added
+        impacts, weight = self.impacts, self.weight
+        pos, size = self.pos, self.size
+        while (
+            pos < size
+            and (impacts[pos] * weight + bound) * UPPER_BOUND_SLACK <= threshold
+        ):
+            pos += 1
+
+        self.pos = pos
+        self.doc = self.ordinals[pos] if pos < size else EXHAUSTED
+        return self.doc
+
+
+def max_score_top_k(
+    cursors: list[TermCursor], query_terms: Sequence[int], limit: int
+) -> list[tuple[int, float]]:
+    """Top-k doc ordinals by summed impact, using MaxScore dynamic pruning.
+
+    `query_terms` lists the term index of every query token in query order,
+    so each document's score is summed exactly like exhaustive scoring.
+    Returns ``(ordinal, score)`` by descending score, ties by ascending
+    ordinal.
+    """
+    if limit <= 0:
+        return []
+
+    # non-essential terms are the low-impact prefix whose combined upper bound
+    # cannot lift a document into the heap on its own
+    cursors = sorted(cursors, key=lambda cursor: cursor.upper_bound)
+    prefix_bounds: list[float] = []
+    total = 0.0
+    for cursor in cursors:
+        total += cursor.upper_bound
+        prefix_bounds.append(total * UPPER_BOUND_SLACK)
+
+    # min-heap of (score, -ordinal): the weakest entry sits on top, and on
+    # equal scores the larger ordinal loses
+    heap: list[tuple[float, int]] = []
+    threshold = float("-inf")
+    first_essential = 0
+    contributions = [0.0] * (max(query_terms, default=-1) + 1)
+    scored = 0
+
+    while True:
+        while (
+            first_essential < len(cursors)
+            and prefix_bounds[first_essential] <= threshold
+        ):
+            first_essential += 1
+
+        essential = cursors[first_essential:]
+        if not essential:
+            break
+
+        if len(essential) == 1:
+            # a single essential list can skip on its own impacts
+            non_essential_bound = (
+                prefix_bounds[first_essential - 1] if first_essential else 0.0
+            )
+            candidate = essential[0].skip_below(non_essential_bound, threshold)
+        else:
+            candidate = min(cursor.doc for cursor in essential)
+
+        if candidate == EXHAUSTED:
+            break
+
+        for term_index in range(len(contributions)):
+            contributions[term_index] = 0.0
+
+        partial = 0.0
+        for cursor in essential:
+            if cursor.doc == candidate:
+                impact = cursor.impacts[cursor.pos]
+                contributions[cursor.term_index] = impact
+                partial += impact * cursor.weight
+                cursor.next()
+
+        # probe non-essential terms from the strongest down, as long as the
+        # document can still beat the threshold
+        pruned = False
+        for i in range(first_essential - 1, -1, -1):
+            if (partial + prefix_bounds[i]) * UPPER_BOUND_SLACK <= threshold:
+                pruned = True
+                break
+
+            cursor = cursors[i]
+            if cursor.seek(candidate) == candidate:
+                impact = cursor.impacts[cursor.pos]
+                contributions[cursor.term_index] = impact
+                partial += impact * cursor.weight
+
+        if pruned:
+            continue
+
+        scored += 1
+        score = 0.0
+        for term_index in query_terms:
+            score += contributions[term_index]
+
+        entry = (score, -candidate)
+        if len(heap) < limit:
+            heapq.heappush(heap, entry)
+        elif entry > heap[0]:
+            heapq.heapreplace(heap, entry)
+
+        if len(heap) == limit:
+            threshold = heap[0][0]
+
+    trace.count("documents_scored", scored)
+    return [(-neg_ordinal, score) for score, neg_ordinal in sorted(heap, reverse=True)]
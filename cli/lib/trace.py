@@ -0,0 +1,147 @@
+import json
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Self, TextIO
+
+# Tracing of query, build and load stages: timed spans and counters,
+# collected per process and off until `enable` is called (--profile,
+# --metrics). While off, `span` hands out one shared no-op context manager
+# and `count` returns at once, so instrumented code pays a function call.
+#
+#   with trace.span("bm25.score"):
+#       ...
+#   trace.count("documents_scored", scored)
+
+_enabled = False
+_lock = threading.Lock()
+_spans: dict[str, list] = {}  # name -> [calls, seconds]
+_counters: dict[str, int] = {}
+
+
+class _Span:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    def __enter__(self) -> Self:
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_) -> None:
+        seconds = time.perf_counter() - self.start
+        with _lock:
+            totals = _spans.setdefault(self.name, [0, 0.0])
+            totals[0] += 1
+            totals[1] += seconds
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *_) -> None:
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+def enable() -> None:
+    global _enabled
+    _enabled = True
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def reset() -> None:
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+
+
+def span(name: str) -> _Span | _NoSpan:
+    return _Span(name) if _enabled else _NO_SPAN
+
+
+def count(name: str, value: int = 1) -> None:
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def snapshot() -> dict:
+    with _lock:
+        return {
+            "spans": {
+                name: {"calls": calls, "seconds": seconds}
+                for name, (calls, seconds) in sorted(_spans.items())
+            },
+            "counters": dict(sorted(_counters.items())),
+        }
+
+
+def print_report(file: TextIO = sys.stderr) -> None:
+    # spans are named stage.substage, so a stage sorts before its parts,
+    # which are indented below it
+    metrics = snapshot()
+    spans = metrics["spans"]
+    if not spans and not metrics["counters"]:
+        print("Profile: nothing traced", file=file)
+        return
+
+    def depth(name: str) -> int:
+        parent = name.rpartition(".")[0]
+        return depth(parent) + 1 if parent in spans else 0
+
+    print(f"{'span':<28} {'calls':>7} {'total ms':>10} {'mean ms':>10}", file=file)
+    for name, totals in spans.items():
+        ms = totals["seconds"] * 1000
+        print(
+            f"{'  ' * depth(name) + name:<28} {totals['calls']:>7} {ms:>10.2f}"
+            f" {ms / totals['calls']:>10.3f}",
+            file=file,
+        )
+    for name, value in metrics["counters"].items():
+        print(f"{name:<28} {value:>7}", file=file)
+
+
+def prometheus_text() -> str:
+    # Prometheus text exposition format
+    metrics = snapshot()
+    lines = [
+        "# HELP search_span_seconds_total Time spent in each traced stage.",
+        "# TYPE search_span_seconds_total counter",
+    ]
+    lines += [
+        f'search_span_seconds_total{{span="{name}"}} {totals["seconds"]:.9f}'
+        for name, totals in metrics["spans"].items()
+    ]
+    lines += [
+        "# HELP search_span_calls_total Times each traced stage ran.",
+        "# TYPE search_span_calls_total counter",
+    ]
+    lines += [
+        f'search_span_calls_total{{span="{name}"}} {totals["calls"]}'
+        for name, totals in metrics["spans"].items()
+    ]
+    for name, value in metrics["counters"].items():
+        lines.append(f"# TYPE search_{name}_total counter")
+        lines.append(f"search_{name}_total {value}")
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics(path: Path) -> None:
+    # JSON for a .json path, Prometheus text otherwise
+    if path.suffix == ".json":
+        text = json.dumps(snapshot(), indent=2) + "\n"
+    else:
+        text = prometheus_text()
+    path.write_text(text)
@@ -1,13 +1,126 @@
 import json
+from collections.abc import Iterator
+from pathlib import Path
 
-from config import MOVIES_JSON, STOPWORDS_TXT
+from config import LOADER_CHUNK_SIZE, MOVIES_JSON, STOPWORDS_TXT
 
+JSON_LINES_SUFFIXES = {".jsonl", ".ndjson"}
 
-def load_movies() -> list[dict]:
-    with open(MOVIES_JSON, "r") as f:
-        data = json.load(f)
 
-    return data["movies"]
+def load_movies(path: Path = MOVIES_JSON) -> list[dict]:
+    return list(iter_movies(path))
+
+
+def iter_movies(path: Path = MOVIES_JSON) -> Iterator[dict]:
+    """Yield the movies of a corpus file one at a time.
+
+    Accepts ``{"movies": [...]}`` like the corpus file, a plain JSON array,
+    or JSON Lines (``.jsonl``/``.ndjson``, one movie per line). The array is
+    parsed incrementally, so the whole file is never held in memory.
+    """
+    with open(path, "r") as f:
+        if path.suffix in JSON_LINES_SUFFIXES:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from _iter_json_array(f.read, path)
+
+
+def _iter_json_array(read, path: Path) -> Iterator[dict]:
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    eof = False
+
+    def fill() -> None:
+        nonlocal buffer, pos, eof
+        chunk = read(LOADER_CHUNK_SIZE)
+        eof = not chunk
+        buffer = buffer[pos:] + chunk
+        pos = 0
+
+    def peek() -> str:
+        # skip whitespace and return the next character ("" at eof)
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n":
+                pos += 1
+            if pos < len(buffer) or eof:
+                return buffer[pos : pos + 1]
+            fill()
+
+    def expect(*chars: str) -> str:
+        nonlocal pos
+        char = peek()
+        if char not in chars or not char:
+            expected = " or ".join(f"'{c}'" for c in chars)
+            raise ValueError(f"Expected {expected} in {path}, found {char!r}")
+        pos += 1
+        return char
+
+    def value():
+        nonlocal pos
+        peek()
+        while True:
+            try:
+                decoded, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # the value is cut off at the end of the buffer
+                if eof:
+                    raise
+                fill()
+                continue
+            if end == len(buffer) and not eof:
+                fill()  # a number may go on in the next chunk
+                continue
+            pos = end
+            return decoded
+
+    def array() -> Iterator[dict]:
+        if peek() != "[":
+            raise ValueError(f"Expected a movies array in {path}")
+        expect("[")
+        if peek() == "]":
+            expect("]")
+            return
+        while True:
+            yield value()
+            if expect(",", "]") == "]":
+                return
+
+    # the array is either the document itself or the value of "movies", in
+    # an object that may have other keys too
+    if peek() != "{":
+        yield from array()
+    else:
+        expect("{")
+        found = False
+        if peek() == "}":
+            expect("}")
+        else:
+            while True:
+                if peek() != '"':
+                    raise ValueError(f"Expected an object key in {path}")
+                key = value()
+                expect(":")
+                if key == "movies" and not found:
+                    found = True
+                    yield from array()
+                else:
+                    value()
+                if expect(",", "}") == "}":
+                    break
+        if not found:
+            raise ValueError(f"Expected a movies array in {path}")
+
+    if peek():
+        raise ValueError(f"Unexpected data after the movies in {path}")
+
+
+def document_text(movie: dict) -> str:
+    # the text that gets indexed and embedded for a movie
+    return f"{movie['title']} {movie['description']}"
 
 
 def load_stopwords() -> list[str]:
@@ -1,9 +1,31 @@
 #!/usr/bin/env python3
 import argparse
 import textwrap
+from pathlib import Path
 
-from config import TRANSFORMER_MODEL
-from lib.semantic_search import embed_text, verify_model
+from config import (
+    ANN_KMEANS_ITERATIONS,
+    ANN_LISTS,
+    EMBEDDING_BATCH_SIZE,
+    HYBRID_ALPHA,
+    HYBRID_CANDIDATES,
+    MAX_SEARCH_RESULTS,
+    PQ_SUBSPACES,
+    QUANTIZED_RESCORE,
+    TRANSFORMER_MODEL,
+)
+from lib import trace
+from lib.hybrid_search import FUSIONS, hybrid_search
+from lib.semantic_search import (
+    build_ann,
+    build_embeddings,
+    build_quantized,
+    embed_text,
+    evaluate_ann,
+    evaluate_quantized,
+    search,
+    verify_model,
+)
 
 
 class _HelpFmt(
@@ -22,6 +44,52 @@ def cmd_embed_text(args: argparse.Namespace) -> None:
     embed_text(args.text)
 
 
+def cmd_build_embeddings(args: argparse.Namespace) -> None:
+    print("Building corpus embeddings ...")
+    build_embeddings(args.batch_size)
+
+
+def cmd_build_ann(args: argparse.Namespace) -> None:
+    print("Building ANN index ...")
+    build_ann(args.lists, args.iterations)
+
+
+def cmd_evaluate_ann(args: argparse.Namespace) -> None:
+    print("Evaluating ANN index against brute force ...")
+    evaluate_ann(args.queries, args.limit, args.nprobe, args.seed)
+
+
+def cmd_build_quantized(args: argparse.Namespace) -> None:
+    print("Quantizing corpus embeddings ...")
+    build_quantized(args.kind, args.subspaces)
+
+
+def cmd_evaluate_quantized(args: argparse.Namespace) -> None:
+    print("Evaluating quantized embeddings against float32 ...")
+    evaluate_quantized(args.queries, args.limit, args.rescore, args.seed)
+
+
+def cmd_search(args: argparse.Namespace) -> None:
+    queries = list(args.queries)
+    if args.queries_file:
+        with open(args.queries_file, "r") as f:
+            queries.extend(line.strip() for line in f if line.strip())
+
+    if not queries:
+        print("No queries given")
+        return
+
+    print(f"Searching for {len(queries)} queries ...")
+    search(queries, args.limit, args.nprobe, args.quantized, args.rescore)
+
+
+def cmd_hybrid(args: argparse.Namespace) -> None:
+    print(f"Hybrid search for: {args.query}")
+    hybrid_search(
+        args.query, args.limit, args.fusion, args.alpha, args.candidates, args.rerank
+    )
+
+
 def build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(
         description="Semantic Search CLI",
@@ -37,6 +105,18 @@ def build_parser() -> argparse.ArgumentParser:
     parser.add_argument(
         "--version", action="version", version="Semantic Search CLI 1.0.0"
     )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Print the time spent in every traced stage and the counters"
+        " (searches run locally, not in the search daemon)",
+    )
+    parser.add_argument(
+        "--metrics",
+        type=Path,
+        help="Write the traced stages and counters to this file: JSON for .json,"
+        " Prometheus text otherwise",
+    )
 
     subparsers = parser.add_subparsers(
         title="commands",
@@ -94,6 +174,273 @@ def build_parser() -> argparse.ArgumentParser:
     )
 
     embed_text_parser.set_defaults(func=cmd_embed_text)
+
+    ###################
+    # Build Embeddings
+    ################
+
+    build_embeddings_parser = subparsers.add_parser(
+        "build_embeddings",
+        aliases=["be"],
+        help="Embed every movie and store the embeddings in the cache",
+        description="Embed title and description of every movie. Only movies"
+        " whose text changed since the last build are encoded again.",
+        formatter_class=_HelpFmt,
+        epilog=textwrap.dedent(
+            """\
+            Examples:
+
+              semantic_search_cli.py build_embeddings
+              semantic_search_cli.py be --batch-size 128
+            """
+        ),
+    )
+    build_embeddings_parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=EMBEDDING_BATCH_SIZE,
+        help="Texts per encode call",
+    )
+    build_embeddings_parser.set_defaults(func=cmd_build_embeddings)
+
+    ############
+    # Build ANN
+    #########
+
+    build_ann_parser = subparsers.add_parser(
+        "build_ann",
+        help="Build an IVF index over the stored embeddings",
+        description="Cluster the stored embeddings with k-means into inverted"
+        " lists. 'search --nprobe N' then scores only the N closest lists.",
+        formatter_class=_HelpFmt,
+        epilog=textwrap.dedent(
+            """\
+            Examples:
+
+              semantic_search_cli.py build_ann
+              semantic_search_cli.py build_ann --lists 1024
+            """
+        ),
+    )
+    build_ann_parser.add_argument(
+        "--lists",
+        type=int,
+        default=ANN_LISTS,
+        help="Number of inverted lists (default: 4 * sqrt(embeddings))",
+    )
+    build_ann_parser.add_argument(
+        "--iterations",
+        type=int,
+        default=ANN_KMEANS_ITERATIONS,
+        help="k-means iterations",
+    )
+    build_ann_parser.set_defaults(func=cmd_build_ann)
+
+    ###############
+    # Evaluate ANN
+    ############
+
+    evaluate_ann_parser = subparsers.add_parser(
+        "evaluate_ann",
+        help="Measure recall and latency of the ANN index per nprobe",
+        description="Use the embeddings of random movies as queries and compare"
+        " the ANN results with brute force search: recall@limit and p50/p95"
+        " latency of single queries, for every nprobe.",
+        formatter_class=_HelpFmt,
+        epilog=textwrap.dedent(
+            """\
+            Examples:
+
+              semantic_search_cli.py evaluate_ann
+              semantic_search_cli.py evaluate_ann --nprobe 4 16 64 --limit 10
+            """
+        ),
+    )
+    evaluate_ann_parser.add_argument(
+        "--queries", type=int, default=200, help="Number of sampled queries"
+    )
+    evaluate_ann_parser.add_argument(
+        "--limit", type=int, default=10, help="k of recall@k"
+    )
+    evaluate_ann_parser.add_argument(
+        "--nprobe",
+        type=int,
+        nargs="+",
+        default=[1, 2, 4, 8, 16, 32],
+        help="Lists scanned per query",
+    )
+    evaluate_ann_parser.add_argument(
+        "--seed", type=int, default=0, help="Seed of the query sample"
+    )
+    evaluate_ann_parser.set_defaults(func=cmd_evaluate_ann)
+
+    ##################
+    # Build Quantized
+    ###############
+
+    build_quantized_parser = subparsers.add_parser(
+        "build_quantized",
+        help="Compress the stored embeddings to int8 or PQ codes",
+        description="Quantize the stored embeddings. int8 keeps one byte per"
+        " dimension (4x smaller), pq one byte per subspace. 'search"
+        " --quantized' then scores the codes instead of the float matrix.",
+        formatter_class=_HelpFmt,
+        epilog=textwrap.dedent(
+            """\
+            Examples:
+
+              semantic_search_cli.py build_quantized
+              semantic_search_cli.py build_quantized --kind pq --subspaces 96
+            """
+        ),
+    )
+    build_quantized_parser.add_argument(
+        "--kind", choices=["int8", "pq"], default="int8", help="Quantization"
+    )
+    build_quantized_parser.add_argument(
+        "--subspaces",
+        type=int,
+        default=PQ_SUBSPACES,
+        help="PQ bytes per embedding, must divide the dimension",
+    )
+    build_quantized_parser.set_defaults(func=cmd_build_quantized)
+
+    #####################
+    # Evaluate Quantized
+    ##################
+
+    evaluate_quantized_parser = subparsers.add_parser(
+        "evaluate_quantized",
+        help="Measure memory, recall and latency of the quantized embeddings",
+        description="Use the embeddings of random movies as queries and compare"
+        " quantized search with float32 search: memory, recall@limit and"
+        " p50/p95 latency of single queries, for every rescore shortlist size.",
+        formatter_class=_HelpFmt,
+        epilog=textwrap.dedent(
+            """\
+            Examples:
+
+              semantic_search_cli.py evaluate_quantized
+              semantic_search_cli.py evaluate_quantized --rescore 0 20 100
+            """
+        ),
+    )
+    evaluate_quantized_parser.add_argument(
+        "--queries", type=int, default=200, help="Number of sampled queries"
+    )
+    evaluate_quantized_parser.add_argument(
+        "--limit", type=int, default=10, help="k of recall@k"
+    )
+    evaluate_quantized_parser.add_argument(
+        "--rescore",
+        type=int,
+        nargs="+",
+        default=[0, 50, QUANTIZED_RESCORE],
+        help="Shortlist sizes rescored exactly (0: no rescoring)",
+    )
+    evaluate_quantized_parser.add_argument(
+        "--seed", type=int, default=0, help="Seed of the query sample"
+    )
+    evaluate_quantized_parser.set_defaults(func=cmd_evaluate_quantized)
+
+    ##########
+    # Search
+    #######
+
+    search_parser = subparsers.add_parser(
+        "search",
+        help="Search the movie embeddings for the closest matches",
+        description="Rank movies by cosine similarity to each query. All"
+        " queries are encoded and scored as one batch.",
+        formatter_class=_HelpFmt,
+        epilog=textwrap.dedent(
+            """\
+            Examples:
+
+              semantic_search_cli.py search "space adventure"
+              semantic_search_cli.py search "heist" "love story" --limit 10
+              semantic_search_cli.py search --queries-file queries.txt
+              semantic_search_cli.py search "heist" --nprobe 8
+              semantic_search_cli.py search "heist" --quantized --rescore 50
+            """
+        ),
+    )
+    search_parser.add_argument("queries", type=str, nargs="*", help="Queries")
+    search_parser.add_argument(
+        "--queries-file", type=str, help="File with one query per line"
+    )
+    search_parser.add_argument(
+        "--limit", type=int, default=MAX_SEARCH_RESULTS, help="Results per query"
+    )
+    approximate = search_parser.add_mutually_exclusive_group()
+    approximate.add_argument(
+        "--nprobe",
+        type=int,
+        help="Search the ANN index, scanning this many lists per query"
+        " (default: exact search)",
+    )
+    approximate.add_argument(
+        "--quantized",
+        action="store_true",
+        help="Score the quantized codes (see build_quantized)",
+    )
+    search_parser.add_argument(
+        "--rescore",
+        type=int,
+        default=QUANTIZED_RESCORE,
+        help="With --quantized: rescore this many candidates with the float"
+        " embeddings (0: no rescoring)",
+    )
+    search_parser.set_defaults(func=cmd_search)
+
+    ##########
+    # Hybrid
+    #######
+
+    hybrid_parser = subparsers.add_parser(
+        "hybrid",
+        help="Fuse BM25 and semantic search results",
+        description="Run BM25 and semantic search concurrently, each for the"
+        " top --candidates movies, and fuse both rankings with reciprocal rank"
+        " fusion or a weighted sum of min-max normalized scores. With --rerank"
+        " only the BM25 candidates are scored semantically instead of the whole"
+        " corpus. The time of every stage is reported.",
+        formatter_class=_HelpFmt,
+        epilog=textwrap.dedent(
+            """\
+            Examples:
+
+              semantic_search_cli.py hybrid "space adventure"
+              semantic_search_cli.py hybrid "heist" --fusion weighted --alpha 0.3
+              semantic_search_cli.py hybrid "heist" --rerank --candidates 200
+            """
+        ),
+    )
+    hybrid_parser.add_argument("query", type=str, help="Query")
+    hybrid_parser.add_argument(
+        "--limit", type=int, default=MAX_SEARCH_RESULTS, help="Number of results"
+    )
+    hybrid_parser.add_argument(
+        "--fusion", choices=FUSIONS, default="rrf", help="How the rankings are fused"
+    )
+    hybrid_parser.add_argument(
+        "--alpha",
+        type=float,
+        default=HYBRID_ALPHA,
+        help="Weighted fusion: weight of BM25, semantic gets 1 - alpha",
+    )
+    hybrid_parser.add_argument(
+        "--candidates",
+        type=int,
+        default=HYBRID_CANDIDATES,
+        help="Results taken from each retriever",
+    )
+    hybrid_parser.add_argument(
+        "--rerank",
+        action="store_true",
+        help="Score only the BM25 candidates semantically",
+    )
+    hybrid_parser.set_defaults(func=cmd_hybrid)
     return parser
 
 
@@ -103,7 +450,14 @@ def main():
     if not hasattr(args, "func"):
         parser.print_help()
         parser.exit(0)
+
+    if args.profile or args.metrics:
+        trace.enable()
     args.func(args)
+    if args.profile:
+        trace.print_report()
+    if args.metrics:
+        trace.write_metrics(args.metrics)
 
 
 if __name__ == "__main__":
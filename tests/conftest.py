@@ -0,0 +1,104 @@
+import random
+from collections.abc import Callable
+from pathlib import Path
+
+import pytest
+from config import BUILD_MEMORY_BUDGET
+from lib import inverted_index, tokenize
+from lib.inverted_index import InvertedIndex
+from lib.tokenize import Tokenizer
+
+STOPWORDS = ["a", "and", "in", "of", "the"]
+
+# made-up words of 2 to 4 syllables, so that they stem to themselves or
+# close to it; sampled with weight 1 / rank like the words of real text
+SYLLABLES = ["ka", "lo", "mi", "ne", "ru", "sa", "to", "vi", "zu", "pe"]
+
+
+def vocabulary(size: int, seed: int = 0) -> list[str]:
+    rng = random.Random(seed)
+    words: dict[str, None] = {}
+    while len(words) < size:
+        syllables = rng.choices(SYLLABLES, k=rng.randint(2, 4))
+        words["".join(syllables)] = None
+    return list(words)
+
+
+def make_movies(
+    count: int, seed: int = 0, first_id: int = 1, vocab: int = 300
+) -> list[dict]:
+    """A small corpus of `count` movies with doc ids from `first_id` on."""
+    rng = random.Random(seed)
+    words = vocabulary(vocab) + STOPWORDS
+    weights = [1 / rank for rank in range(1, len(words) + 1)]
+    rng.shuffle(weights)  # stop words are not always the rarest
+
+    def text(length: int) -> str:
+        return " ".join(rng.choices(words, weights, k=length))
+
+    return [
+        {
+            "id": doc_id,
+            "title": text(rng.randint(1, 4)).title(),
+            "description": text(rng.randint(5, 40)),
+        }
+        for doc_id in range(first_id, first_id + count)
+    ]
+
+
+def random_queries(count: int, seed: int = 0, max_words: int = 4) -> list[str]:
+    rng = random.Random(seed)
+    words = vocabulary(300) + STOPWORDS
+    return [
+        " ".join(rng.choices(words, k=rng.randint(1, max_words))) for _ in range(count)
+    ]
+
+
+@pytest.fixture
+def cache_dir(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    """An empty cache directory the index is built in and loaded from."""
+    directory = tmp_path / "cache"
+    for name, file_name in [
+        ("CACHE_DIR", ""),
+        ("CACHE_BUILD_FILE", "build.seg"),
+        ("CACHE_DOC_LENGTH_FILE", "doc_lengths.pkl"),
+        ("CACHE_DOCMAP_FILE", "docmap.pkl"),
+        ("CACHE_INDEX_FILE", "index.pkl"),
+        ("CACHE_MANIFEST_FILE", "segments.json"),
+        ("CACHE_SEGMENT_FILE", "index.seg"),
+        ("CACHE_STEMS_FILE", "stems.bin"),
+        ("CACHE_TF_FILE", "term_frequencies.pkl"),
+    ]:
+        monkeypatch.setattr(inverted_index, name, directory / file_name)
+
+    # a tokenizer of its own, without the stop words and stems of data/ and
+    # cache/
+    monkeypatch.setattr(tokenize, "_tokenizer", Tokenizer(STOPWORDS))
+    return directory
+
+
+@pytest.fixture
+def build_index(
+    cache_dir: Path, monkeypatch: pytest.MonkeyPatch
+) -> Callable[..., InvertedIndex]:
+    """Build and save an index of the given movies, and load it again."""
+
+    def build(
+        movies: list[dict],
+        workers: int = 1,
+        positions: bool = False,
+        memory_budget: int = BUILD_MEMORY_BUDGET,
+    ) -> InvertedIndex:
+        monkeypatch.setattr(inverted_index, "iter_movies", lambda: iter(movies))
+        index = InvertedIndex()
+        index.build(workers, memory_budget, positions)
+        index.save()
+        return load_index()
+
+    return build
+
+
+def load_index() -> InvertedIndex:
+    index = InvertedIndex()
+    index.load()
+    return index
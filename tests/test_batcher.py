@@ -0,0 +1,152 @@
+import asyncio
+import threading
+
+import numpy as np
+import pytest
+from lib.batcher import BatchingEncoder, EmbeddingBatcher
+
+
+class StandInEncoder:
+    """Encodes a text as its length and first character, recording calls."""
+
+    def __init__(self, fail: bool = False) -> None:
+        self.fail = fail
+        self.calls: list[list[str]] = []
+
+    def __call__(self, texts: list[str]) -> np.ndarray:
+        self.calls.append(texts)
+        if self.fail:
+            self.fail = False
+            raise RuntimeError("encoder failed")
+        return np.stack([vector(text) for text in texts])
+
+
+def vector(text: str) -> np.ndarray:
+    return np.array([len(text), ord(text[0])], dtype=np.float32)
+
+
+def run(encoder: StandInEncoder, requests, **settings):
+    # runs `requests(batcher)` on a fresh loop, closing the batcher after
+    async def main():
+        batcher = EmbeddingBatcher(encoder, **settings)
+        try:
+            return batcher, await requests(batcher)
+        finally:
+            await batcher.close()
+
+    return asyncio.run(main())
+
+
+def texts(count: int) -> list[str]:
+    return [f"text {i}" for i in range(count)]
+
+
+def test_full_batches_close_at_once():
+    encoder = StandInEncoder()
+
+    async def requests(batcher):
+        return await batcher.embed_many(texts(20))
+
+    # the deadline would be far off; only the last batch waits for it
+    batcher, vectors = run(encoder, requests, max_batch_size=8, max_wait_ms=50)
+    assert [len(call) for call in encoder.calls] == [8, 8, 4]
+    assert [text for call in encoder.calls for text in call] == texts(20)
+    np.testing.assert_array_equal(vectors, [vector(text) for text in texts(20)])
+    assert batcher.stats()["batches"] == 3
+
+
+def test_batches_close_at_the_deadline():
+    encoder = StandInEncoder()
+
+    async def requests(batcher):
+        first = asyncio.gather(batcher.embed("a"), batcher.embed("bb"))
+        await asyncio.sleep(0.2)
+        return await first, await batcher.embed("ccc")
+
+    run(encoder, requests, max_batch_size=8, max_wait_ms=20)
+    assert encoder.calls == [["a", "bb"], ["ccc"]]
+
+
+def test_identical_texts_are_encoded_once_per_batch():
+    encoder = StandInEncoder()
+
+    async def requests(batcher):
+        return await batcher.embed_many(["a", "bb", "a", "a"])
+
+    batcher, vectors = run(encoder, requests, max_batch_size=8, max_wait_ms=20)
+    assert encoder.calls == [["a", "bb"]]
+    np.testing.assert_array_equal(
+        vectors, [vector(text) for text in ["a", "bb", "a", "a"]]
+    )
+    assert batcher.stats()["mean_batch_size"] == 4
+
+
+def test_encoder_errors_reach_every_request_of_the_batch():
+    encoder = StandInEncoder(fail=True)
+
+    async def requests(batcher):
+        failed = await asyncio.gather(
+            *(batcher.embed(text) for text in texts(3)), return_exceptions=True
+        )
+        # the batcher keeps going after a failed batch
+        return failed, await batcher.embed("after")
+
+    _, (failed, after) = run(encoder, requests, max_batch_size=8, max_wait_ms=20)
+    assert [str(err) for err in failed] == ["encoder failed"] * 3
+    assert all(isinstance(err, RuntimeError) for err in failed)
+    np.testing.assert_array_equal(after, vector("after"))
+
+
+def test_requests_beyond_the_queue_limit_are_rejected():
+    encoder = StandInEncoder()
+
+    async def requests(batcher):
+        # queued before the worker gets to take any of them
+        return await asyncio.gather(
+            *(batcher.embed(text) for text in texts(3)), return_exceptions=True
+        )
+
+    batcher, found = run(
+        encoder, requests, max_batch_size=8, max_wait_ms=20, max_queue=2
+    )
+    assert isinstance(found[2], asyncio.QueueFull)
+    np.testing.assert_array_equal(found[:2], [vector(text) for text in texts(2)])
+    stats = batcher.stats()
+    assert (stats["requests"], stats["rejected"]) == (2, 1)
+
+
+def test_threaded_callers_share_batches():
+    encoder = StandInEncoder()
+    batching = BatchingEncoder(encoder, max_batch_size=64, max_wait_ms=200)
+    barrier = threading.Barrier(4)
+    found = {}
+
+    def call(caller: int) -> None:
+        caller_texts = [f"caller {caller} text {i}" for i in range(5)]
+        barrier.wait()
+        found[caller] = (caller_texts, batching(caller_texts))
+
+    threads = [threading.Thread(target=call, args=(caller,)) for caller in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = batching.stats()
+    batching.close()
+
+    for caller_texts, vectors in found.values():
+        np.testing.assert_array_equal(vectors, [vector(text) for text in caller_texts])
+    assert stats["requests"] == 20
+    assert stats["batches"] < 4
+
+
+@pytest.mark.parametrize("max_batch_size", [1, 3])
+def test_every_request_is_answered(max_batch_size):
+    encoder = StandInEncoder()
+
+    async def requests(batcher):
+        return await batcher.embed_many(texts(10))
+
+    _, vectors = run(encoder, requests, max_batch_size=max_batch_size, max_wait_ms=5)
+    assert max(len(call) for call in encoder.calls) == max_batch_size
+    np.testing.assert_array_equal(vectors, [vector(text) for text in texts(10)])
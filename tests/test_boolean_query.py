@@ -0,0 +1,140 @@
+import random
+from collections import Counter
+from itertools import islice
+
+import pytest
+from conftest import make_movies
+from lib import boolean_query
+from lib.tokenize import tokenize_str
+
+MOVIES = make_movies(300, seed=11)
+
+
+class Document:
+    def __init__(self, movie: dict) -> None:
+        self.title = tokenize_str(movie["title"])
+        self.description = tokenize_str(movie["description"])
+        self.tokens = self.title + self.description
+
+
+def brute_force(node: boolean_query.Node | None, documents: dict[int, Document]):
+    # the matching doc ids of a parsed query, document by document; None for
+    # parts without indexed words, which are left out like the index does
+    if node is None:
+        return None
+
+    if isinstance(node, boolean_query.Term):
+        tokens = tokenize_str(node.text)
+        if not tokens:
+            return None
+        return {
+            doc_id
+            for doc_id, document in documents.items()
+            if term_matches(node, tokens, document)
+        }
+
+    if isinstance(node, boolean_query.Or):
+        children = [brute_force(child, documents) for child in node.children]
+        children = [child for child in children if child is not None]
+        return set().union(*children) if children else None
+
+    included, excluded = [], []
+    for child in node.children if isinstance(node, boolean_query.And) else [node]:
+        if isinstance(child, boolean_query.Not):
+            if (found := brute_force(child.child, documents)) is not None:
+                excluded.append(found)
+        elif (found := brute_force(child, documents)) is not None:
+            included.append(found)
+    if not included and not excluded:
+        return None
+    matches = set(documents).intersection(*included)
+    return matches.difference(*excluded)
+
+
+def term_matches(term: boolean_query.Term, tokens: list[str], document: Document):
+    if term.phrase and len(tokens) > 1:
+        # a start of the phrase, within the field
+        starts = range(len(document.tokens) - len(tokens) + 1)
+        if term.field == "title":
+            starts = range(len(document.title) - len(tokens) + 1)
+        elif term.field == "description":
+            starts = range(len(document.title), starts.stop)
+        return any(
+            document.tokens[start : start + len(tokens)] == tokens for start in starts
+        )
+
+    field_tokens = {
+        None: document.tokens,
+        "title": document.title,
+        "description": document.description,
+    }[term.field]
+    return any(token in field_tokens for token in tokens)
+
+
+def random_query(rng: random.Random, words: list[str], depth: int = 2) -> str:
+    def primary() -> str:
+        field = rng.choice(["", "", "", "title:", "description:"])
+        kind = rng.random()
+        if kind < 0.15 and depth:
+            return f"{field}({random_query(rng, words, depth - 1)})"
+        if kind < 0.35:
+            # a few consecutive words of a document, or made-up
+            text = rng.choice(MOVIES)[rng.choice(["title", "description"])].split()
+            start = rng.randrange(len(text))
+            phrase = text[start : start + rng.randint(1, 3)]
+            if rng.random() < 0.2:
+                rng.shuffle(phrase)
+            return f'{field}"{" ".join(phrase)}"'
+        return field + rng.choice(words)
+
+    def unary() -> str:
+        return ("NOT " if rng.random() < 0.2 else "") + primary()
+
+    def conjunction() -> str:
+        parts = [unary()]
+        for _ in range(rng.randint(0, 2)):
+            parts.append(rng.choice([" AND ", " NOT ", " AND NOT "]) + unary())
+        return "".join(parts)
+
+    return rng.choice([" ", " OR "]).join(
+        conjunction() for _ in range(rng.randint(1, 3))
+    )
+
+
+def query_words() -> list[str]:
+    # frequent and rare words, a stop word and a word of no document
+    counts = Counter(
+        word
+        for movie in MOVIES
+        for word in f"{movie['title']} {movie['description']}".split()
+    )
+    ranked = [word for word, _ in counts.most_common()]
+    return ranked[:30] + ranked[-10:] + ["the", "Nowhere"]
+
+
+@pytest.mark.parametrize("segments", [1, 3])
+def test_random_queries_match_brute_force(build_index, segments):
+    index = build_index(MOVIES, positions=True)
+    movies = {movie["id"]: movie for movie in MOVIES}
+    for commit in range(segments - 1):
+        # updates and additions, and a deletion, per delta segment
+        for changed in make_movies(10, seed=commit, first_id=280 + commit * 15):
+            if changed["id"] in movies:
+                index.update_document(changed)
+            else:
+                index.add_document(changed)
+            movies[changed["id"]] = changed
+        index.delete_document(commit + 1)
+        del movies[commit + 1]
+        index.commit()
+    assert len(index.segments.files) == segments
+
+    documents = {doc_id: Document(movie) for doc_id, movie in movies.items()}
+    rng = random.Random(segments)
+    words = query_words()
+    for _ in range(200):
+        query = random_query(rng, words)
+        expected = sorted(brute_force(boolean_query.parse(query), documents) or ())
+        assert list(index.iter_documents(query)) == expected, query
+        assert index.get_documents(query) == expected, query
+        assert list(islice(index.iter_documents(query), 5)) == expected[:5], query
@@ -0,0 +1,104 @@
+import random
+
+import pytest
+from config import BM25_B, BM25_K1
+from conftest import load_index, make_movies, random_queries
+from lib.inverted_index import InvertedIndex
+from lib.segment_set import TieredMergePolicy
+from lib.tokenize import tokenize_str
+from lib.utils import document_text
+
+# small tiers, so that the commits below trigger merges
+POLICY = TieredMergePolicy(factor=2, min_segment_docs=10)
+
+
+def snapshot(index: InvertedIndex, movies: list[dict]) -> dict:
+    # what searches see of an index: corpus stats, live postings by doc id,
+    # stored documents and BM25 scores
+    postings = index.postings
+    doc_ids = postings.doc_ids
+    tokens = {token for movie in movies for token in tokenize_str(document_text(movie))}
+    terms = {}
+    for token in sorted(tokens):
+        ordinals, tfs = postings.lookup(token)
+        found = [(doc_ids[ordinal], tf) for ordinal, tf in zip(ordinals, tfs)]
+        if postings.positional:
+            found = [
+                (*posting, tuple(positions))
+                for posting, positions in zip(
+                    found, postings.positions_in(token, list(ordinals))
+                )
+            ]
+        terms[token] = sorted(found)
+
+    ids = sorted(movie["id"] for movie in movies)
+    return {
+        "doc_count": postings.doc_count,
+        "total_doc_length": postings.total_doc_length,
+        "terms": terms,
+        "documents": index.hydrate(ids, ("title", "description")),
+        "scores": [
+            index.bm25_search(query, 1000, BM25_K1, BM25_B)
+            for query in random_queries(50, seed=3)
+        ],
+    }
+
+
+@pytest.mark.parametrize("positions", [False, True])
+def test_incremental_changes_match_a_full_rebuild(build_index, cache_dir, positions):
+    rng = random.Random(7)
+    index = build_index(make_movies(200), positions=positions)
+    final = {movie["id"]: movie for movie in make_movies(200)}
+
+    # adds, updates and deletes over several commits, some of them merging
+    for commit in range(6):
+        for movie in make_movies(20, seed=commit + 1, first_id=150 + commit * 15):
+            if movie["id"] in final:
+                index.update_document(movie)
+            else:
+                index.add_document(movie)
+            final[movie["id"]] = movie
+        for doc_id in rng.sample(sorted(final), 5):
+            index.delete_document(doc_id)
+            del final[doc_id]
+        index.commit(POLICY)
+    assert len(index.segments.files) > 1
+
+    movies = sorted(final.values(), key=lambda movie: movie["id"])
+    incremental = snapshot(load_index(), movies)
+    index.merge(full=True)
+    merged = snapshot(load_index(), movies)
+    (merged_segment,) = index.segments.files
+    merged_bytes = (cache_dir / merged_segment).read_bytes()
+
+    rebuilt_index = build_index(movies, positions=positions)
+    rebuilt = snapshot(rebuilt_index, movies)
+    scores = rebuilt.pop("scores")
+    for found in (incremental, merged):
+        # impacts of several segments are computed, not stored: the same
+        # formula, but not always to the last bit
+        assert [
+            pytest.approx(query_scores) for query_scores in found.pop("scores")
+        ] == scores
+        assert found == rebuilt
+
+    # a fully merged index is the index a rebuild writes
+    (rebuilt_segment,) = rebuilt_index.segments.files
+    assert merged_bytes == (cache_dir / rebuilt_segment).read_bytes()
+
+
+def test_full_merge_sees_commits_of_another_writer(build_index):
+    # the merging index was loaded before the other one committed
+    index = build_index(make_movies(100))
+    other = load_index()
+    added = make_movies(3, seed=1, first_id=1000)
+    for movie in added:
+        other.add_document(movie)
+    other.commit()
+
+    index.merge(full=True)
+    merged = load_index()
+    assert len(merged.segments.files) == 1
+    assert merged.postings.doc_count == 103
+    ids = [movie["id"] for movie in added]
+    assert merged.hydrate(ids) == [{"title": movie["title"]} for movie in added]
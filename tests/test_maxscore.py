@@ -0,0 +1,45 @@
+import pytest
+from config import BM25_B, BM25_K1
+from conftest import make_movies, random_queries
+
+QUERIES = random_queries(200, seed=5)
+
+
+def hits(results: dict[int, float]) -> list[tuple[int, float]]:
+    return list(results.items())
+
+
+@pytest.mark.parametrize("k1, b", [(BM25_K1, BM25_B), (0.9, 0.4)])
+@pytest.mark.parametrize("limit", [1, 5, 10_000])
+def test_maxscore_matches_exhaustive(build_index, k1, b, limit):
+    # the default (k1, b) impacts are stored in the segment, others computed
+    index = build_index(make_movies(500))
+    for query in QUERIES:
+        expected = index.bm25_search_exhaustive(query, limit, k1, b)
+        found = index.bm25_search(query, limit, k1, b, engine="maxscore")
+        assert hits(found) == hits(expected), query
+
+
+def test_maxscore_matches_exhaustive_across_segments(build_index):
+    # delta segments store no impacts, and updated documents are tombstoned
+    index = build_index(make_movies(400))
+    for movie in make_movies(100, seed=1, first_id=301):
+        if movie["id"] <= 400:
+            index.update_document(movie)
+        else:
+            index.add_document(movie)
+    index.commit()
+    assert len(index.segments.files) > 1
+
+    for query in QUERIES:
+        assert hits(index.bm25_search(query, 10, BM25_K1, BM25_B)) == hits(
+            index.bm25_search_exhaustive(query, 10, BM25_K1, BM25_B)
+        ), query
+
+
+@pytest.mark.parametrize("limit", [0, -1])
+def test_limits_below_one_find_nothing(build_index, limit):
+    index = build_index(make_movies(50))
+    query = QUERIES[0]
+    assert index.bm25_search(query, limit, BM25_K1, BM25_B) == {}
+    assert index.bm25_search_exhaustive(query, limit, BM25_K1, BM25_B) == {}
@@ -0,0 +1,33 @@
+import pytest
+from conftest import make_movies
+from lib import inverted_index
+
+MOVIES = make_movies(600)
+
+
+def built_files(build_index, cache_dir, **options) -> dict[str, bytes]:
+    # the saved segment, whatever its name, and the stem table
+    index = build_index(MOVIES, **options)
+    (segment,) = index.segments.files
+    return {
+        "segment": (cache_dir / segment).read_bytes(),
+        "stems": (cache_dir / "stems.bin").read_bytes(),
+    }
+
+
+@pytest.mark.parametrize("positions", [False, True])
+@pytest.mark.parametrize("memory_budget", [None, 20_000])
+def test_worker_builds_match_serial_build(
+    build_index, cache_dir, monkeypatch, positions, memory_budget
+):
+    # many batches, and with a small budget many spilled runs as well
+    monkeypatch.setattr(inverted_index, "BUILD_BATCH_DOCS", 40)
+    options = {"positions": positions}
+    if memory_budget is not None:
+        options["memory_budget"] = memory_budget
+
+    serial = built_files(build_index, cache_dir, **options)
+    for workers in (2, 3):
+        assert built_files(build_index, cache_dir, workers=workers, **options) == (
+            serial
+        ), workers
@@ -0,0 +1,30 @@
+import pytest
+from config import BM25_B, BM25_K1
+
+MOVIES = [
+    {"id": 1, "title": "Gotham", "description": "the knight was dark and cold"},
+    {"id": 2, "title": "Gotham", "description": "the dark knight was cold"},
+    {"id": 3, "title": "Gotham", "description": "a dark night for the knight"},
+]
+
+
+def search(index, query: str, proximity: float) -> dict[int, float]:
+    return index.bm25_search(query, 10, BM25_K1, BM25_B, proximity)
+
+
+def test_in_order_pairs_rank_above_reversed_ones(build_index):
+    index = build_index(MOVIES, positions=True)
+    plain = search(index, "dark knight", 0.0)
+    boosted = search(index, "dark knight", 1.0)
+
+    assert list(boosted) == [2, 3, 1]
+    assert boosted[2] == pytest.approx(plain[2] + 1.0)
+    # "dark night for the knight": stop words are not counted
+    assert boosted[3] == pytest.approx(plain[3] + 1.0 / 3)
+    # "knight was dark" only has the words the other way round
+    assert boosted[1] == pytest.approx(plain[1])
+
+
+def test_repeated_words_are_not_boosted(build_index):
+    index = build_index(MOVIES, positions=True)
+    assert search(index, "knight knight", 1.0) == search(index, "knight knight", 0.0)
@@ -0,0 +1,86 @@
+import shutil
+from itertools import islice
+
+from config import BM25_B, BM25_K1, MAX_SEARCH_RESULTS
+from conftest import STOPWORDS, make_movies
+from lib import search
+from lib.result_cache import ResultCache
+
+
+def counts(cache: ResultCache) -> tuple[int, int, int]:
+    stats = cache.stats()
+    return stats["hits"], stats["disk_hits"], stats["misses"]
+
+
+def a_word(movies: list[dict]) -> str:
+    return next(
+        word for word in movies[0]["description"].split() if word not in STOPWORDS
+    )
+
+
+def test_results_are_cached_until_the_index_changes(
+    build_index, cache_dir, monkeypatch
+):
+    movies = make_movies(100)
+    query = a_word(movies)
+    cache = ResultCache()
+    monkeypatch.setattr(search, "result_cache", cache)
+    monkeypatch.setattr(search, "index_is_loaded", True)
+
+    index = build_index(movies)
+    monkeypatch.setattr(search, "search_index", index)
+    titles = search.index_search(query)
+    assert titles
+    assert search.index_search(query) == titles
+    assert counts(cache) == (1, 0, 1)
+
+    # a commit is a new generation of the same index
+    index.add_document({"id": 1000, "title": query, "description": query})
+    index.commit()
+    search.index_search(query)
+    assert counts(cache) == (1, 0, 2)
+
+    # a wiped and rebuilt index starts over at the same generation
+    generation = index.generation
+    shutil.rmtree(cache_dir)
+    for _ in range(generation):
+        rebuilt = build_index(movies[:50])
+    assert rebuilt.generation == generation
+    assert rebuilt.index_id != index.index_id
+    monkeypatch.setattr(search, "search_index", rebuilt)
+    found = search.index_search(query)
+    assert counts(cache) == (1, 0, 3)
+    doc_ids = islice(rebuilt.iter_documents(query), MAX_SEARCH_RESULTS)
+    assert found == [hit["title"] for hit in rebuilt.hydrate(doc_ids)]
+    assert cache.stats()["invalidations"] == 2
+
+
+def test_stored_results_are_only_those_of_the_index_searched(
+    build_index, cache_dir, tmp_path
+):
+    movies = make_movies(100)
+    query = a_word(movies)
+    path = tmp_path / "results.db"
+
+    index = build_index(movies)
+    cache = ResultCache(path)
+    expected = cache.bm25_search(index, query, 10, BM25_K1, BM25_B)
+    cache.close()
+
+    # reopened, the results of the same index are read from the table
+    cache = ResultCache(path)
+    assert cache.bm25_search(index, query, 10, BM25_K1, BM25_B) == expected
+    assert counts(cache) == (0, 1, 0)
+    cache.close()
+
+    # a rebuilt index of other movies at the same generation
+    shutil.rmtree(cache_dir)
+    rebuilt = build_index(make_movies(100, seed=1))
+    assert rebuilt.generation == index.generation
+    assert rebuilt.index_id != index.index_id
+    cache = ResultCache(path)
+    found = cache.bm25_search(rebuilt, query, 10, BM25_K1, BM25_B)
+    assert found == rebuilt.bm25_search(query, 10, BM25_K1, BM25_B)
+    assert found != expected
+    assert counts(cache) == (0, 0, 1)
+    cache.close()
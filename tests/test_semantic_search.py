@@ -0,0 +1,131 @@
+import sys
+import types
+import zlib
+from typing import ClassVar
+
+import numpy as np
+import pytest
+from config import TRANSFORMER_MODEL
+from conftest import make_movies, random_queries
+from lib import embeddings, semantic_search
+from lib.semantic_search import SemanticSearch
+from lib.utils import document_text
+
+DIMENSION = 32
+
+
+class FakeModel:
+    """Stands in for a SentenceTransformer: counts of hashed words."""
+
+    encoded: ClassVar[list[str]] = []  # every text encoded, by any instance
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    def encode(
+        self, texts: list[str], batch_size: int = 32, convert_to_numpy: bool = True
+    ) -> np.ndarray:
+        FakeModel.encoded.extend(texts)
+        return np.stack([embed(text) for text in texts])
+
+
+def embed(text: str) -> np.ndarray:
+    vector = np.zeros(DIMENSION, dtype=np.float32)
+    for word in text.lower().split():
+        vector[zlib.crc32(word.encode()) % DIMENSION] += 1
+    return vector
+
+
+@pytest.fixture(autouse=True)
+def fake_model(tmp_path, monkeypatch):
+    # the store in a temporary dir, and a fake sentence_transformers module
+    directory = tmp_path / "cache"
+    monkeypatch.setattr(embeddings, "CACHE_DIR", directory)
+    monkeypatch.setattr(
+        embeddings, "CACHE_EMBEDDINGS_MANIFEST_FILE", directory / "embeddings.json"
+    )
+    array_files = {}
+    for key, name in [
+        ("vectors", "CACHE_EMBEDDINGS_FILE"),
+        ("ids", "CACHE_EMBEDDING_IDS_FILE"),
+        ("hashes", "CACHE_EMBEDDING_HASHES_FILE"),
+    ]:
+        path = directory / getattr(embeddings, name).name
+        monkeypatch.setattr(embeddings, name, path)
+        array_files[key] = path
+    monkeypatch.setattr(embeddings, "ARRAY_FILES", array_files)
+
+    module = types.ModuleType("sentence_transformers")
+    module.SentenceTransformer = FakeModel
+    monkeypatch.setitem(sys.modules, "sentence_transformers", module)
+    monkeypatch.setattr(FakeModel, "encoded", [])
+    return directory
+
+
+def build(monkeypatch, movies: list[dict]) -> None:
+    monkeypatch.setattr(semantic_search, "iter_movies", lambda: iter(movies))
+    FakeModel.encoded.clear()
+    semantic_search.build_embeddings(batch_size=16)
+
+
+def test_build_embeddings_reuses_unchanged_documents(monkeypatch, capsys, fake_model):
+    movies = make_movies(100)
+    build(monkeypatch, movies)
+    assert len(FakeModel.encoded) == 100
+    assert "Encoded 100 documents, reused 0" in capsys.readouterr().out
+
+    build(monkeypatch, movies)
+    assert FakeModel.encoded == []
+    assert "Encoded 0 documents, reused 100" in capsys.readouterr().out
+
+    # 5 changed, 10 new and 20 removed documents, in another order
+    changed = [dict(movie, title="changed") for movie in movies[:5]]
+    new = make_movies(10, seed=1, first_id=1001)
+    movies = new + movies[40:] + changed + movies[5:20]
+    build(monkeypatch, movies)
+    assert sorted(FakeModel.encoded) == sorted(
+        document_text(movie) for movie in changed + new
+    )
+    assert "Encoded 15 documents, reused 75" in capsys.readouterr().out
+
+    store = embeddings.EmbeddingStore.load()
+    by_id = {movie["id"]: movie for movie in movies}
+    assert store.doc_ids.tolist() == sorted(by_id)
+    expected = embeddings.normalize(
+        np.stack([embed(document_text(by_id[doc_id])) for doc_id in sorted(by_id)])
+    )
+    assert np.array_equal(store.vectors, expected)
+
+    # only the arrays of the last build are left
+    assert len(list(fake_model.glob("*.npy"))) == 3
+
+
+@pytest.mark.parametrize("limit", [1, 10, 1000])
+def test_search_orders_hits_like_brute_force(monkeypatch, limit):
+    build(monkeypatch, make_movies(300))
+    store = embeddings.EmbeddingStore.load()
+    queries = random_queries(20, seed=2)
+
+    results = SemanticSearch(TRANSFORMER_MODEL).search(queries, limit)
+    for query, hits in zip(queries, results):
+        scores = dict(
+            zip(
+                store.doc_ids.tolist(),
+                (store.vectors @ embeddings.normalize(embed(query)[None])[0]).tolist(),
+            )
+        )
+        assert len(hits) == min(limit, len(scores))
+        # descending score, ties by ascending doc id
+        assert hits == sorted(hits, key=lambda hit: (-hit[1], hit[0]))
+        # the brute force scores (up to float rounding of the matrix product),
+        # and no better document left out
+        assert [score for _, score in hits] == pytest.approx(
+            [scores[doc_id] for doc_id, _ in hits], abs=1e-6
+        )
+        found = {doc_id for doc_id, _ in hits}
+        worst = hits[-1][1]
+        assert all(
+            score <= worst + 1e-6
+            for doc_id, score in scores.items()
+            if doc_id not in found
+        )
@@ -0,0 +1,59 @@
+import pytest
+from config import BM25_B, BM25_K1
+from conftest import make_movies, random_queries
+from lib.inverted_index import InvertedIndex
+from lib.sparse_bm25 import SparseBM25
+from lib.tokenize import tokenize_str
+
+QUERIES = random_queries(200, seed=9)
+
+
+@pytest.fixture(params=[1, 2], ids=["one segment", "delta segment"])
+def index(request, build_index) -> InvertedIndex:
+    index = build_index(make_movies(400))
+    if request.param > 1:
+        # computed instead of stored impacts, and tombstones
+        for movie in make_movies(60, seed=1, first_id=380):
+            if movie["id"] <= 400:
+                index.update_document(movie)
+            else:
+                index.add_document(movie)
+        index.delete_document(7)
+        index.commit()
+    assert len(index.segments.files) == request.param
+    return index
+
+
+@pytest.mark.parametrize("k1, b", [(BM25_K1, BM25_B), (0.9, 0.4)])
+@pytest.mark.parametrize("limit", [1, 10, 10_000])
+def test_sparse_engine_matches_reference(index, k1, b, limit):
+    # the same hits in the same order, and scores equal to the last bit
+    for query in QUERIES:
+        expected = index.bm25_search_exhaustive(query, limit, k1, b)
+        found = index.bm25_search(query, limit, k1, b, engine="sparse")
+        assert list(found.items()) == list(expected.items()), query
+
+
+@pytest.mark.parametrize("batch_postings", [1, 50, 100_000])
+def test_batched_queries_match_reference(index, batch_postings):
+    # from one query per product to all of them in one
+    engine = SparseBM25(
+        index.postings,
+        lambda token: index.get_bm25_impacts(token, BM25_K1, BM25_B),
+        batch_postings,
+    )
+    doc_ids = index.postings.doc_ids
+    tops = engine.top_k_many([tokenize_str(query) for query in QUERIES], 10)
+    for query, top in zip(QUERIES, tops):
+        expected = index.bm25_search_exhaustive(query, 10, BM25_K1, BM25_B)
+        assert [(doc_ids[ordinal], score) for ordinal, score in top] == list(
+            expected.items()
+        ), query
+
+
+def test_batched_search_matches_single_searches(index):
+    tokens = [tokenize_str(query) for query in QUERIES]
+    batched = index.bm25_search_tokens_many(tokens, 10, BM25_K1, BM25_B, "sparse")
+    for query, found in zip(QUERIES, batched):
+        single = index.bm25_search(query, 10, BM25_K1, BM25_B, engine="sparse")
+        assert list(found.items()) == list(single.items()), query
@@ -0,0 +1,32 @@
+import pytest
+from lib.stem_table import StemTable
+
+STEMS = {"running": "run", "knights": "knight", "darkness": "dark"}
+
+
+def test_lookups(tmp_path):
+    path = tmp_path / "stems.bin"
+    StemTable.write(path, STEMS)
+    table = StemTable.open(path)
+    assert len(table) == 3
+    assert {word: table.get(word) for word in STEMS} == STEMS
+    assert table.get("run") is None
+
+
+@pytest.mark.parametrize(
+    "damage",
+    [
+        lambda data: b"",
+        lambda data: data[:10],
+        lambda data: data[:40],
+        lambda data: data[:-1],
+        lambda data: b"NOTSTEMS" + data[8:],
+    ],
+    ids=["empty", "header", "offsets", "blob", "magic"],
+)
+def test_damaged_tables_are_not_used(tmp_path, damage):
+    path = tmp_path / "stems.bin"
+    StemTable.write(path, STEMS)
+    path.write_bytes(damage(path.read_bytes()))
+    assert StemTable.open(path) is None
+    assert StemTable.open(tmp_path / "missing.bin") is None